@@ -0,0 +1,110 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+"""
+Measures how many capability checks per second ircdb.checkCapability does for
+nested commands, each of which checks the capabilities
+callbacks.checkCommandCapability checks (anti-capabilities of the command and
+its plugin, globally and in the channel).
+
+Usage: PYTHONPATH=. python3 benchmarks/capabilities.py
+
+Run it from a scratch directory, as importing supybot.ircdb creates conf/ and
+logs/ in the current directory.
+"""
+
+import time
+
+from supybot import conf, ircdb
+
+USERS = 20000
+COMMANDS = ['%s.%s' % (plugin, command)
+            for plugin in ('channel', 'misc', 'utilities', 'string', 'math')
+            for command in ('echo', 'last', 'list', 'calc', 'len', 'kick')]
+CHANNELS = ['#chan%d' % i for i in range(10)]
+ROUNDS = 20
+
+def capabilities(command, channel):
+    (plugin, _) = command.split('.')
+    for capability in (command, plugin):
+        yield ircdb.makeAntiCapability(capability)
+        yield ircdb.makeChannelCapability(channel,
+                ircdb.makeAntiCapability(capability))
+        yield ircdb.makeChannelCapability(channel, capability)
+
+def main():
+    users = ircdb.UsersDictionary()
+    for i in range(USERS):
+        user = ircdb.IrcUser()
+        user.id = i + 1
+        user.name = 'user%d' % i
+        user.hostmasks.add('*!*@host%d.example.org' % i)
+        if i % 10 == 0:
+            user.addCapability('-math.calc')
+        # setUser checks the hostmasks against every other user's.
+        users.users[user.id] = user
+        users.reindexUser(user)
+    channels = ircdb.ChannelsDictionary()
+    for channel in CHANNELS:
+        c = ircdb.IrcChannel()
+        c.addCapability('-string.len')
+        channels.setChannel(channel, c)
+    channels.flush = lambda: None
+    hostmasks = ['nick%d!~user@host%d.example.org' % (i, i)
+                 for i in range(0, USERS, USERS // 50)]
+    hostmasks += ['unknown%d!~user@unknown%d.example.net' % (i, i)
+                  for i in range(50)]
+    checks = [(hostmask, capability)
+              for hostmask in hostmasks
+              for command in COMMANDS
+              for capability in capabilities(command, CHANNELS[0])]
+
+    def run(name, check):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            for (hostmask, capability) in checks:
+                check(hostmask, capability)
+        elapsed = time.perf_counter() - start
+        print('%-32s %8.0f checks/s' %
+              (name + ':', len(checks) * ROUNDS / elapsed))
+
+    run('uncached', lambda hostmask, capability:
+        ircdb._checkCapability(hostmask, capability, users, channels,
+                               False, False, False))
+    check = lambda hostmask, capability: \
+        ircdb.checkCapability(hostmask, capability, users, channels)
+    run('cached (%s entries)' % conf.supybot.caches.capabilities(), check)
+    with conf.supybot.caches.capabilities.context(len(checks)):
+        run('cached (%s entries)' % len(checks), check)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,79 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+"""
+Measures how many lookups per second cdb.Reader does on a database of 100k
+records, reading the file with seek and read, and memory-mapping it.
+
+Usage: PYTHONPATH=. python3 benchmarks/cdb.py
+
+Run it from a scratch directory, as importing supybot creates conf/ and logs/
+in the current directory.
+"""
+
+import os
+import time
+import random
+import tempfile
+
+from supybot import cdb
+
+RECORDS = 100000
+LOOKUPS = 200000
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'bench.cdb')
+        maker = cdb.Maker(filename)
+        for i in range(RECORDS):
+            maker.add('http://example.org/%d' % i, 'https://ex.am/%x' % i)
+        maker.finish()
+        keys = ['http://example.org/%d' % random.randrange(RECORDS * 2)
+                for _ in range(LOOKUPS)]
+        for useMmap in (False, True):
+            reader = cdb.Reader(filename, useMmap=useMmap)
+            name = 'mmap' if useMmap else 'seek/read'
+            start = time.perf_counter()
+            for key in keys:
+                reader.get(key)
+            elapsed = time.perf_counter() - start
+            print('%-10s get:      %8.0f lookups/s' %
+                  (name, LOOKUPS / elapsed))
+            start = time.perf_counter()
+            reader.get_many(keys)
+            elapsed = time.perf_counter() - start
+            print('%-10s get_many: %8.0f lookups/s' %
+                  (name, LOOKUPS / elapsed))
+            reader.close()
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,90 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+"""
+Measures how many records per second each dbi mapping adds, gets, sets, and
+reads back when the database is opened, with databases of 100k records.
+
+Usage: PYTHONPATH=. python3 benchmarks/dbi.py [mapping ...]
+
+Run it from a scratch directory, as importing supybot creates conf/ and logs/
+in the current directory.  The flat mapping reads the whole file for every
+get or set, so it is only asked for a few of them.
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+from supybot import dbi
+
+RECORDS = 100000
+OPERATIONS = 20000
+SLOW_OPERATIONS = {'flat': 20}
+
+def bench(name, directory):
+    filename = os.path.join(directory, '%s.db' % name)
+    Mapping = dbi.Mappings[name]
+    map = Mapping(filename)
+    record = 'x' * 80
+    start = time.perf_counter()
+    ids = [map.add(record) for _ in range(RECORDS)]
+    add = RECORDS / (time.perf_counter() - start)
+    map.flush()
+    n = SLOW_OPERATIONS.get(name, OPERATIONS)
+    sample = random.sample(ids, n)
+    start = time.perf_counter()
+    for id in sample:
+        map.get(id)
+    get = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for id in sample:
+        map.set(id, 'y' * 80)
+    set = n / (time.perf_counter() - start)
+    map.close()
+    start = time.perf_counter()
+    map = Mapping(filename)
+    opened = time.perf_counter() - start
+    map.close()
+    print('%-8s  add: %8.0f/s  get: %8.0f/s  set: %8.0f/s  open: %6.3fs' %
+          (name, add, get, set, opened))
+
+def main():
+    names = sys.argv[1:] or ['flat', 'cdb', 'indexed']
+    with tempfile.TemporaryDirectory() as directory:
+        for name in names:
+            bench(name, directory)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,116 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+"""
+Measures how many requests per second the embedded HTTP server answers to
+concurrent clients, with the single-threaded server and with the threaded
+server and persistent connections.  Some requests are slow, to show how they
+affect the others.
+
+Usage: PYTHONPATH=. python3 benchmarks/httpserver.py
+
+Run it from a scratch directory, as importing supybot creates conf/ and logs/
+in the current directory.
+"""
+
+import time
+import threading
+import http.client
+
+from supybot import conf, httpserver
+
+CLIENTS = 20
+REQUESTS = 50
+SLOW_DELAY = 0.05
+
+class Callback(httpserver.SupyHTTPServerCallback):
+    name = 'bench'
+    def doGet(self, handler, path):
+        if path == '/slow':
+            time.sleep(SLOW_DELAY)
+        response = b'ok'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+def client(port, slow, keepAlive, latencies):
+    connection = None
+    for i in range(REQUESTS):
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', port)
+        start = time.perf_counter()
+        connection.request('GET', '/bench/slow' if slow else '/bench/fast')
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if not keepAlive or response.will_close:
+            connection.close()
+            connection = None
+    if connection is not None:
+        connection.close()
+
+def run(threaded):
+    with conf.supybot.servers.http.threaded.context(threaded):
+        server = httpserver.RealSupyHTTPServer(('127.0.0.1', 0), 4,
+                httpserver.SupyHTTPRequestHandler)
+    server.hook('bench', Callback())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    port = server.server_address[1]
+    latencies = []
+    clients = [threading.Thread(target=client,
+                                args=(port, i == 0, threaded, latencies))
+               for i in range(CLIENTS)]
+    start = time.perf_counter()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    server.server_close()
+    thread.join()
+    latencies.sort()
+    print('%-12s %7.0f requests/s, median latency %6.2fms, '
+          'p99 latency %6.2fms' %
+          ('threaded' if threaded else 'single', len(latencies) / elapsed,
+           latencies[len(latencies) // 2] * 1000,
+           latencies[len(latencies) * 99 // 100] * 1000))
+
+def main():
+    for threaded in (False, True):
+        run(threaded)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
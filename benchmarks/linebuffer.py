@@ -0,0 +1,122 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Compares the line framing of the Socket driver before and after
+drivers.LineBuffer, by replaying a burst of IRC lines.
+
+Usage: PYTHONPATH=. python3 benchmarks/linebuffer.py [capture]
+
+capture is a file of raw IRC lines, as received from a server; by default a
+synthetic netsplit/NAMES burst of 100k lines is used.
+"""
+
+import sys
+import time
+import socket
+import threading
+
+from supybot import drivers
+
+LINES = 100000
+ROUNDS = 5
+
+def syntheticBurst():
+    lines = []
+    for i in range(LINES):
+        if i % 3 == 0:
+            lines.append(':irc.example.net 353 bot = #chan :%s' %
+                         ' '.join('@nick%d' % j for j in range(i % 40)))
+        elif i % 3 == 1:
+            lines.append(':nick%d!~user%d@host-%d.example.org QUIT '
+                         ':irc.example.net irc2.example.net' % (i, i, i))
+        else:
+            lines.append(':nick%d!~user%d@host-%d.example.org JOIN #chan'
+                         % (i, i, i))
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+def replay(data):
+    """Returns a socket receiving data from a thread, like it would from a
+    server."""
+    (a, b) = socket.socketpair()
+    def send():
+        a.sendall(data)
+        a.close()
+    threading.Thread(target=send).start()
+    return b
+
+def oldFraming(data, readSize):
+    conn = replay(data)
+    inbuffer = b''
+    count = 0
+    while True:
+        received = conn.recv(readSize)
+        if not received:
+            conn.close()
+            return count
+        inbuffer += received
+        lines = inbuffer.split(b'\n')
+        inbuffer = lines.pop()
+        count += len(lines)
+
+def newFraming(data, readSize):
+    conn = replay(data)
+    inbuffer = drivers.LineBuffer()
+    count = 0
+    while inbuffer.recvInto(conn, readSize):
+        count += len(inbuffer.lines())
+    conn.close()
+    return count
+
+def bench(name, f, data, readSize):
+    best = None
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        count = f(data, readSize)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-30s %8.1f ms  %10d lines/s' %
+          ('%s (%d bytes reads)' % (name, readSize), best * 1000,
+           count / best))
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as fd:
+            data = fd.read()
+    else:
+        data = syntheticBurst()
+    print('%d bytes, %d lines' % (len(data), data.count(b'\n')))
+    for readSize in (1024, 16384, 65536):
+        bench('split', oldFraming, data, readSize)
+        bench('LineBuffer', newFraming, data, readSize)
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
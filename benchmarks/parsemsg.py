@@ -0,0 +1,99 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Measures how many lines per second drivers.parseMsg parses, and how long it
+takes to then read the fields plugins commonly use.
+
+Usage: PYTHONPATH=. python3 benchmarks/parsemsg.py [capture]
+
+capture is a file of raw IRC lines, as received from a server; by default a
+synthetic capture of 1M lines (joins, quits, channel messages, with and
+without IRCv3 message tags) is used.
+"""
+
+import sys
+import time
+
+from supybot import drivers
+from supybot.utils.str import decode_raw_line
+
+LINES = 1000000
+
+def syntheticCapture():
+    templates = [
+        ':nick%(i)d!~user%(i)d@host-%(i)d.example.org JOIN #chan',
+        '@time=2020-04-11T12:%(m)02d:%(s)02d.%(i)03dZ;account=acc%(i)d '
+        ':nick%(i)d!~user%(i)d@host-%(i)d.example.org JOIN #chan '
+        'acc%(i)d :Real Name',
+        '@time=2020-04-11T12:%(m)02d:%(s)02d.%(i)03dZ;msgid=abc%(i)d '
+        ':nick%(i)d!~user%(i)d@host-%(i)d.example.org PRIVMSG #chan '
+        ':hello world, this is line %(i)d',
+        ':nick%(i)d!~user%(i)d@host-%(i)d.example.org PRIVMSG #chan '
+        ':hello world, this is line %(i)d',
+        ':nick%(i)d!~user%(i)d@host-%(i)d.example.org QUIT '
+        ':irc.example.net irc2.example.net',
+        ':irc.example.net 353 bot = #chan :@op +voice nick%(i)d other%(i)d',
+        'PING :irc.example.net',
+        ]
+    for i in range(LINES):
+        yield (templates[i % len(templates)] %
+               {'i': i % 1000, 'm': i % 60, 's': (i // 60) % 60}).encode()
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as fd:
+            lines = fd.read().split(b'\n')
+    else:
+        lines = list(syntheticCapture())
+    lines = [decode_raw_line(line) for line in lines]
+
+    start = time.perf_counter()
+    msgs = [drivers.parseMsg(line) for line in lines]
+    elapsed = time.perf_counter() - start
+    print('parseMsg:               %8.0f lines/s' % (len(lines) / elapsed))
+
+    start = time.perf_counter()
+    for msg in msgs:
+        if msg is not None:
+            (msg.nick, msg.command, msg.args)
+    elapsed = time.perf_counter() - start
+    print('+ nick/command/args:    %8.0f lines/s' % (len(lines) / elapsed))
+
+    start = time.perf_counter()
+    for msg in msgs:
+        if msg is not None:
+            (msg.user, msg.host, msg.server_tags, msg.time)
+    elapsed = time.perf_counter() - start
+    print('+ user/host/tags/time:  %8.0f lines/s' % (len(lines) / elapsed))
+
+if __name__ == '__main__':
+    main()
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -30,6 +30,8 @@
 
 import re
 import math
+import heapq
+import array
 import types
 
 import supybot.log as log
@@ -44,7 +46,7 @@ import supybot.ircmsgs as ircmsgs
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
-from supybot.utils.math_evaluator import safe_eval, InvalidNode
+from supybot.utils.math_evaluator import safe_compile, InvalidNode
 
 _ = PluginInternationalization('ChannelStats')
 
@@ -142,20 +144,29 @@ class StatsDB(plugins.ChannelUserDB):
         else:
             return UserStat(*L)
 
+    def getForUpdate(self, channel, id):
+        """Returns the stats of <id> in <channel>, creating them if needed.
+        They are marked as changed, so the caller can update them in place."""
+        try:
+            stat = self[channel, id]
+        except KeyError:
+            if id == 'channelStats':
+                stat = ChannelStat()
+            else:
+                stat = UserStat()
+        self[channel, id] = stat
+        return stat
+
     def addMsg(self, irc, msg, id=None):
         if msg.channel:
             channel = plugins.getChannel(msg.channel)
-            if (channel, 'channelStats') not in self:
-                self[channel, 'channelStats'] = ChannelStat()
-            self[channel, 'channelStats'].addMsg(msg)
+            self.getForUpdate(channel, 'channelStats').addMsg(msg)
             try:
                 if id is None:
                     id = ircdb.users.getUserId(msg.prefix)
             except KeyError:
                 return
-            if (channel, id) not in self:
-                self[channel, id] = UserStat()
-            self[channel, id].addMsg(msg)
+            self.getForUpdate(channel, id).addMsg(msg)
 
     def getChannelStats(self, channel):
         return self[channel, 'channelStats']
@@ -172,7 +183,7 @@ class ChannelStats(callbacks.Plugin):
         self.__parent = super(ChannelStats, self)
         self.__parent.__init__(irc)
         self.outFiltering = False
-        self.db = StatsDB(filename)
+        self.db = plugins.openChannelUserDB(StatsDB, filename)
         self._flush = self.db.flush
         world.flushers.append(self._flush)
 
@@ -197,11 +208,9 @@ class ChannelStats(callbacks.Plugin):
         return msg
 
     def _setUsers(self, irc, channel):
-        if (channel, 'channelStats') not in self.db:
-            self.db[channel, 'channelStats'] = ChannelStat()
-        oldUsers = self.db[channel, 'channelStats'].users
+        stat = self.db.getForUpdate(channel, 'channelStats')
         newUsers = len(irc.state.channels[channel].users)
-        self.db[channel, 'channelStats'].users = max(oldUsers, newUsers)
+        stat.users = max(stat.users, newUsers)
 
     def doJoin(self, irc, msg):
         self._setUsers(irc, msg.args[0])
@@ -215,13 +224,9 @@ class ChannelStats(callbacks.Plugin):
         except KeyError:
             id = None
         for channel in msg.tagged('channels'):
-            if (channel, 'channelStats') not in self.db:
-                self.db[channel, 'channelStats'] = ChannelStat()
-            self.db[channel, 'channelStats'].quits += 1
+            self.db.getForUpdate(channel, 'channelStats').quits += 1
             if id is not None:
-                if (channel, id) not in self.db:
-                    self.db[channel, id] = UserStat()
-                self.db[channel, id].quits += 1
+                self.db.getForUpdate(channel, id).quits += 1
 
     def doKick(self, irc, msg):
         (channel, nick, _) = msg.args
@@ -230,9 +235,7 @@ class ChannelStats(callbacks.Plugin):
             id = ircdb.users.getUserId(hostmask)
         except KeyError:
             return
-        if (channel, id) not in self.db:
-            self.db[channel, id] = UserStat()
-        self.db.channels[channel][id].kicked += 1
+        self.db.getForUpdate(channel, id).kicked += 1
 
     @internationalizeDocstring
     def stats(self, irc, msg, args, channel, name):
@@ -296,50 +299,69 @@ class ChannelStats(callbacks.Plugin):
     stats = wrap(stats, ['channeldb', additional('something')])
 
     @internationalizeDocstring
-    def rank(self, irc, msg, args, channel, expr):
-        """[<channel>] <stat expression>
+    def rank(self, irc, msg, args, channel, optlist, expr):
+        """[<channel>] [--top <n>] <stat expression>
 
         Returns the ranking of users according to the given stat expression.
         Valid variables in the stat expression include 'msgs', 'chars',
         'words', 'smileys', 'frowns', 'actions', 'joins', 'parts', 'quits',
         'kicks', 'kicked', 'topics', and 'modes'.  Any simple mathematical
-        expression involving those variables is permitted.
+        expression involving those variables is permitted.  If --top is
+        given, only the <n> first users are returned.
         """
+        top = dict(optlist).get('top')
         if channel != '#':
             # Skip this check if databases.plugins.channelspecific is False.
             if msg.nick not in irc.state.channels[channel].users:
                 irc.error(format('You must be in %s to use this command.', channel))
                 return
         expr = expr.lower()
-        users = []
-        for ((c, id), stats) in self.db.items():
-            if ircutils.strEqual(c, channel) and \
-               (id == 0 or ircdb.users.hasUser(id)):
-                e = {}
-                for attr in stats._values:
-                    e[attr] = float(getattr(stats, attr))
-                try:
-                    v = safe_eval(expr, allow_ints=True, variables=e)
-                except ZeroDivisionError:
-                    v = float('inf')
-                except NameError as e:
-                    irc.errorInvalid(_('stat variable'), str(e))
-                except InvalidNode as e:
-                    irc.error(_('Invalid syntax: %s') % e.args[0], Raise=True)
-                except Exception as e:
-                    irc.error(utils.exnToString(e), Raise=True)
-                else:
-                    v = float(v)
-                if id == 0:
-                    users.append((v, irc.nick))
-                else:
-                    users.append((v, ircdb.users.getUser(id).name))
-        users.sort()
-        users.reverse()
+        try:
+            f = safe_compile(expr, allow_ints=True, variables=UserStat._values)
+        except NameError as e:
+            irc.errorInvalid(_('stat variable'), str(e), Raise=True)
+        except InvalidNode as e:
+            irc.error(_('Invalid syntax: %s') % e.args[0], Raise=True)
+        except Exception as e:
+            irc.error(utils.exnToString(e), Raise=True)
+        # The stats are put in columns, so the expression is evaluated on
+        # all users at once.
+        names = []
+        columns = dict((attr, array.array('d')) for attr in UserStat._values)
+        for (id, stats) in self.db.channelItems(channel):
+            if id == 0:
+                names.append(irc.nick)
+            elif isinstance(id, int) and ircdb.users.hasUser(id):
+                names.append(ircdb.users.getUser(id).name)
+            else:
+                continue
+            for attr in UserStat._values:
+                columns[attr].append(getattr(stats, attr))
+        try:
+            try:
+                values = f(columns, len(names))
+            except ZeroDivisionError:
+                # Only the users it happened with rank at the top.
+                values = []
+                for i in range(len(names)):
+                    row = dict((attr, column[i:i+1])
+                               for (attr, column) in columns.items())
+                    try:
+                        values.extend(f(row, 1))
+                    except ZeroDivisionError:
+                        values.append(float('inf'))
+            values = list(map(float, values))
+        except Exception as e:
+            irc.error(utils.exnToString(e), Raise=True)
+        users = zip(values, names)
+        if top:
+            users = heapq.nlargest(top, users)
+        else:
+            users = sorted(users, reverse=True)
         s = utils.str.commaAndify(['#%s %s (%.3g)' % (i+1, u, v)
                                    for (i, (v, u)) in enumerate(users)])
         irc.reply(s)
-    rank = wrap(rank, ['channeldb', 'text'])
+    rank = wrap(rank, ['channeldb', getopts({'top': 'positiveInt'}), 'text'])
 
     @internationalizeDocstring
     def channelstats(self, irc, msg, args, channel):
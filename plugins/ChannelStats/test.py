@@ -93,6 +93,12 @@ class ChannelStatsTestCase(ChannelPluginTestCase):
         self.assertNotError('channelstats rank chars / msgs')
         self.assertNotError('channelstats rank kicks/kicked') # Tests inf
         self.assertNotError('channelstats rank log(msgs)')
+        self.assertRegexp('channelstats rank msgs / 0', r'\(inf\)')
+        self.assertRegexp('channelstats rank --top 1 msgs', r'^#1 [^,]*$')
+        self.assertRegexp('channelstats rank msgs ** 2 + 1',
+                          r'^#1 \S+ \(\d+\) and #2 \S+ \(\d+\)$')
+        self.assertError('channelstats rank foo')
+        self.assertError('channelstats rank msgs <')
 
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
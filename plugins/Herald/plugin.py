@@ -60,7 +60,7 @@ class Herald(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(Herald, self)
         self.__parent.__init__(irc)
-        self.db = HeraldDB(filename)
+        self.db = plugins.openChannelUserDB(HeraldDB, filename)
         world.flushers.append(self.db.flush)
         self.lastParts = plugins.ChannelUserDictionary()
         splitTimeout = conf.supybot.plugins.Herald.throttle.afterSplit
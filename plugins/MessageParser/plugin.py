@@ -42,6 +42,12 @@ import re
 import os
 import sys
 import time
+import collections
+
+try:
+    from re import _parser as sre_parse
+except ImportError: # Python < 3.11
+    import sre_parse
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -70,6 +76,32 @@ import supybot.world as world
 import supybot.log as log
 
 
+def requiredLiteral(regexp):
+    """Returns the longest run of literal characters that any match of
+    <regexp> must contain, or an empty string if there is none (or if the
+    regexp is case-insensitive, which a plain substring test can't
+    emulate)."""
+    try:
+        parsed = sre_parse.parse(regexp)
+    except Exception:
+        return ''
+    state = getattr(parsed, 'state', None) or parsed.pattern
+    if state.flags & sre_parse.SRE_FLAG_IGNORECASE:
+        return ''
+    best = ''
+    current = []
+    for (op, av) in parsed:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+        else:
+            if len(current) > len(best):
+                best = ''.join(current)
+            current = []
+    if len(current) > len(best):
+        best = ''.join(current)
+    return best
+
+
 class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
     """This plugin can set regexp triggers to activate the bot.
     Use 'add' command to add regexp trigger, 'remove' to remove."""
@@ -77,6 +109,18 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
     def __init__(self, irc):
         callbacks.Plugin.__init__(self, irc)
         plugins.ChannelDBHandler.__init__(self)
+        # Maps database filenames to lists of compiled triggers.
+        self._triggers = {}
+        # Maps database channels to Counters of pending usage_count updates.
+        self._ranks = {}
+        self._ranksLock = threading.Lock()
+        world.flushers.append(self._flushRanks)
+
+    def die(self):
+        if self._flushRanks in world.flushers:
+            world.flushers.remove(self._flushRanks)
+        self._flushRanks()
+        callbacks.Plugin.die(self)
 
     def makeDb(self, filename):
         """Create the database and connect to it."""
@@ -115,16 +159,60 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
         db.isolation_level = None
         return db
 
+    def _getTriggers(self, channel):
+        """Returns the compiled triggers of the database of <channel>, as
+        (regexp, pattern, literal, action) tuples, where literal is a
+        substring every match of pattern contains."""
+        filename = self.makeFilename(channel)
+        triggers = self._triggers.get(filename)
+        if triggers is None:
+            db = self.getDb(channel)
+            cursor = db.cursor()
+            cursor.execute("SELECT regexp, action FROM triggers ORDER BY id")
+            triggers = []
+            for (regexp, action) in cursor.fetchall():
+                try:
+                    pattern = re.compile(regexp)
+                except Exception as e:
+                    log.warning('MessageParser: invalid regexp %q in %s: %s',
+                                regexp, filename, e)
+                    continue
+                triggers.append((regexp, pattern, requiredLiteral(regexp),
+                                 action))
+            self._triggers[filename] = triggers
+        return triggers
+
+    def _invalidateTriggers(self, channel):
+        self._triggers.pop(self.makeFilename(channel), None)
+
     def _updateRank(self, network, channel, regexp):
         subfolder = None if channel == 'global' else channel
         if self.registryValue('keepRankInfo', subfolder, network):
+            with self._ranksLock:
+                counts = self._ranks.setdefault(channel,
+                                                collections.Counter())
+                counts[regexp] += 1
+
+    def _flushRanks(self, channel=None):
+        """Writes the pending usage counts (only those of <channel>'s
+        database, if given) to the databases."""
+        with self._ranksLock:
+            if channel is None:
+                pending = self._ranks
+                self._ranks = {}
+            else:
+                channel = plugins.getChannel(channel)
+                pending = {}
+                if channel in self._ranks:
+                    pending[channel] = self._ranks.pop(channel)
+        for (channel, counts) in pending.items():
             db = self.getDb(channel)
             cursor = db.cursor()
-            cursor.execute("""SELECT usage_count
-                      FROM triggers
-                      WHERE regexp=?""", (regexp,))
-            old_count = cursor.fetchall()[0][0]
-            cursor.execute("UPDATE triggers SET usage_count=? WHERE regexp=?", (old_count + 1, regexp,))
+            cursor.executemany("""UPDATE triggers
+                                  SET usage_count=usage_count+?
+                                  WHERE regexp=?""",
+                               [(count, regexp)
+                                for (regexp, count) in counts.items()])
             db.commit()
 
     def _runCommandFunction(self, irc, msg, command):
@@ -158,21 +246,14 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
         if not channel:
             return
         if self.registryValue('enable', channel, irc.network):
+            text = msg.args[1]
             actions = []
-            results = []
-            for channel in set(map(plugins.getChannel, (channel, 'global'))):
-                db = self.getDb(channel)
-                cursor = db.cursor()
-                cursor.execute("SELECT regexp, action FROM triggers")
-                # Fetch results and prepend channel name or 'global'. This
-                # prevents duplicating the following lines.
-                results.extend([(channel,)+x for x in cursor.fetchall()])
-            if len(results) == 0:
-                return
             max_triggers = self.registryValue('maxTriggers', channel, irc.network)
-            for (channel, regexp, action) in results:
-                for match in re.finditer(regexp, msg.args[1]):
-                    if match is not None:
+            for channel in set(map(plugins.getChannel, (channel, 'global'))):
+                for (regexp, pattern, literal, action) in self._getTriggers(channel):
+                    if literal not in text:
+                        continue
+                    for match in pattern.finditer(text):
                         thisaction = action
                         self._updateRank(irc.network, channel, regexp)
                         for (i, j) in enumerate(match.groups()):
@@ -181,10 +262,11 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
                         actions.append(thisaction)
                         if max_triggers != 0 and max_triggers == len(actions):
                             break
+                    if max_triggers != 0 and max_triggers == len(actions):
+                        break
                 if max_triggers != 0 and max_triggers == len(actions):
                     break
 
-
             for action in actions:
                 self._runCommandFunction(irc, msg, action)
 
@@ -207,6 +289,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
         if not self._checkManageCapabilities(irc, msg, channel):
             capabilities = self.registryValue('requireManageCapability')
             irc.errorNoCapability(capabilities, Raise=True)
+        self._flushRanks(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
         cursor.execute("SELECT id, usage_count, locked FROM triggers WHERE regexp=?", (regexp,))
@@ -230,6 +313,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
                               (NULL, ?, ?, ?, ?, ?, ?)""",
                             (regexp, name, int(time.time()), usage_count, action, locked,))
             db.commit()
+            self._invalidateTriggers(channel)
             irc.replySuccess()
         else:
             irc.error(_('That trigger is locked.'))
@@ -269,6 +353,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
 
         cursor.execute("""DELETE FROM triggers WHERE id=?""", (id,))
         db.commit()
+        self._invalidateTriggers(channel)
         irc.replySuccess()
     remove = wrap(remove, ['channelOrGlobal',
                             getopts({'id': '',}),
@@ -294,6 +379,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
             return
         cursor.execute("UPDATE triggers SET locked=1 WHERE regexp=?", (regexp,))
         db.commit()
+        self._invalidateTriggers(channel)
         irc.replySuccess()
     lock = wrap(lock, ['channelOrGlobal', 'text'])
 
@@ -317,6 +403,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
             return
         cursor.execute("UPDATE triggers SET locked=0 WHERE regexp=?", (regexp,))
         db.commit()
+        self._invalidateTriggers(channel)
         irc.replySuccess()
     unlock = wrap(unlock, ['channelOrGlobal', 'text'])
 
@@ -358,6 +445,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
         itself.
         If option --id specified, will retrieve by regexp id, not content.
         """
+        self._flushRanks(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
         target = 'regexp'
@@ -421,6 +509,7 @@ class MessageParser(callbacks.Plugin, plugins.ChannelDBHandler):
         message isn't sent in the channel itself.
         """
         numregexps = self.registryValue('rankListLength', channel, irc.network)
+        self._flushRanks(channel)
         db = self.getDb(channel)
         cursor = db.cursor()
         cursor.execute("""SELECT regexp, usage_count
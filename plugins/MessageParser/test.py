@@ -85,6 +85,20 @@ class MessageParserTestCase(ChannelPluginTestCase):
         self.assertResponse(' ', '$1')
         self.assertNotError('messageparser remove "this( .+)? a(.*)"')
 
+    def testRequiredLiteral(self):
+        from . import plugin
+        self.assertEqual(plugin.requiredLiteral('stuff'), 'stuff')
+        self.assertEqual(plugin.requiredLiteral('this (.+) a(.*)'), 'this ')
+        self.assertEqual(plugin.requiredLiteral('ab?cde+f'), 'cd')
+        self.assertEqual(plugin.requiredLiteral('foo|barbaz'), '')
+        self.assertEqual(plugin.requiredLiteral('(?i)stuff'), '')
+        self.assertNotError('messageparser add "(?i)STUFF" "echo caseless"')
+        self.feedMsg('some stuff')
+        self.assertResponse(' ', 'caseless')
+        self.assertNotError('messageparser add "foo|barbaz" "echo branch"')
+        self.feedMsg('barbaz')
+        self.assertResponse(' ', 'branch')
+
     def testShow(self):
         self.assertNotError('messageparser add "stuff" "echo i saw some stuff"')
         self.assertRegexp('messageparser show "nostuff"', 'there is no such regexp trigger')
@@ -65,11 +65,11 @@ class DbiNewsDB(plugins.DbiChannelDB):
                                utils.str.timestamp(self.expires))
                 return s
 
-        def __init__(self, filename):
+        def __init__(self, filename, **kwargs):
             # We use self.__class__ here because apparently DB isn't in our
             # scope.  python--
             self.__parent = super(self.__class__, self)
-            self.__parent.__init__(filename)
+            self.__parent.__init__(filename, **kwargs)
 
         def add(self, subject, text, at, expires, by):
             return self.__parent.add(self.Record(at=at, by=by, text=text,
@@ -103,7 +103,7 @@ class DbiNewsDB(plugins.DbiChannelDB):
             (news.subject, news.text) = s.split(': ', 1)
             self.set(id, news)
 
-NewsDB = plugins.DB('News', {'flat': DbiNewsDB})
+NewsDB = plugins.DB('News', plugins.dbiTypes(DbiNewsDB))
 
 class News(callbacks.Plugin):
     """This plugin provides a means of maintaining News for a channel."""
@@ -60,6 +60,8 @@ class NoteRecord(dbi.Record):
 class DbiNoteDB(dbi.DB):
     Mapping = 'flat'
     Record = NoteRecord
+    indexes = ['frm', 'to', 'read']
+    textIndexes = ['text']
 
     def __init__(self, *args, **kwargs):
         dbi.DB.__init__(self, *args, **kwargs)
@@ -119,7 +121,7 @@ class DbiNoteDB(dbi.DB):
                 while id in ids:
                     ids.remove(id)
 
-NoteDB = plugins.DB('Note', {'flat': DbiNoteDB})
+NoteDB = plugins.DB('Note', plugins.dbiTypes(DbiNoteDB))
 
 class Note(callbacks.Plugin):
     """Allows you to send notes to other users."""
@@ -289,11 +291,7 @@ class Note(callbacks.Plugin):
         the notes.  If --sent is specified, only search sent notes.
         """
         criteria = []
-        def to(note):
-            return note.to == user.id
-        def frm(note):
-            return note.frm == user.id
-        own = to
+        own = {'to': user.id}
         for (option, arg) in optlist:
             if option == 'regexp':
                 criteria.append(lambda s:
@@ -301,8 +299,10 @@ class Note(callbacks.Plugin):
                                                plugin_name=self.name(),
                                                fcn_name='search'))
             elif option == 'sent':
-                own = frm
+                own = {'frm': user.id}
+        words = ()
         if glob:
+            words = dbi.globWords(glob, anchored=False)
             glob = utils.python.glob2re(glob)
             criteria.append(re.compile(glob).search)
         def match(note):
@@ -310,7 +310,7 @@ class Note(callbacks.Plugin):
                 if not p(note.text):
                     return False
             return True
-        notes = list(self.db.select(lambda n: match(n) and own(n)))
+        notes = list(self.db.select(match, words=words, **own))
         if not notes:
             irc.reply('No matching notes were found.')
         else:
@@ -346,13 +346,10 @@ class Note(callbacks.Plugin):
             return self._oldnotes(irc, msg, sender)
         if sent:
             return self._sentnotes(irc, msg, receiver)
-        def p(note):
-            return not note.read and note.to == user.id
+        criteria = {'to': user.id}
         if sender:
-            originalP = p
-            def p(note):
-                return originalP(note) and note.frm == sender.id
-        notes = list(self.db.select(p))
+            criteria['frm'] = sender.id
+        notes = list(self.db.select(lambda note: not note.read, **criteria))
         if not notes:
             irc.reply('You have no unread notes.')
         else:
@@ -409,13 +406,10 @@ class Note(callbacks.Plugin):
         except KeyError:
             irc.errorNotRegistered()
             return
-        def p(note):
-            return note.frm == user.id
+        criteria = {'frm': user.id}
         if receiver:
-            originalP = p
-            def p(note):
-                return originalP(note) and note.to == receiver.id
-        notes = list(self.db.select(p))
+            criteria['to'] = receiver.id
+        notes = list(self.db.select(**criteria))
         if not notes:
             irc.error('I couldn\'t find any sent notes for your user.')
         else:
@@ -431,13 +425,10 @@ class Note(callbacks.Plugin):
         except KeyError:
             irc.errorNotRegistered()
             return
-        def p(note):
-            return note.to == user.id and note.read
+        criteria = {'to': user.id, 'read': True}
         if sender:
-            originalP = p
-            def p(note):
-                return originalP(note) and note.frm == sender.id
-        notes = list(self.db.select(p))
+            criteria['frm'] = sender.id
+        notes = list(self.db.select(**criteria))
         if not notes:
             irc.reply('I couldn\'t find any matching read notes '
                       'for your user.')
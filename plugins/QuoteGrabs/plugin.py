@@ -287,14 +287,14 @@ class QuoteGrabs(callbacks.Plugin):
             raise callbacks.ArgumentError
         if ircutils.nickEqual(nick, msg.nick):
             irc.error(_('You can\'t quote grab yourself.'), Raise=True)
-        for m in reversed(irc.state.history):
-            if m.command == 'PRIVMSG' and ircutils.nickEqual(m.nick, nick) \
-                    and ircutils.strEqual(m.args[0], chan):
-                # TODO: strip statusmsg prefix for comparison? Must be careful
-                # abouk leaks, though.
-                self._grab(channel, irc, m, msg.prefix)
-                irc.replySuccess()
-                return
+        # TODO: strip statusmsg prefix for comparison? Must be careful
+        # abouk leaks, though.
+        for m in irc.state.last(msg.channel, nick, lambda m:
+                                m.command == 'PRIVMSG' and
+                                ircutils.strEqual(m.args[0], chan), limit=1):
+            self._grab(channel, irc, m, msg.prefix)
+            irc.replySuccess()
+            return
         irc.error(_('I couldn\'t find a proper message to grab.'))
     grab = wrap(grab, ['channeldb', 'nick'])
 
@@ -86,6 +86,9 @@ conf.registerGlobalValue(RSS, 'waitPeriod',
     registry.PositiveInteger(1800, _("""Indicates how many seconds the bot will
     wait between retrieving RSS feeds; requests made within this period will
     return cached results.""")))
+conf.registerGlobalValue(RSS, 'maximumConcurrentFetches',
+    registry.PositiveInteger(4, _("""Determines how many feeds the bot will
+    fetch at the same time when updating announced feeds.""")))
 conf.registerGlobalValue(RSS, 'sortFeedItems',
     FeedItemSortOrder('asInFeed', _("""Determines whether feed items should be
     sorted by their publication/update timestamp or kept in the same order as
@@ -35,6 +35,7 @@ import sys
 import json
 import time
 import types
+import random
 import string
 import socket
 import threading
@@ -43,6 +44,7 @@ import feedparser
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.utils.minisix as minisix
 import supybot.ircmsgs as ircmsgs
@@ -54,8 +56,13 @@ _ = PluginInternationalization('RSS')
 
 if world.testing:
     INIT_DELAY = 1
+    UPDATE_PERIOD = 0.1
 else:
     INIT_DELAY = 10
+    UPDATE_PERIOD = 10
+
+# Maximum number of seconds a failing feed waits before being retried.
+MAX_BACKOFF = 86400
 
 if minisix.PY2:
     from urllib2 import ProxyHandler
@@ -76,18 +83,6 @@ addConverter('feedName', get_feedName)
 announced_headlines_filename = \
         conf.supybot.directories.data.dirize('RSS_announced.flat')
 
-def only_one_at_once(f):
-    lock = [False]
-    def newf(*args, **kwargs):
-        if lock[0]:
-            return
-        lock[0] = True
-        try:
-            f(*args, **kwargs)
-        finally:
-            lock[0] = False
-    return newf
-
 def get_entry_id(entry):
     # in order, try elements to use as unique identifier.
     # http://validator.w3.org/feed/docs/rss2.html#hrelementsOfLtitemgt
@@ -105,7 +100,9 @@ class InvalidFeedUrl(ValueError):
 class Feed:
     __slots__ = ('url', 'name', 'data', 'last_update', 'entries',
             'etag', 'modified', 'initial',
-            'lock', 'announced_entries', 'last_exception')
+            'lock', 'announced_entries', 'last_exception',
+            'fetching', 'failures', 'retry_at',
+            'fetch_count', 'last_duration', 'last_size')
     def __init__(self, name, url, initial,
             plugin_is_loading=False, announced=None):
         assert name, name
@@ -127,6 +124,16 @@ class Feed:
         self.announced_entries = announced or \
                 utils.structures.TruncatableSet()
         self.last_exception = None
+        # Whether the feed is waiting for or being fetched by the worker
+        # pool.
+        self.fetching = False
+        # Number of consecutive failed fetches, and when the feed may be
+        # fetched again after the last one.
+        self.failures = 0
+        self.retry_at = 0
+        self.fetch_count = 0
+        self.last_duration = None
+        self.last_size = None
 
     def __repr__(self):
         return 'Feed(%r, %r, %r, <bool>, %r)' % \
@@ -218,8 +225,17 @@ class RSS(callbacks.Plugin):
                 self.log.error('%s is not a valid feed, removing.', name)
                 continue
         world.flushers.append(self._flush)
+        self._last_check = 0
+        self._pool = callbacks.threadPool(self.name(),
+                conf.supybot.plugins.RSS.maximumConcurrentFetches)
+        schedule.addPeriodicEvent(self.update_feeds, UPDATE_PERIOD,
+                                  name='RSS_update_feeds', now=False)
 
     def die(self):
+        try:
+            schedule.removePeriodicEvent('RSS_update_feeds')
+        except KeyError:
+            pass
         self._flush()
         world.flushers.remove(self._flush)
         self.__parent.die()
@@ -278,7 +294,10 @@ class RSS(callbacks.Plugin):
 
     def __call__(self, irc, msg):
         self.__parent.__call__(irc, msg)
-        threading.Thread(target=self.update_feeds).start()
+        # Don't wait for the next periodic update if it is late (eg. the
+        # clock jumped), but don't check more often than it either.
+        if self._last_check + UPDATE_PERIOD <= time.time():
+            self.update_feeds()
 
 
     ##################
@@ -287,14 +306,17 @@ class RSS(callbacks.Plugin):
     def get_feed(self, name):
         return self.feeds.get(self.feed_names.get(name, name), None)
 
-    def is_expired(self, feed):
-        assert feed
+    def get_wait_period(self, feed):
         period = self.registryValue('waitPeriod')
         if feed.name != feed.url: # Named feed
             specific_period = self.registryValue('feeds.%s.waitPeriod' % feed.name)
             if specific_period:
                 period = specific_period
-        event_horizon = time.time() - period
+        return period
+
+    def is_expired(self, feed):
+        assert feed
+        event_horizon = time.time() - self.get_wait_period(feed)
         return feed.last_update < event_horizon
 
     ###############
@@ -308,8 +330,16 @@ class RSS(callbacks.Plugin):
             handlers.append(ProxyHandler(
                 {'https': utils.force(utils.web.proxy())}))
         with feed.lock:
-            d = feedparser.parse(feed.url, etag=feed.etag,
-                    modified=feed.modified, handlers=handlers)
+            start = time.time()
+            try:
+                d = feedparser.parse(feed.url, etag=feed.etag,
+                        modified=feed.modified, handlers=handlers)
+            except Exception as e:
+                # Keep the entries we already have.
+                self.log.exception('Error while fetching feed %s:', feed.url)
+                feed.last_exception = e
+                self._fetched(feed, start, None, failed=True)
+                return
             if 'status' not in d or d.status != 304: # Not modified
                 if 'etag' in d:
                     feed.etag = d.etag
@@ -317,7 +347,6 @@ class RSS(callbacks.Plugin):
                     feed.modified = d.modified
                 feed.data = d.feed
                 feed.entries = d.entries
-                feed.last_update = time.time()
                 # feedparser will store soft errors in bozo_exception and set
                 # the "bozo" bit to 1 on supported platforms:
                 # https://pythonhosted.org/feedparser/bozo.html
@@ -327,17 +356,75 @@ class RSS(callbacks.Plugin):
                     feed.last_exception = d.bozo_exception
                 else:
                     feed.last_exception = None
+            else:
+                # The server is fine, and what we have is still current.
+                feed.last_exception = None
+            failed = d.get('status', 200) >= 400 or \
+                    (feed.last_exception is not None and not d.entries)
+            self._fetched(feed, start, d.get('headers', {}), failed)
 
             (initial, feed.initial) = (feed.initial, False)
         self.announce_feed(feed, initial)
 
+    def _fetched(self, feed, start, headers, failed):
+        """Updates the statistics of the feed after fetching it, and when it
+        should be fetched again."""
+        feed.fetch_count += 1
+        feed.last_update = time.time()
+        feed.last_duration = feed.last_update - start
+        try:
+            feed.last_size = int(headers['content-length'])
+        except (TypeError, KeyError, ValueError):
+            feed.last_size = None
+        if failed:
+            # Back off exponentially, with some jitter so failing feeds
+            # don't end up being retried all at once.
+            feed.failures += 1
+            period = self.get_wait_period(feed)
+            backoff = min(period * 2 ** (feed.failures - 1),
+                          max(period, MAX_BACKOFF))
+            feed.retry_at = feed.last_update + \
+                    backoff * random.uniform(1, 1.5)
+            self.log.info('Could not fetch feed %s (%i failures in a '
+                          'row), retrying in %i seconds.', feed.url,
+                          feed.failures, feed.retry_at - feed.last_update)
+        else:
+            feed.failures = 0
+            feed.retry_at = 0
+        self.log.debug('Fetched feed %s in %.2f seconds (%s bytes).',
+                       feed.url, feed.last_duration, feed.last_size)
+
     def update_feed_if_needed(self, feed):
         if self.is_expired(feed) and \
                 self._init_time + INIT_DELAY < time.time():
             self.update_feed(feed)
 
-    @only_one_at_once
+    def _fetch_feed(self, feed):
+        try:
+            self.update_feed(feed)
+        except Exception:
+            self.log.exception('Error while updating feed %s:', feed.url)
+        finally:
+            feed.fetching = False
+
+    def schedule_feed(self, feed):
+        """Has the worker pool fetch the feed, unless it is already waiting
+        for it."""
+        if feed.fetching:
+            return
+        feed.fetching = True
+        if not self._pool.submit(self._fetch_feed, feed):
+            # Too many feeds are waiting already; it will be scheduled again
+            # by the next update.
+            feed.fetching = False
+
     def update_feeds(self):
+        """Periodically called by the scheduler; has the worker pool fetch
+        the announced feeds whose wait period is over."""
+        now = time.time()
+        self._last_check = now
+        if self._init_time + INIT_DELAY >= now:
+            return
         announced_feeds = set()
         for irc in world.ircs:
             for channel in irc.state.channels:
@@ -348,7 +435,8 @@ class RSS(callbacks.Plugin):
                 self.log.warning('Feed %s is announced but does not exist.',
                         name)
                 continue
-            self.update_feed_if_needed(feed)
+            if self.is_expired(feed) and feed.retry_at <= now:
+                self.schedule_feed(feed)
 
     def get_new_entries(self, feed):
         with feed.lock:
@@ -627,6 +715,14 @@ class RSS(callbacks.Plugin):
         response = format(_('Title: %s;  URL: %u;  '
                           'Description: %s;  Last updated: %s.'),
                           title, link, desc, when)
+        if feed.fetch_count:
+            if feed.last_size is None:
+                size = _('unknown size')
+            else:
+                size = format('%S', feed.last_size)
+            response += format(_('  Fetched %n, last in %s seconds (%s).'),
+                               (feed.fetch_count, _('time')),
+                               '%.2f' % feed.last_duration, size)
         irc.reply(utils.str.normalizeWhitespace(response))
     info = wrap(info, [first('url', 'feedName')])
 RSS = internationalizeDocstring(RSS)
@@ -29,6 +29,8 @@
 ###
 
 import sys
+import socket
+import threading
 import feedparser
 from supybot.test import *
 import supybot.conf as conf
@@ -60,6 +62,8 @@ def constant(content):
         return minisix.io.BytesIO(content)
     return f
 
+parse = feedparser.parse
+
 url = 'http://www.advogato.org/rss/articles.xml'
 class RSSTestCase(ChannelPluginTestCase):
     plugins = ('RSS','Plugin')
@@ -342,6 +346,145 @@ class RSSTestCase(ChannelPluginTestCase):
         finally:
             feedparser._open_resource = old_open
 
+    def _parsed(self, content, **kwargs):
+        d = parse(content.encode())
+        d.update(kwargs)
+        return d
+
+    def _mockParse(self, f):
+        def restore():
+            feedparser.parse = parse
+        self.addCleanup(restore)
+        feedparser.parse = f
+
+    def testFetchStats(self):
+        self._mockParse(lambda *args, **kwargs: self._parsed(xkcd_old,
+                        headers={'content-length': '1234'}))
+        timeFastForward(1.1)
+        self.assertNotError('rss add xkcd http://xkcd.com/rss.xml')
+        try:
+            self.assertRegexp('rss info xkcd',
+                              r'Fetched 1 time, last in [0-9.]+ seconds '
+                              r'\(1KB\)')
+        finally:
+            self._feedMsg('rss remove xkcd')
+
+    def testNotModified(self):
+        cb = self.irc.getCallback('RSS')
+        self._mockParse(lambda *args, **kwargs: self._parsed(xkcd_old))
+        self.assertNotError('rss add xkcd http://xkcd.com/rss.xml')
+        try:
+            feed = cb.get_feed('xkcd')
+            cb.update_feed(feed)
+            entries = feed.entries
+            feed.last_update = 0
+            self._mockParse(lambda *args, **kwargs:
+                    feedparser.FeedParserDict(status=304, entries=[]))
+            cb.update_feed(feed)
+            self.assertEqual(feed.entries, entries)
+            self.assertFalse(cb.is_expired(feed))
+            self.assertEqual(feed.fetch_count, 2)
+            # A 304 after a failed fetch means the server is back.
+            def parse(*args, **kwargs):
+                raise socket.error('Connection refused')
+            self._mockParse(parse)
+            cb.update_feed(feed)
+            self.assertEqual(feed.failures, 1)
+            self._mockParse(lambda *args, **kwargs:
+                    feedparser.FeedParserDict(status=304, entries=[]))
+            cb.update_feed(feed)
+            self.assertEqual(feed.failures, 0)
+            self.assertEqual(feed.retry_at, 0)
+            self.assertEqual(feed.last_exception, None)
+            self.assertEqual(feed.entries, entries)
+        finally:
+            self._feedMsg('rss remove xkcd')
+
+    def testBackoff(self):
+        cb = self.irc.getCallback('RSS')
+        self._mockParse(lambda *args, **kwargs: self._parsed(xkcd_old))
+        self.assertNotError('rss add xkcd http://xkcd.com/rss.xml')
+        try:
+            feed = cb.get_feed('xkcd')
+            cb.update_feed(feed)
+            data = feed.data
+            def parse(*args, **kwargs):
+                raise socket.error('Connection refused')
+            self._mockParse(parse)
+            with conf.supybot.plugins.RSS.waitPeriod.context(100):
+                for failures in (1, 2, 3):
+                    cb.update_feed(feed)
+                    self.assertEqual(feed.failures, failures)
+                    self.assertIsInstance(feed.last_exception, socket.error)
+                    self.assertEqual(feed.data, data)
+                    backoff = 100 * 2 ** (failures - 1)
+                    delay = feed.retry_at - feed.last_update
+                    self.assertTrue(backoff <= delay <= backoff * 1.5,
+                                    (backoff, delay))
+                # Not fetched again until retry_at, even if expired.
+                timeFastForward(101)
+                scheduled = []
+                cb.schedule_feed = scheduled.append
+                try:
+                    self.assertNotError('rss announce add xkcd')
+                    cb.update_feeds()
+                    self.assertEqual(scheduled, [])
+                    feed.retry_at = time.time() - 1
+                    cb.update_feeds()
+                    self.assertEqual(scheduled, [feed])
+                finally:
+                    del cb.schedule_feed
+                    self._feedMsg('rss announce remove xkcd')
+            self._mockParse(lambda *args, **kwargs: self._parsed(xkcd_new))
+            cb.update_feed(feed)
+            self.assertEqual(feed.failures, 0)
+            self.assertEqual(feed.retry_at, 0)
+            self.assertEqual(feed.last_exception, None)
+        finally:
+            self._feedMsg('rss remove xkcd')
+
+    def testConcurrentFetches(self):
+        cb = self.irc.getCallback('RSS')
+        lock = threading.Lock()
+        event = threading.Event()
+        running = [0, 0] # current, maximum
+        def parse(*args, **kwargs):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            event.wait(5)
+            with lock:
+                running[0] -= 1
+            return self._parsed(xkcd_old)
+        self._mockParse(parse)
+        names = ['feed%i' % i for i in range(8)]
+        for name in names:
+            self.assertNotError('rss add %s http://example.org/%s' %
+                                (name, name))
+        try:
+            feeds = [cb.get_feed(name) for name in names]
+            for feed in feeds:
+                cb.schedule_feed(feed)
+                # Already waiting for the pool; not submitted again.
+                cb.schedule_feed(feed)
+            time.sleep(0.2)
+            self.assertEqual(running[1],
+                    conf.supybot.plugins.RSS.maximumConcurrentFetches())
+            event.set()
+            start = time.time()
+            while any(feed.fetching for feed in feeds) and \
+                    time.time() - start < 5:
+                time.sleep(0.01)
+            self.assertEqual([feed.fetch_count for feed in feeds],
+                             [1] * len(feeds))
+            # Listed by "status threads"
+            self.assertIn(callbacks.threadPool('RSS'),
+                          callbacks.threadPools())
+        finally:
+            event.set()
+            for name in names:
+                self._feedMsg('rss remove %s' % name)
+
     if network:
         timeout = 5  # Note this applies also to the above tests
 
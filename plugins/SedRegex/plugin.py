@@ -60,6 +60,15 @@ axe_spaces = utils.str.MultipleReplacer({'\n': '\\n', '\t': '\\t', '\r': '\\r'})
 class SearchNotFound(Exception):
     pass
 
+def _replace(pattern, replacement, count, texts):
+    """Returns the index of the first of the texts matching the pattern, and
+    the result of the substitution.  This runs in a separate process, as
+    specially-crafted regexps can take exponential time."""
+    for (i, text) in enumerate(texts):
+        if pattern.search(text):
+            return (i, pattern.sub(replacement, text, count))
+    raise SearchNotFound()
+
 class SedRegex(callbacks.PluginRegexp):
     """History replacer using sed-style regex syntax."""
     threaded = True
@@ -113,7 +122,6 @@ class SedRegex(callbacks.PluginRegexp):
     def replacer(self, irc, msg, regex):
         if not self.registryValue('enable', msg.channel, irc.network):
             return
-        iterable = reversed(irc.state.history)
         msg.tag('Replacer')
 
         try:
@@ -124,7 +132,6 @@ class SedRegex(callbacks.PluginRegexp):
                 irc.error('%s.%s: %s' % (e.__class__.__module__, e.__class__.__name__, e))
             return
 
-        next(iterable)
         if 's' in flags:  # Special 's' flag lets the bot only look at self messages
             target = msg.nick
         else:
@@ -132,24 +139,58 @@ class SedRegex(callbacks.PluginRegexp):
         if not ircutils.isNick(str(target), strictRfc=True):
             return
 
-        regex_timeout = self.registryValue('processTimeout')
-        try:
-            message = process(self._replacer_process, irc, msg,
-                    target, pattern, replacement, count, iterable,
-                    timeout=regex_timeout, pn=self.name(), cn='replacer')
-        except ProcessTimeoutError:
-            irc.error(_("Search timed out."))
-        except SearchNotFound:
-            irc.error(_("Search not found in the last %i messages.") %
-                len(irc.state.history))
-        except Exception as e:
-            if self.registryValue('displayErrors', msg.channel, irc.network):
-                irc.error('%s.%s: %s' % (e.__class__.__module__,
-                    e.__class__.__name__, e))
+        # Skip the message we are replying to.
+        if msg.channel:
+            messages = irc.state.last(msg.channel, target or None,
+                                      lambda m: m is not msg)
         else:
-            irc.reply(message, prefixNick=False)
-
-    def _replacer_process(self, irc, msg, target, pattern, replacement, count, messages):
+            messages = [m for m in reversed(irc.state.history)
+                        if m is not msg]
+        candidates = self._replacer_candidates(irc, msg, target, messages)
+        if self.registryValue('boldReplacementText', msg.channel, irc.network):
+            replacement = ircutils.bold(replacement)
+
+        def callback(result):
+            (i, subst) = result
+            (m, action) = candidates[i]
+            if m.nick == msg.nick:
+                messageprefix = msg.nick
+            else:
+                messageprefix = '%s thinks %s' % (msg.nick, m.nick)
+            if action:  # If the message was an ACTION, prepend the nick back.
+                subst = '* %s %s' % (m.nick, subst)
+            subst = axe_spaces(subst)
+            irc.reply(_("%s meant to say: %s") % (messageprefix, subst),
+                      prefixNick=False)
+
+        def errback(e):
+            if isinstance(e, ProcessTimeoutError):
+                irc.error(_("Search timed out."))
+            elif isinstance(e, SearchNotFound):
+                self.log.debug(_("SedRegex: Search %r not found in the last %i messages of %s."),
+                                 msg.args[1], len(messages), msg.args[0])
+                irc.error(_("Search not found in the last %i messages.") %
+                    len(messages))
+            else:
+                self.log.warning(_("SedRegex error: %s"), e)
+                if self.registryValue('displayErrors', msg.channel, irc.network):
+                    irc.error('%s.%s: %s' % (e.__class__.__module__,
+                        e.__class__.__name__, e))
+
+        # When running substitutions, ignore the "* nick" part of any actions.
+        texts = [ircmsgs.unAction(m) if action else m.args[1]
+                 for (m, action) in candidates]
+        regex_timeout = self.registryValue('processTimeout')
+        processAsync(_replace, pattern, replacement, count, texts,
+                     callback=callback, errback=errback,
+                     timeout=regex_timeout, pn=self.name(), cn='replacer')
+
+    def _replacer_candidates(self, irc, msg, target, messages):
+        """Returns the messages a replacement may apply to, most recent first,
+        as (message, isAction) pairs."""
+        candidates = []
+        ignoreRegex = self.registryValue('ignoreRegex', msg.channel,
+                                         irc.network)
         for m in messages:
             if m.command in ('PRIVMSG', 'NOTICE') and \
                     ircutils.strEqual(m.args[0], msg.args[0]) and m.tagged('receivedBy') == irc:
@@ -157,45 +198,12 @@ class SedRegex(callbacks.PluginRegexp):
                     continue
                 # Don't snarf ignored users' messages unless specifically
                 # told to.
-                if ircdb.checkIgnored(m.prefix) and not target:
+                if not target and ircdb.checkIgnored(m.prefix):
                     continue
-
-                # When running substitutions, ignore the "* nick" part of any actions.
-                action = ircmsgs.isAction(m)
-                if action:
-                    text = ircmsgs.unAction(m)
-                else:
-                    text = m.args[1]
-
-                if self.registryValue('ignoreRegex', msg.channel, irc.network) and \
-                        m.tagged('Replacer'):
+                if ignoreRegex and m.tagged('Replacer'):
                     continue
-                if m.nick == msg.nick:
-                    messageprefix = msg.nick
-                else:
-                    messageprefix = '%s thinks %s' % (msg.nick, m.nick)
-
-                try:
-                    replace_result = pattern.search(text)
-                    if replace_result:
-                        if self.registryValue('boldReplacementText',
-                                              msg.channel, irc.network):
-                            replacement = ircutils.bold(replacement)
-                        subst = pattern.sub(replacement, text, count)
-                        if action:  # If the message was an ACTION, prepend the nick back.
-                            subst = '* %s %s' % (m.nick, subst)
-
-                        subst = axe_spaces(subst)
-
-                        return _("%s meant to say: %s") % \
-                            (messageprefix, subst)
-                except Exception as e:
-                    self.log.warning(_("SedRegex error: %s"), e, exc_info=True)
-                    raise
-
-        self.log.debug(_("SedRegex: Search %r not found in the last %i messages of %s."),
-                         msg.args[1], len(irc.state.history), msg.args[0])
-        raise SearchNotFound()
+                candidates.append((m, ircmsgs.isAction(m)))
+        return candidates
     replacer.__doc__ = SED_REGEX.pattern
 
 Class = SedRegex
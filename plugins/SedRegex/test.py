@@ -32,6 +32,8 @@ from __future__ import print_function
 import unittest
 from supybot.test import *
 
+import supybot.commands as commands
+
 class SedRegexTestCase(ChannelPluginTestCase):
     other = "blah!blah@someone.else"
     other2 = "ghost!ghost@spooky"
@@ -51,6 +53,19 @@ class SedRegexTestCase(ChannelPluginTestCase):
         m = self.getMsg(' ')
         self.assertIn('Abcd testefgh', str(m))
 
+    def testSimpleReplaceWithoutWorkers(self):
+        # A new pool, so there is no idle worker left by other tests.
+        (pool, commands.processPool) = \
+            (commands.processPool, commands.ProcessPool())
+        try:
+            with conf.supybot.commands.processes.context(0):
+                self.feedMsg('Abcd abcdefgh')
+                self.feedMsg('s/abcd/test/')
+                m = self.getMsg(' ')
+                self.assertIn('Abcd testefgh', str(m))
+        finally:
+            commands.processPool = pool
+
     def testCaseInsensitiveReplace(self):
         self.feedMsg('Aliens Are Invading, Help!')
         self.feedMsg('s/a/e/i')
@@ -31,6 +31,7 @@
 import re
 import sys
 import time
+import bisect
 
 import supybot.log as log
 import supybot.conf as conf
@@ -56,6 +57,7 @@ class IrcStringAndIntDict(utils.InsensitivePreservingDict):
 
 class SeenDB(plugins.ChannelUserDB):
     IdDict = IrcStringAndIntDict
+    _nickIndexes = None
     def serialize(self, v):
         return list(v)
 
@@ -67,21 +69,54 @@ class SeenDB(plugins.ChannelUserDB):
         seen = time.time()
         self[channel, nickOrId] = (seen, saying)
         self[channel, '<last>'] = (seen, saying)
+        if not isinstance(nickOrId, int) and self._nickIndexes is not None:
+            self._indexNick(channel, nickOrId)
+
+    def _nickIndex(self, channel):
+        """Returns the index of the nicks seen in <channel>: the sorted list of
+        their lowercased versions, a dict mapping those to the nicks, and one
+        mapping trigrams to the lowercased nicks containing them."""
+        if self._nickIndexes is None:
+            # Built on the first wildcard search, then kept up to date by
+            # update().
+            self._nickIndexes = ircutils.IrcDict()
+            for (searchChan, searchNick) in self.keys():
+                # The responses keyed by id duplicate those keyed by nick.
+                if not isinstance(searchNick, int):
+                    self._indexNick(searchChan, searchNick)
+        return self._nickIndexes.get(channel, ([], {}, {}))
+
+    def _indexNick(self, channel, nick):
+        try:
+            (nicks, names, trigrams) = self._nickIndexes[channel]
+        except KeyError:
+            (nicks, names, trigrams) = self._nickIndexes[channel] = \
+                ([], {}, {})
+        lowered = ircutils.toLower(nick)
+        if lowered not in names:
+            bisect.insort(nicks, lowered)
+            for i in range(len(lowered) - 2):
+                trigrams.setdefault(lowered[i:i+3], set()).add(lowered)
+        names[lowered] = nick
 
     def seenWildcard(self, channel, nick):
-        nicks = ircutils.IrcSet()
-        nickRe = re.compile('^%s$' % '.*'.join(nick.split('*')), re.I)
-        for (searchChan, searchNick) in self.keys():
-            #print 'chan: %s ... nick: %s' % (searchChan, searchNick)
-            if isinstance(searchNick, int):
-                # We need to skip the reponses that are keyed by id as they
-                # apparently duplicate the responses for the same person that
-                # are keyed by nick-string
-                continue
-            if ircutils.strEqual(searchChan, channel):
-                if nickRe.search(searchNick) is not None:
-                    nicks.add(searchNick)
-        L = [[nick, self.seen(channel, nick)] for nick in nicks]
+        (nicks, names, trigrams) = self._nickIndex(channel)
+        parts = ircutils.toLower(nick).split('*')
+        nickRe = re.compile('.*'.join(map(re.escape, parts)), re.S)
+        candidates = None
+        if parts[0]:
+            start = bisect.bisect_left(nicks, parts[0])
+            end = bisect.bisect_left(nicks, parts[0] + '\U0010ffff', start)
+            candidates = nicks[start:end]
+        for part in parts:
+            for i in range(len(part) - 2):
+                found = trigrams.get(part[i:i+3], ())
+                if candidates is None or len(found) < len(candidates):
+                    candidates = found
+        if candidates is None:
+            candidates = nicks
+        L = [[names[lowered], self.seen(channel, names[lowered])]
+             for lowered in candidates if nickRe.fullmatch(lowered)]
         def negativeTime(x):
             return -x[1][0]
         utils.sortBy(negativeTime, L)
@@ -100,8 +135,8 @@ class Seen(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(Seen, self)
         self.__parent.__init__(irc)
-        self.db = SeenDB(filename)
-        self.anydb = SeenDB(anyfilename)
+        self.db = plugins.openChannelUserDB(SeenDB, filename)
+        self.anydb = plugins.openChannelUserDB(SeenDB, anyfilename)
         self.lastmsg = {}
         world.flushers.append(self.db.flush)
         world.flushers.append(self.anydb.flush)
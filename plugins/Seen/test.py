@@ -100,6 +100,27 @@ class ChannelDBTestCase(ChannelPluginTestCase):
         finally:
             conf.supybot.protocols.irc.strictRfc.setValue(orig)
 
+    def testSeenWildcardIndex(self):
+        self.irc.feedMsg(ircmsgs.join(self.channel, self.irc.nick,
+                                         prefix=self.prefix))
+        self.assertNotError('config plugins.Seen.minimumNonWildcard 2')
+        for nick in ('Alice', 'alfred', '[al]', 'bob'):
+            self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'hi',
+                                             prefix='%s!u@h' % nick))
+            timeFastForward(1)
+        self.assertRegexp('seen al*',
+                          r'^al\* could be alfred \(.*\) or Alice \(')
+        self.assertRegexp('seen *fre*', '^alfred was last seen')
+        self.assertRegexp('seen "[al*"', r'^\[al\] was last seen')
+        self.assertRegexp('seen *{al}', r'^\[al\] was last seen')
+        # Nicks seen after the index was built are in it too.
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'hi',
+                                         prefix='ALBERT!u@h'))
+        self.assertRegexp('seen al*', '^al\* could be ALBERT ')
+        self.assertRegexp('seen *ber*', '^ALBERT was last seen')
+        self.assertRegexp('seen *ob', '^bob was last seen')
+        self.assertRegexp('seen *lz*', 'haven\'t seen anyone')
+
     def testSeenNoUser(self):
         self.irc.feedMsg(ircmsgs.join(self.channel, self.irc.nick,
                                          prefix=self.prefix))
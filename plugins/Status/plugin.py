@@ -39,6 +39,7 @@ import supybot.conf as conf
 import supybot.utils as utils
 import supybot.world as world
 from supybot.commands import *
+from supybot.commands import processPool
 import supybot.callbacks as callbacks
 from supybot.i18n import PluginInternationalization, internationalizeDocstring
 _ = PluginInternationalization('Status')
@@ -90,21 +91,32 @@ class Status(callbacks.Plugin):
     def threads(self, irc, msg, args):
         """takes no arguments
 
-        Returns the current threads that are active.
+        Returns the current threads that are active, and how busy the
+        threads of each plugin are.
         """
         threads = [t.getName() for t in threading.enumerate()]
         threads.sort()
         s = format(_('I have spawned %n; %n %b still currently active: %L.'),
                    (world.threadsSpawned, 'thread'),
                    (len(threads), 'thread'), len(threads), threads)
+        L = []
+        for pool in callbacks.threadPools():
+            L.append(format(_('%s: %i of %n busy (at most %i), %i queued, '
+                              '%i completed, %i rejected'),
+                            pool.name, pool.running,
+                            (pool.threads, 'thread'), pool.maxRunning,
+                            len(pool.queue), pool.completed, pool.rejected))
+        if L:
+            s += format(_('  Plugins\' threads: %L.'), L)
         irc.reply(s)
     threads = wrap(threads)
 
     def processes(self, irc, msg, args):
         """takes no arguments
 
-        Returns the number of processes that have been spawned, and list of
-        ones that are still active.
+        Returns the number of processes that have been spawned, list of
+        ones that are still active, and statistics about the worker processes
+        running sandboxed commands.
         """
         ps = [multiprocessing.current_process().name]
         ps = ps + [p.name for p in multiprocessing.active_children()]
@@ -112,6 +124,14 @@ class Status(callbacks.Plugin):
                    (world.processesSpawned, 'process'),
                    (len(ps), 'process'),
                    len(ps), ps)
+        stats = processPool.stats()
+        s += format(_('  %i of my %n %b busy, %n waiting for one.  '
+                      'I have run %n (%n), which took %.2f seconds on '
+                      'average and %.2f seconds at most.'),
+                    stats['busy'], (stats['workers'], 'worker process'),
+                    stats['busy'], (stats['waiting'], 'task'),
+                    (stats['tasks'], 'task'), (stats['timeouts'], 'timeout'),
+                    stats['averageTime'], stats['maxTime'])
         irc.reply(s)
     processes = wrap(processes)
 
@@ -208,6 +228,22 @@ class Status(callbacks.Plugin):
         irc.reply(s)
     cmd = wrap(cmd)
 
+    @internationalizeDocstring
+    def caches(self, irc, msg, args):
+        """takes no arguments
+
+        Returns the size, hits, misses, and evictions of the bot's caches.
+        Their sizes can be changed in supybot.caches.
+        """
+        L = []
+        for cache in utils.structures.CacheDict.named():
+            L.append(format(_('%s: %i of %i items, %n, %n, %n'),
+                            cache.name, len(cache), cache.max,
+                            (cache.hits, 'hit'), (cache.misses, 'miss'),
+                            (cache.evictions, 'eviction')))
+        irc.reply(format('%L', L))
+    caches = wrap(caches)
+
     @internationalizeDocstring
     def commands(self, irc, msg, args):
         """takes no arguments
@@ -32,6 +32,7 @@ from supybot.test import *
 import sys
 
 import supybot.world as world
+import supybot.callbacks as callbacks
 
 class StatusTestCase(PluginTestCase):
     plugins = ('Status',)
@@ -61,6 +62,11 @@ class StatusTestCase(PluginTestCase):
     def testCmd(self):
         self.assertNotError('cmd')
 
+    def testCaches(self):
+        self.assertRegexp('caches', r'hostmaskPatterns: \d+ of 1000 items')
+        with conf.supybot.caches.hostmaskPatterns.context(10):
+            self.assertRegexp('caches', r'hostmaskPatterns: \d+ of 10 items')
+
     def testCommands(self):
         self.assertNotError('commands')
 
@@ -71,9 +77,12 @@ class StatusTestCase(PluginTestCase):
 
     def testThreads(self):
         self.assertNotError('threads')
+        callbacks.threadPool('StatusTest').submit(lambda: None)
+        self.assertRegexp('threads', r'StatusTest: \d+ of \d+ threads? busy')
 
     def testProcesses(self):
         self.assertNotError('processes')
+        self.assertRegexp('processes', r'of my \d+ worker process')
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
 
@@ -65,7 +65,8 @@ class FlatTodoDb(object):
     def _getDb(self, uid):
         dbfile = os.path.join(self.directory, str(uid))
         if uid not in self.dbs:
-            self.dbs[uid] = dbi.DB(dbfile, Record=TodoRecord)
+            self.dbs[uid] = dbi.DB(dbfile, Record=TodoRecord,
+                                   indexes=['active'], textIndexes=['task'])
         return self.dbs[uid]
 
     def close(self):
@@ -78,7 +79,7 @@ class FlatTodoDb(object):
 
     def getTodos(self, uid):
         db = self._getDb(uid)
-        L = [R for R in db.select(lambda r: r.active)]
+        L = [R for R in db.select(active=True)]
         if not L:
             raise dbi.NoRecordError
         return L
@@ -94,14 +95,14 @@ class FlatTodoDb(object):
         t.active = False
         db.set(tid, t)
 
-    def select(self, uid, criteria):
+    def select(self, uid, criteria, words=()):
         db = self._getDb(uid)
         def match(todo):
             for p in criteria:
                 if not p(todo.task):
                     return False
             return True
-        todos = db.select(lambda t: match(t))
+        todos = db.select(match, words=words)
         if not todos:
             raise dbi.NoRecordError
         return todos
@@ -238,6 +239,7 @@ class Todo(callbacks.Plugin):
         if not optlist and not globs:
             raise callbacks.ArgumentError
         criteria = []
+        words = set()
         for (option, arg) in optlist:
             if option == 'regexp':
                 criteria.append(lambda s:
@@ -245,10 +247,11 @@ class Todo(callbacks.Plugin):
                                                plugin_name=self.name(),
                                                fcn_name='search'))
         for glob in globs:
+            words.update(dbi.globWords(glob, anchored=False))
             glob = utils.python.glob2re(glob)
             criteria.append(re.compile(glob).search)
         try:
-            tasks = self.db.select(user.id, criteria)
+            tasks = self.db.select(user.id, criteria, words=words)
             L = [format('#%i: %s', t.id, self._shrink(t.task)) for t in tasks]
             irc.reply(format('%L', L))
         except dbi.NoRecordError:
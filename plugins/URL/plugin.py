@@ -60,7 +60,7 @@ class DbiUrlDB(plugins.DbiChannelDB):
             L.reverse()
             return L
 
-URLDB = plugins.DB('URL', {'flat': DbiUrlDB})
+URLDB = plugins.DB('URL', plugins.dbiTypes(DbiUrlDB))
 
 class URL(callbacks.Plugin):
     """This plugin records how many URLs have been mentioned in
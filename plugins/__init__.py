@@ -32,10 +32,13 @@ import gc
 import os
 import csv
 import time
+import json
 import codecs
 import fnmatch
+import functools
 import os.path
 import threading
+import collections
 import collections.abc
 
 from .. import callbacks, conf, dbi, ircdb, ircutils, log, utils, world
@@ -74,6 +77,12 @@ def DB(filename, types):
         raise NoSuitableDatabase(types.keys())
     return MakeDB
 
+def dbiTypes(cls):
+    """Returns the types that can be given to DB() for <cls>, a dbi.DB or
+    DbiChannelDB subclass, one per dbi mapping it can be stored with."""
+    return {'flat': cls,
+            'indexed': functools.partial(cls, Mapping='indexed')}
+
 def makeChannelFilename(filename, channel=None, dirname=None):
     assert channel is not None, 'Channel should not be None'
     filename = os.path.basename(filename)
@@ -146,8 +155,9 @@ class ChannelDBHandler(object):
 class DbiChannelDB(object):
     """This just handles some of the general stuff for Channel DBI databases.
     Check out ChannelIdDatabasePlugin for an example of how to use this."""
-    def __init__(self, filename):
+    def __init__(self, filename, Mapping=None):
         self.filename = filename
+        self.Mapping = Mapping
         self.dbs = ircutils.IrcDict()
 
     def _getDb(self, channel):
@@ -155,7 +165,10 @@ class DbiChannelDB(object):
         try:
             db = self.dbs[channel]
         except KeyError:
-            db = self.DB(filename)
+            if self.Mapping is None:
+                db = self.DB(filename)
+            else:
+                db = self.DB(filename, Mapping=self.Mapping)
             self.dbs[channel] = db
         return db
 
@@ -206,6 +219,10 @@ class ChannelUserDictionary(collections.abc.MutableMapping):
             for (id, v) in ids.items():
                 yield ((channel, id), v)
 
+    def channelItems(self, channel):
+        """Returns the list of the (id, value) pairs of <channel>."""
+        return list(self.channels.get(channel, {}).items())
+
     def keys(self):
         L = []
         for (k, _) in self.items():
@@ -218,20 +235,48 @@ class ChannelUserDictionary(collections.abc.MutableMapping):
 #     would very much feel like an extension, rather than part of the db
 #     itself.
 class ChannelUserDB(ChannelUserDictionary):
+    """A ChannelUserDictionary stored in a CSV file.  If
+    supybot.databases.plugins.journal is True, flushing only appends the
+    entries set or deleted since the last flush to <filename>.journal, and
+    the file is rewritten when the journal becomes as big as it."""
+    compactionRatio = 1.0
+    compactionMinimumSize = 64 * 1024
     def __init__(self, filename):
         ChannelUserDictionary.__init__(self)
         self.filename = filename
+        self.journalName = filename + '.journal'
+        self.dirty = set()
+        self._fileSize = 0
+        self._journalSize = 0
+        self._open()
+
+    def _open(self):
+        """Loads the database from its file and journal."""
         try:
             fd = codecs.open(self.filename, encoding='utf8')
         except EnvironmentError as e:
             log.warning('Couldn\'t open %s: %s.', self.filename, e)
-            return
+        else:
+            self._fileSize = os.path.getsize(self.filename)
+            self._load(fd, journal=False)
+            fd.close()
+        if os.path.exists(self.journalName):
+            self._journalSize = os.path.getsize(self.journalName)
+            with codecs.open(self.journalName, encoding='utf8') as fd:
+                self._load(fd, journal=True)
+        self.dirty.clear()
+
+    def _load(self, fd, journal):
+        """Reads the entries of the database (or, if <journal>, of the journal,
+        whose lines start with + for entries that were set and - for those
+        that were deleted)."""
         reader = csv.reader(fd)
         try:
             lineno = 0
             for t in reader:
                 lineno += 1
                 try:
+                    op = t.pop(0) if journal else '+'
                     channel = t.pop(0)
                     id = t.pop(0)
                     try:
@@ -239,8 +284,11 @@ class ChannelUserDB(ChannelUserDictionary):
                     except ValueError:
                         # We'll skip over this so, say, nicks can be kept here.
                         pass
-                    v = self.deserialize(channel, id, t)
-                    self[channel, id] = v
+                    if op == '-':
+                        self.pop((channel, id), None)
+                    else:
+                        v = self.deserialize(channel, id, t)
+                        self[channel, id] = v
                 except Exception as e:
                     log.warning('Invalid line #%s in %s.',
                                 lineno, self.__class__.__name__)
@@ -250,7 +298,44 @@ class ChannelUserDB(ChannelUserDictionary):
                         lineno, self.__class__.__name__)
             log.debug('Exception: %s', utils.exnToString(e))
 
+    def __setitem__(self, key, v):
+        ChannelUserDictionary.__setitem__(self, key, v)
+        self.dirty.add(key)
+
+    def __delitem__(self, key):
+        ChannelUserDictionary.__delitem__(self, key)
+        self.dirty.add(key)
+
+    def _appendJournal(self):
+        with codecs.open(self.journalName, 'a', encoding='utf8') as fd:
+            writer = csv.writer(fd)
+            for (channel, id) in self.dirty:
+                try:
+                    L = self.serialize(self[channel, id])
+                except KeyError:
+                    L = ['-', channel, id]
+                else:
+                    L = list(L)
+                    L[0:0] = ['+', channel, id]
+                writer.writerow(L)
+            self._journalSize = fd.tell()
+        self.dirty.clear()
+
     def flush(self):
+        if conf.supybot.databases.plugins.journal():
+            if not self.dirty:
+                return
+            elif self._journalSize < max(self.compactionMinimumSize,
+                                         self._fileSize * self.compactionRatio):
+                self._appendJournal()
+                return
+        if self.dirty and self._journalSize:
+            # If we crash after replacing the file but before removing the
+            # journal, the journal is replayed over the new file; so it has
+            # to be up to date too.  This also keeps the journal from
+            # bringing back what was deleted if we refuse to write a blank
+            # file.
+            self._appendJournal()
         mode = 'wb' if utils.minisix.PY2 else 'w'
         fd = utils.file.AtomicFile(self.filename, mode, makeBackupIfSmaller=False)
         writer = csv.writer(fd)
@@ -272,6 +357,11 @@ class ChannelUserDB(ChannelUserDictionary):
             L.insert(0, channel)
             writer.writerow(L)
         fd.close()
+        self._fileSize = os.path.getsize(self.filename)
+        if self._journalSize:
+            os.remove(self.journalName)
+            self._journalSize = 0
+        self.dirty.clear()
 
     def close(self):
         self.flush()
@@ -288,6 +378,183 @@ class ChannelUserDB(ChannelUserDictionary):
         raise NotImplementedError
 
 
+class SqliteChannelUserDB(ChannelUserDB):
+    """A ChannelUserDB stored in an SQLite database, whose entries are only
+    loaded when they are used.  The most recently used ones are kept in an
+    LRU cache, and those that changed are written back when they leave it or
+    when the database is flushed.
+
+    Channels and ids are normalized (according to the IRC casemapping for
+    channels, and to IdDict for ids) to look entries up, but kept as they
+    were given.  When the SQLite database is created, the entries of the CSV
+    database it replaces are imported in it."""
+    cacheSize = 1000
+    def __init__(self, filename):
+        # The database may be used by threaded plugins and flushers.
+        self._lock = threading.RLock()
+        super(SqliteChannelUserDB, self).__init__(filename)
+
+    def _open(self):
+        import sqlite3
+        filename = self.csvFilename = self.filename
+        self.filename = self.sqliteFilename(filename)
+        self._cache = collections.OrderedDict()
+        idDict = self.IdDict()
+        self._idKey = getattr(idDict, 'key', lambda id: id)
+        exists = os.path.exists(self.filename)
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+                           channel_key TEXT,
+                           id_key,
+                           channel TEXT,
+                           id,
+                           value TEXT,
+                           PRIMARY KEY (channel_key, id_key)
+                           )""")
+        self.db.commit()
+        if not exists and os.path.exists(filename):
+            self.importCsv(filename)
+
+    @staticmethod
+    def sqliteFilename(filename):
+        (root, ext) = os.path.splitext(filename)
+        return '%s.sqlite3%s' % (root, ext)
+
+    def importCsv(self, filename):
+        """Imports the entries of the CSV database <filename> (and of its
+        journal)."""
+        deserialize = self.deserialize
+        class CsvChannelUserDB(ChannelUserDB):
+            IdDict = self.IdDict
+            def deserialize(self, channel, id, L):
+                return deserialize(channel, id, L)
+        for (key, v) in CsvChannelUserDB(filename).items():
+            self[key] = v
+            if len(self._cache) >= self.cacheSize:
+                self.flush()
+        self.flush()
+        log.info('Imported %s into %s.', filename, self.filename)
+
+    def _key(self, key):
+        (channel, id) = key
+        return (ircutils.toLower(channel), self._idKey(id))
+
+    def _encode(self, v):
+        return json.dumps(['' if x is None else str(x)
+                           for x in self.serialize(v)])
+
+    def _write(self, entries):
+        self.db.executemany("""INSERT OR REPLACE INTO entries
+                               VALUES (?, ?, ?, ?, ?)""",
+            [(normalized[0], normalized[1], channel, id, self._encode(v))
+             for (normalized, (channel, id, v)) in entries])
+
+    def _cacheEntry(self, normalized, entry):
+        self._cache[normalized] = entry
+        self._cache.move_to_end(normalized)
+        if len(self._cache) > self.cacheSize:
+            (oldest, (channel, id, v, dirty)) = self._cache.popitem(last=False)
+            if dirty:
+                self._write([(oldest, (channel, id, v))])
+
+    def __getitem__(self, key):
+        normalized = self._key(key)
+        with self._lock:
+            return self._getitem(key, normalized)
+
+    def _getitem(self, key, normalized):
+        try:
+            entry = self._cache[normalized]
+        except KeyError:
+            row = self.db.execute("""SELECT channel, id, value FROM entries
+                                     WHERE channel_key=? AND id_key=?""",
+                                  normalized).fetchone()
+            if row is None:
+                raise KeyError(key)
+            (channel, id, value) = row
+            entry = (channel, id,
+                     self.deserialize(channel, id, json.loads(value)), False)
+        self._cacheEntry(normalized, entry)
+        return entry[2]
+
+    def __setitem__(self, key, v):
+        (channel, id) = key
+        with self._lock:
+            self._cacheEntry(self._key(key), (channel, id, v, True))
+
+    def __delitem__(self, key):
+        normalized = self._key(key)
+        with self._lock:
+            cached = self._cache.pop(normalized, None)
+            cursor = self.db.execute("""DELETE FROM entries
+                                        WHERE channel_key=? AND id_key=?""",
+                                     normalized)
+            rowcount = cursor.rowcount
+        if rowcount == 0 and (cached is None or not cached[3]):
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except KeyError:
+            return False
+
+    def _select(self, query, *args):
+        with self._lock:
+            self.flush()
+            return self.db.execute(query, args).fetchall()
+
+    def __iter__(self):
+        for (channel, id) in self._select('SELECT channel, id FROM entries'):
+            yield (channel, id)
+
+    def __len__(self):
+        return self._select('SELECT COUNT(*) FROM entries')[0][0]
+
+    def items(self):
+        for (channel, id, value) in self._select(
+                'SELECT channel, id, value FROM entries'):
+            yield ((channel, id),
+                   self.deserialize(channel, id, json.loads(value)))
+
+    def channelItems(self, channel):
+        return [(id, self.deserialize(channel, id, json.loads(value)))
+                for (channel, id, value) in self._select(
+                    """SELECT channel, id, value FROM entries
+                       WHERE channel_key=?""", ircutils.toLower(channel))]
+
+    def keys(self):
+        return list(self)
+
+    def flush(self):
+        with self._lock:
+            dirty = [(normalized, (channel, id, v))
+                     for (normalized, (channel, id, v, isDirty))
+                     in self._cache.items() if isDirty]
+            if dirty:
+                self._write(dirty)
+                for (normalized, (channel, id, v)) in dirty:
+                    self._cache[normalized] = (channel, id, v, False)
+            self.db.commit()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._cache.clear()
+            self.db.close()
+
+def openChannelUserDB(cls, filename):
+    """Returns a <cls> (a ChannelUserDB subclass) stored in <filename>, or
+    in an SQLite database next to it, depending on
+    supybot.databases.plugins.channelUserDatabase."""
+    if conf.supybot.databases.plugins.channelUserDatabase() == 'sqlite3':
+        cls = type(cls.__name__, (SqliteChannelUserDB, cls), {})
+    return cls(filename)
+
+
 def getUserName(id):
     if isinstance(id, int):
         try:
@@ -306,6 +573,8 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
                     'by',
                     'text'
                     ]
+            indexes = ['by']
+            textIndexes = ['text']
             def add(self, at, by, text, **kwargs):
                 record = self.Record(at=at, by=by, text=text, **kwargs)
                 return super(self.__class__, self).add(record)
@@ -313,7 +582,7 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
     def __init__(self, irc):
         self.__parent = super(ChannelIdDatabasePlugin, self)
         self.__parent.__init__(irc)
-        self.db = DB(self.name(), {'flat': self.DB})()
+        self.db = DB(self.name(), dbiTypes(self.DB))()
 
     def die(self):
         self.db.close()
@@ -403,9 +672,10 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
                     return False
             return True
 
+        criteria = {}
         for (opt, arg) in optlist:
             if opt == 'by':
-                predicates.append(lambda r, arg=arg: r.by == arg.id)
+                criteria['by'] = arg.id
             elif opt == 'regexp':
                 if not ircdb.checkCapability(msg.prefix, 'trusted'):
                     # Limited --regexp to trusted users, because specially
@@ -419,8 +689,9 @@ class ChannelIdDatabasePlugin(callbacks.Plugin):
             def globP(r, glob=glob.lower()):
                 return fnmatch.fnmatch(r.text.lower(), glob)
             predicates.append(globP)
+            criteria['words'] = dbi.globWords(glob)
         L = []
-        for record in self.db.select(channel, p):
+        for record in self.db.select(channel, p, **criteria):
             L.append(self.searchSerializeRecord(record))
         if L:
             L.sort()
@@ -39,7 +39,9 @@ import time
 from . import shlex
 import codecs
 import getopt
+import asyncio
 import inspect
+import threading
 import warnings
 
 from . import (conf, ircdb, irclib, ircmsgs, ircutils, log, registry,
@@ -580,6 +582,10 @@ class RichReplyMethods(object):
         v = self._getConfig(conf.supybot.replies.requiresPrivacy)
         return self._error(self.__makeReply(v, s), **kwargs)
 
+    def errorBusy(self, s='', **kwargs):
+        v = self._getConfig(conf.supybot.replies.busy)
+        return self._error(self.__makeReply(v, s), **kwargs)
+
     def errorInvalid(self, what, given=None, s='', repr=True, **kwargs):
         if given is not None:
             if repr:
@@ -857,9 +863,8 @@ class NestedCommandsIrcProxy(ReplyIrcProxy):
             args = self.args[len(command):]
             if world.isMainThread() and \
                (cb.threaded or conf.supybot.debug.threadAllCommands()):
-                t = CommandThread(target=cb._callCommand,
-                                  args=(command, self, self.msg, args))
-                t.start()
+                runInThread(cb, self, cb._callCommand,
+                            command, self, self.msg, args)
             else:
                 cb._callCommand(command, self, self.msg, args)
 
@@ -1092,6 +1097,81 @@ class CommandThread(world.SupyThread):
         finally:
             self.cb.threaded = self.originalThreaded
 
+_threadPools = {}
+def threadPool(name, maxThreads=None):
+    """Returns the pool of threads used by the plugin with the given name.
+    When the pool is created, it runs at most <maxThreads> threads (an int or
+    a callable), or supybot.commands.threads if it is not given."""
+    try:
+        return _threadPools[name]
+    except KeyError:
+        pool = world.ThreadPool(name,
+                                maxThreads or conf.supybot.commands.threads,
+                                conf.supybot.commands.threads.queue)
+        return _threadPools.setdefault(name, pool)
+
+def threadPools():
+    """Returns the plugins' thread pools, sorted by name."""
+    return [_threadPools[name] for name in sorted(_threadPools)]
+
+def runInThread(cb, irc, f, *args, **kwargs):
+    """Runs f(*args, **kwargs) in the thread pool of the plugin <cb>, or
+    replies with supybot.replies.busy if too many of its commands are already
+    running."""
+    def run():
+        originalThreaded = cb.threaded
+        cb.threaded = True
+        try:
+            f(*args, **kwargs)
+        finally:
+            cb.threaded = originalThreaded
+    if not threadPool(cb.name()).submit(run):
+        log.warning('Not running a command of %s: too many of its commands '
+                    'are already running.', cb.name())
+        irc.errorBusy()
+
+def _getRunningLoop():
+    try:
+        return asyncio.get_running_loop()
+    except AttributeError: # Python < 3.7
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError: # Not the main thread
+            return None
+        return loop if loop.is_running() else None
+    except RuntimeError:
+        return None
+
+_backgroundLoop = None
+_backgroundLoopLock = threading.Lock()
+def _getBackgroundLoop():
+    """Returns the event loop running in a background thread, starting it if
+    needed."""
+    global _backgroundLoop
+    with _backgroundLoopLock:
+        if _backgroundLoop is None:
+            loop = asyncio.new_event_loop()
+            t = world.SupyThread(target=loop.run_forever,
+                                 name='Thread #%s (for async commands)' %
+                                 world.threadsSpawned)
+            t.daemon = True
+            t.start()
+            _backgroundLoop = loop
+        return _backgroundLoop
+
+def runCoroutine(coro):
+    """Runs the coroutine returned by an ``async def`` command and returns a
+    future of its result (with the ``result``, ``cancelled`` and
+    ``add_done_callback`` methods).
+
+    If an event loop is running (ie. the Asyncio driver is in use), the
+    coroutine is run as a task of that loop; otherwise it is run by an event
+    loop shared by all commands, in a background thread."""
+    loop = _getRunningLoop()
+    if loop is not None:
+        return asyncio.ensure_future(coro, loop=loop)
+    return asyncio.run_coroutine_threadsafe(coro, _getBackgroundLoop())
+
 class CommandProcess(world.SupyProcess):
     """Just does some extra logging and error-recovery for commands that need
     to run in processes.
@@ -1304,7 +1384,7 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
                     for cb in self.pre_command_callbacks)):
             return
         method = self.getCommandMethod(command)
-        method(irc, msg, *args, **kwargs)
+        return method(irc, msg, *args, **kwargs)
 
     def _callCommand(self, command, irc, msg, *args, **kwargs):
         if irc.nick == msg.args[0]:
@@ -1313,7 +1393,7 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
         else:
             self.log.info('%s called on %s by %q.', formatCommand(command),
                     msg.args[0], msg.prefix)
-        try:
+        def f():
             if len(command) == 1 or command[0] != self.canonicalName():
                 fullCommandName = [self.canonicalName()] + command
             else:
@@ -1338,9 +1418,27 @@ class Commands(BasePlugin, SynchronizedAndFirewalled):
 
             try:
                 self.callingCommand = command
-                self.callCommand(command, irc, msg, *args, **kwargs)
+                ret = self.callCommand(command, irc, msg, *args, **kwargs)
             finally:
                 self.callingCommand = None
+            if inspect.iscoroutine(ret):
+                # An "async def" command; errors it raises once it actually
+                # runs are handled the same way as errors of other commands.
+                def done(future):
+                    if future.cancelled():
+                        # CancelledError isn't an Exception.
+                        log.info('%s was cancelled.', command)
+                    else:
+                        self._handleCommandErrors(command, irc, msg,
+                                                  future.result)
+                runCoroutine(ret).add_done_callback(done)
+        self._handleCommandErrors(command, irc, msg, f)
+
+    def _handleCommandErrors(self, command, irc, msg, f):
+        """Calls f, replying to the command's caller with the appropriate
+        error if it raises."""
+        try:
+            f()
         except SilentError:
             pass
         except (getopt.GetoptError, ArgumentError) as e:
@@ -36,8 +36,11 @@ from __future__ import division
 
 import os
 import sys
+import mmap
 import struct
 import os.path
+import functools
+import threading
 
 from . import utils
 from .utils import minisix
@@ -46,12 +49,14 @@ def hash(s):
     """DJB's hash function for CDB."""
     h = 5381
     for c in s:
-        h = ((h + (h << 5)) ^ ord(c)) & minisix.L(0xFFFFFFFF)
+        h = ((h + (h << 5)) ^ ord(c)) & 0xFFFFFFFF
     return h
 
+_twoInts = struct.Struct('<LL')
+
 def unpack2Ints(s):
     """Returns two ints unpacked from the binary string s."""
-    return struct.unpack('<LL', s)
+    return _twoInts.unpack(s)
 
 def pack2Ints(i, j):
     """Returns a packed binary string from the two ints."""
@@ -91,6 +96,10 @@ def shelf(filename, *args, **kwargs):
         maker.finish()
         return Shelf(filename, *args, **kwargs)
 
+# Values are written as they are: encoded like in the CDB, and with newlines
+# left alone so their length is right.
+_journalArgs = {'encoding': 'utf8', 'newline': ''}
+
 def _readKeyValue(fd):
     klen = 0
     dlen = 0
@@ -145,9 +154,11 @@ class Maker(object):
         h = hash(key)
         hashPointer = h % 256
         startPosition = self.fd.tell()
+        key = key.encode()
+        data = data.encode()
         self.fd.write(pack2Ints(len(key), len(data)))
-        self.fd.write(key.encode())
-        self.fd.write(data.encode())
+        self.fd.write(key)
+        self.fd.write(data)
         self.hashes[hashPointer].append((h, startPosition))
 
     def finish(self):
@@ -181,121 +192,169 @@ class Maker(object):
 
 
 class Reader(utils.IterableMap):
-    """Class for reading from a CDB database."""
-    def __init__(self, filename):
+    """Class for reading from a CDB database.
+
+    Unless useMmap is False (or the file can't be mapped), the file is
+    memory-mapped, so probing the hash tables and comparing keys don't need
+    any system call or copy."""
+    def __init__(self, filename, useMmap=True):
         self.filename = filename
         self.fd = open(filename, 'rb')
-        self.loop = 0
-        self.khash = 0
-        self.kpos = 0
-        self.hpos = 0
-        self.hslots = 0
-        self.dpos = 0
-        self.dlen = 0
+        self._mmap = None
+        self._view = None
+        if useMmap:
+            try:
+                self._mmap = mmap.mmap(self.fd.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                pass
+        if self._mmap is not None:
+            self._view = memoryview(self._mmap)
+            self._ints = functools.partial(_twoInts.unpack_from, self._mmap)
+            self._read = self._readView
+        # The records are between the hash table pointers and the first
+        # hash table, which is followed by all the others; there are twice as
+        # many slots as records.
+        (self._end, _) = self._ints(0)
+        self.fd.seek(0, 2)
+        self._length = (self.fd.tell() - self._end) // 16
 
     def close(self):
+        if self._mmap is not None:
+            self._view.release()
+            self._mmap.close()
         self.fd.close()
 
     def _read(self, len, pos):
         self.fd.seek(pos)
         return self.fd.read(len)
 
-    def _match(self, key, pos):
-        return self._read(len(key), pos) == key
+    def _readView(self, len, pos):
+        return self._view[pos:pos+len]
+
+    def _ints(self, pos):
+        return unpack2Ints(self._read(8, pos))
 
     def items(self):
-        # uses loop/hslots in a strange, non-re-entrant manner.
-        (self.loop,) = struct.unpack('<i', self._read(4, 0))
-        self.hslots = 2048
-        while self.hslots < self.loop:
-            (klen, dlen) = unpack2Ints(self._read(8, self.hslots))
-            dpos = self.hslots + 8 + klen
-            ret = (self._read(klen, self.hslots+8).decode(),
-                    self._read(dlen, dpos).decode())
-            self.hslots = dpos + dlen
-            yield ret
-        self.loop = 0
-        self.hslots = 0
-
-    def _findnext(self, key):
-        if not self.loop:
-            self.khash = hash(key)
-            (self.hpos, self.hslots) = unpack2Ints(self._read(8,
-                                                    (self.khash * 8) & 2047))
-            if not self.hslots:
-                return False
-            self.kpos = self.hpos + (((self.khash // 256) % self.hslots) * 8)
-        while self.loop < self.hslots:
-            (h, p) = unpack2Ints(self._read(8, self.kpos))
+        pos = 2048
+        while pos < self._end:
+            (klen, dlen) = self._ints(pos)
+            dpos = pos + 8 + klen
+            yield (str(self._read(klen, pos+8), 'utf8'),
+                   str(self._read(dlen, dpos), 'utf8'))
+            pos = dpos + dlen
+
+    def _findall(self, key):
+        """Yields the position and length of the data of each record of
+        <key>."""
+        h = hash(key)
+        key = key.encode()
+        (hpos, hslots) = self._ints((h & 255) << 3)
+        if not hslots:
+            return
+        end = hpos + hslots * 8
+        kpos = hpos + ((h >> 8) % hslots) * 8
+        for _ in range(hslots):
+            (slotHash, p) = self._ints(kpos)
             if p == 0:
-                return False
-            self.loop += 1
-            self.kpos += 8
-            if self.kpos == self.hpos + (self.hslots * 8):
-                self.kpos = self.hpos
-            if h == self.khash:
-                (u, self.dlen) = unpack2Ints(self._read(8, p))
-                if u == len(key):
-                    if self._match(key, p+8):
-                        self.dpos = p + 8 + u
-                        return True
-        return False
-
-    def _find(self, key, loop=0):
-        self.loop = loop
-        return self._findnext(key)
-
-    def _getCurrentData(self):
-        return self._read(self.dlen, self.dpos).decode()
-
-    def find(self, key, loop=0):
-        if self._find(key, loop=loop):
-            return self._getCurrentData()
-        else:
-            try:
-                return self.default
-            except AttributeError:
-                raise KeyError(key)
+                return
+            kpos += 8
+            if kpos == end:
+                kpos = hpos
+            if slotHash == h:
+                (klen, dlen) = self._ints(p)
+                if klen == len(key) and self._read(klen, p+8) == key:
+                    yield (p + 8 + klen, dlen)
+
+    def _getData(self, key):
+        for (dpos, dlen) in self._findall(key):
+            return str(self._read(dlen, dpos), 'utf8')
+        raise KeyError(key)
+
+    def find(self, key):
+        return self._getData(key)
 
     def findall(self, key):
-        ret = []
-        while self._findnext(key):
-            ret.append(self._getCurrentData())
-        return ret
+        return [str(self._read(dlen, dpos), 'utf8')
+                for (dpos, dlen) in self._findall(key)]
 
     def get(self, key, default=None):
         try:
-            return self[key]
+            return self._getData(key)
         except KeyError:
             return default
 
+    def get_many(self, keys, default=None):
+        """Returns the list of the values of <keys>, with <default> for those
+        that are not in the database."""
+        # Same as _findall, with everything bound to locals once for all the
+        # keys.
+        ints = self._ints
+        read = self._read
+        ret = []
+        for key in keys:
+            value = default
+            h = hash(key)
+            key = key.encode()
+            (hpos, hslots) = ints((h & 255) << 3)
+            if hslots:
+                end = hpos + hslots * 8
+                kpos = hpos + ((h >> 8) % hslots) * 8
+                for _ in range(hslots):
+                    (slotHash, p) = ints(kpos)
+                    if p == 0:
+                        break
+                    kpos += 8
+                    if kpos == end:
+                        kpos = hpos
+                    if slotHash == h:
+                        (klen, dlen) = ints(p)
+                        if klen == len(key) and read(klen, p+8) == key:
+                            value = str(read(dlen, p + 8 + klen), 'utf8')
+                            break
+            ret.append(value)
+        return ret
+
+    def __contains__(self, key):
+        for _ in self._findall(key):
+            return True
+        return False
+
     def __len__(self):
-        (start,) = struct.unpack('<i', self._read(4, 0))
-        self.fd.seek(0, 2)
-        return ((self.fd.tell() - start) // 16)
+        return self._length
 
-    has_key = _find
-    __contains__ = has_key
+    has_key = __contains__
     __getitem__ = find
 
 
 class ReaderWriter(utils.IterableMap):
-    """Uses a journal to pretend that a CDB is writable database."""
+    """Uses a journal to pretend that a CDB is writable database.
+
+    Modifications are kept in memory (and in the journal) on top of the CDB.
+    When flushed, they are frozen -- along with their journal -- and merged
+    into a new CDB by a background thread, which then replaces the old one;
+    modifications made meanwhile go to a new journal and layer, so they never
+    wait for the CDB to be rebuilt."""
     def __init__(self, filename, journalName=None, maxmods=0):
         if journalName is None:
             journalName = filename + '.journal'
         self.journalName = journalName
+        self.mergingJournalName = journalName + '.merging'
         self.maxmods = maxmods
         self.mods = 0
         self.filename = filename
+        self._lock = threading.RLock()
+        self._merger = None
         self._readJournal()
         self._openFiles()
         self.adds = {}
         self.removals = set()
+        # The (adds, removals) being merged into the CDB, if any.
+        self._merging = None
 
     def _openFiles(self):
         self.cdb = Reader(self.filename)
-        self.journal = open(self.journalName, 'w')
+        self.journal = open(self.journalName, 'w', **_journalArgs)
 
     def _closeFiles(self):
         self.cdb.close()
@@ -312,10 +371,15 @@ class ReaderWriter(utils.IterableMap):
         self.journal.flush()
 
     def _readJournal(self):
+        # A merging journal is only left over if we stopped while merging it;
+        # it is older than the current journal.
         removals = set()
         adds = {}
-        try:
-            fd = open(self.journalName, 'r')
+        for journalName in (self.mergingJournalName, self.journalName):
+            try:
+                fd = open(journalName, 'r', **_journalArgs)
+            except IOError:
+                continue
             while True:
                 (initchar, key, value) = _readKeyValue(fd)
                 if initchar is None:
@@ -329,106 +393,160 @@ class ReaderWriter(utils.IterableMap):
                         del adds[key]
                     removals.add(key)
             fd.close()
-        except IOError:
-            pass
         if removals or adds:
-            maker = Maker(self.filename)
-            cdb = Reader(self.filename)
-            for (key, value) in cdb.items():
-                if key in removals:
-                    continue
-                elif key in adds:
-                    value = adds[key]
-                    if value is not None:
-                        maker.add(key, value)
-                        adds[key] = None
-                else:
-                    maker.add(key, value)
-            for (key, value) in adds.items():
-                if value is not None:
-                    maker.add(key, value)
-            cdb.close()
-            maker.finish()
-        if os.path.exists(self.journalName):
-            os.remove(self.journalName)
+            self._make(self.filename, adds, removals)
+        for journalName in (self.mergingJournalName, self.journalName):
+            if os.path.exists(journalName):
+                os.remove(journalName)
+
+    @staticmethod
+    def _make(filename, adds, removals):
+        """Replaces the CDB <filename> with one where the keys in <removals>
+        are removed, and those in <adds> set."""
+        maker = Maker(filename)
+        cdb = Reader(filename)
+        for (key, value) in cdb.items():
+            if key not in removals and key not in adds:
+                maker.add(key, value)
+        for (key, value) in adds.items():
+            maker.add(key, value)
+        cdb.close()
+        maker.finish()
+
+    def _merge(self):
+        (adds, removals) = self._merging
+        try:
+            self._make(self.filename, adds, removals)
+        except:
+            with self._lock:
+                # Keep the modifications; those made since take precedence.
+                for (key, value) in adds.items():
+                    if key not in self.adds and key not in self.removals:
+                        self.adds[key] = value
+                        self._journalAddKey(key, value)
+                for key in removals:
+                    if key not in self.adds and key not in self.removals:
+                        self.removals.add(key)
+                        self._journalRemoveKey(key)
+                self._merging = None
+                self._merger = None
+                os.remove(self.mergingJournalName)
+            raise
+        with self._lock:
+            self.cdb.close()
+            self.cdb = Reader(self.filename)
+            self._merging = None
+            self._merger = None
+            os.remove(self.mergingJournalName)
+
+    def _layers(self):
+        if self._merging is None:
+            return ((self.adds, self.removals),)
+        else:
+            return ((self.adds, self.removals), self._merging)
 
     def close(self):
         self.flush()
+        self.join()
+        if self.adds or self.removals:
+            # Modified while the previous merge was running.
+            self.flush()
+            self.join()
         self._closeFiles()
 
     def flush(self):
-        self._closeFiles()
-        self._readJournal()
-        self._openFiles()
+        """Starts merging the modifications into the CDB, unless a merge is
+        already running."""
+        with self._lock:
+            if self._merger is not None or not (self.adds or self.removals):
+                return
+            self.journal.close()
+            os.rename(self.journalName, self.mergingJournalName)
+            self.journal = open(self.journalName, 'w', **_journalArgs)
+            self._merging = (self.adds, self.removals)
+            self.adds = {}
+            self.removals = set()
+            self.mods = 0
+            self._merger = threading.Thread(target=self._merge,
+                    name='Merging %s' % os.path.basename(self.filename))
+            self._merger.daemon = True
+            self._merger.start()
+
+    def join(self):
+        """Waits for the running merge, if any, to finish."""
+        merger = self._merger
+        if merger is not None:
+            merger.join()
 
     def _flushIfOverLimit(self):
         if self.maxmods:
             if isinstance(self.maxmods, int):
                 if self.mods > self.maxmods:
                     self.flush()
-                    self.mods = 0
             elif isinstance(self.maxmods, float):
                 assert 0 <= self.maxmods
                 if self.mods / max(len(self.cdb), 100) > self.maxmods:
                     self.flush()
-                    self.mods = 0
 
     def __getitem__(self, key):
-        if key in self.removals:
-            raise KeyError(key)
-        else:
-            try:
-                return self.adds[key]
-            except KeyError:
-                return self.cdb[key] # If this raises KeyError, we lack key.
+        with self._lock:
+            for (adds, removals) in self._layers():
+                if key in removals:
+                    raise KeyError(key)
+                elif key in adds:
+                    return adds[key]
+            return self.cdb[key] # If this raises KeyError, we lack key.
 
     def __delitem__(self, key):
-        if key in self.removals:
-            raise KeyError(key)
-        else:
-            if key in self.adds and key in self.cdb:
-                self._journalRemoveKey(key)
-                del self.adds[key]
-                self.removals.add(key)
-            elif key in self.adds:
-                self._journalRemoveKey(key)
-                del self.adds[key]
-            elif key in self.cdb:
-                self._journalRemoveKey(key)
-            else:
+        with self._lock:
+            if key not in self:
                 raise KeyError(key)
-        self.mods += 1
+            self._journalRemoveKey(key)
+            self.adds.pop(key, None)
+            self.removals.add(key)
+            self.mods += 1
         self._flushIfOverLimit()
 
     def __setitem__(self, key, value):
-        if key in self.removals:
-            self.removals.remove(key)
-        self._journalAddKey(key, value)
-        self.adds[key] = value
-        self.mods += 1
+        with self._lock:
+            self.removals.discard(key)
+            self._journalAddKey(key, value)
+            self.adds[key] = value
+            self.mods += 1
         self._flushIfOverLimit()
 
     def __contains__(self, key):
-        if key in self.removals:
-            return False
-        else:
-            return key in self.adds or key in self.cdb
+        with self._lock:
+            for (adds, removals) in self._layers():
+                if key in removals:
+                    return False
+                elif key in adds:
+                    return True
+            return key in self.cdb
 
     has_key = __contains__
 
     def items(self):
-        already = set()
-        for (key, value) in self.cdb.items():
-            if key in self.removals or key in already:
-                continue
-            elif key in self.adds:
-                already.add(key)
-                yield (key, self.adds[key])
-            else:
-                yield (key, value)
-        for (key, value) in self.adds.items():
-            if key not in already:
-                yield (key, value)
+        # Don't hold the lock while yielding, the consumer may be slow or
+        # never finish.  The layers are copied, and the CDB is reopened, as
+        # a merge may replace (and close) it meanwhile.
+        with self._lock:
+            layers = [(list(adds.items()), set(removals))
+                      for (adds, removals) in self._layers()]
+            cdb = Reader(self.filename)
+        try:
+            seen = set()
+            for (adds, removals) in layers:
+                for (key, value) in adds:
+                    if key not in seen:
+                        seen.add(key)
+                        yield (key, value)
+                seen.update(removals)
+            for (key, value) in cdb.items():
+                if key not in seen:
+                    yield (key, value)
+        finally:
+            cdb.close()
 
     def setdefault(self, key, value):
         try:
@@ -443,18 +561,57 @@ class ReaderWriter(utils.IterableMap):
         except KeyError:
             return default
 
+    def get_many(self, keys, default=None):
+        """Returns the list of the values of <keys>, with <default> for those
+        that are not in the database."""
+        keys = list(keys)
+        with self._lock:
+            layers = self._layers()
+            ret = []
+            fromCdb = []
+            for key in keys:
+                for (adds, removals) in layers:
+                    if key in removals:
+                        ret.append(default)
+                        break
+                    elif key in adds:
+                        ret.append(adds[key])
+                        break
+                else:
+                    ret.append(None)
+                    fromCdb.append((len(ret) - 1, key))
+            values = self.cdb.get_many([key for (_, key) in fromCdb], default)
+            for ((i, _), value) in zip(fromCdb, values):
+                ret[i] = value
+            return ret
+
 
 class Shelf(ReaderWriter):
     """Uses pickle to mimic the shelf module."""
+    # The database stores text, so each byte of the pickles is stored as the
+    # code point of the same value.
+    @staticmethod
+    def _dumps(value):
+        return minisix.pickle.dumps(value, True).decode('latin1')
+
+    @staticmethod
+    def _loads(s):
+        return minisix.pickle.loads(s.encode('latin1'))
+
     def __getitem__(self, key):
-        return minisix.pickle.loads(ReaderWriter.__getitem__(self, key))
+        return self._loads(ReaderWriter.__getitem__(self, key))
 
     def __setitem__(self, key, value):
-        ReaderWriter.__setitem__(self, key, minisix.pickle.dumps(value, True))
+        ReaderWriter.__setitem__(self, key, self._dumps(value))
+
+    def get_many(self, keys, default=None):
+        values = ReaderWriter.get_many(self, keys, default)
+        return [value if value is default else self._loads(value)
+                for value in values]
 
     def items(self):
         for (key, value) in ReaderWriter.items(self):
-            yield (key, minisix.pickle.loads(value))
+            yield (key, self._loads(value))
 
 
 if __name__ == '__main__':
@@ -32,18 +32,22 @@
 Includes wrappers for commands.
 """
 
+import os
 import time
+import pickle
 import getopt
 import inspect
 import threading
+import collections
 import multiprocessing #python2.6 or later!
+import multiprocessing.connection
 
 try:
     import resource
 except ImportError: # Windows!
     resource = None
 
-from . import callbacks, conf, ircdb, ircmsgs, ircutils, log, \
+from . import callbacks, conf, ircdb, ircmsgs, ircutils, log, schedule, \
         utils, world
 from .utils import minisix
 from .i18n import PluginInternationalization, internationalizeDocstring
@@ -60,10 +64,9 @@ def thread(f):
     """Makes sure a command spawns a thread when called."""
     def newf(self, irc, msg, args, *L, **kwargs):
         if world.isMainThread():
-            targetArgs = (self.callingCommand, irc, msg, args) + tuple(L)
-            t = callbacks.CommandThread(target=self._callCommand,
-                                        args=targetArgs, kwargs=kwargs)
-            t.start()
+            callbacks.runInThread(self, irc, self._callCommand,
+                                  self.callingCommand, irc, msg, args, *L,
+                                  **kwargs)
         else:
             f(self, irc, msg, args, *L, **kwargs)
     return utils.python.changeFunctionName(newf, f.__name__, f.__doc__)
@@ -78,7 +81,337 @@ def _rlimit_min(a, b):
     elif b == resource.RLIM_INFINITY:
         return a
     else:
-        return min(soft, heap_size)
+        return min(a, b)
+
+###
+# Process pool.  Forking a process for every call to process() is slow, so
+# tasks are pickled and sent to a few long-lived worker processes instead.
+# Tasks which can't be pickled (closures, functions taking an Irc object,
+# ...) still get a process of their own, forked with the task already in its
+# memory.
+###
+_TASK_RETURNED = 0
+_TASK_RAISED = 1
+_TASK_UNLOADABLE = 2
+_ORPHAN_CHECK_INTERVAL = 1
+
+def _runTask(f, args, kwargs, heap_size):
+    """Runs a task with the heap size limited to <heap_size>, and returns
+    a (status, value) pair."""
+    limits = None
+    if resource and heap_size is not None:
+        rsrc = resource.RLIMIT_DATA
+        limits = resource.getrlimit(rsrc)
+        resource.setrlimit(rsrc, (_rlimit_min(limits[0], heap_size),
+                                  limits[1]))
+    try:
+        return (_TASK_RETURNED, f(*args, **kwargs))
+    except Exception as e:
+        return (_TASK_RAISED, e)
+    finally:
+        if limits is not None:
+            resource.setrlimit(resource.RLIMIT_DATA, limits)
+
+def _sendResult(conn, result):
+    try:
+        conn.send(result)
+    except Exception as e:
+        conn.send((_TASK_RAISED,
+                   Exception('Could not send the result: %s' % e)))
+
+def _poolWorker(conn, parentConn):
+    """Main loop of pooled worker processes."""
+    # The bot's ends of the pipes were inherited when forking; close them so
+    # that each worker gets EOF once the bot closes its end.
+    parentConn.close()
+    for worker in processPool._workers:
+        worker.conn.close()
+    # EOF never comes if the bot is killed before it can close the pipes
+    # (other processes forked by the bot may hold them too), so also exit
+    # when this worker is orphaned.
+    ppid = os.getppid()
+    while True:
+        try:
+            while not conn.poll(_ORPHAN_CHECK_INTERVAL):
+                if os.getppid() != ppid:
+                    return
+            data = conn.recv_bytes()
+        except EOFError:
+            return
+        try:
+            task = pickle.loads(data)
+        except Exception:
+            # Most likely, the function is from a plugin that was loaded (or
+            # reloaded) after this worker was forked.
+            conn.send((_TASK_UNLOADABLE, None))
+            continue
+        _sendResult(conn, _runTask(*task))
+
+def _forkedWorker(conn, f, args, kwargs, heap_size):
+    _sendResult(conn, _runTask(f, args, kwargs, heap_size))
+
+class _Worker(object):
+    __slots__ = ('process', 'conn', 'tasks', 'pooled')
+    def __init__(self, target, args, pn, cn, pooled):
+        (self.conn, childConn) = multiprocessing.Pipe()
+        if pooled:
+            args = (self.conn,) + args
+        self.process = callbacks.CommandProcess(target=target,
+                args=(childConn,) + args, kwargs={'pn': pn, 'cn': cn})
+        self.process.daemon = pooled
+        self.process.start()
+        childConn.close()
+        self.tasks = 0
+        self.pooled = pooled
+
+    def stop(self):
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+    def result(self, ready):
+        """Returns the (status, value) of the task this worker ran, given the
+        objects multiprocessing.connection.wait returned."""
+        if self.conn in ready:
+            try:
+                return self.conn.recv()
+            except EOFError:
+                pass
+            except Exception as e:
+                return (_TASK_RAISED, e)
+        # The process died without sending a result (eg. it was killed).
+        return (_TASK_RETURNED, None)
+
+class _Task(object):
+    __slots__ = ('f', 'args', 'kwargs', 'heap_size', 'timeout', 'pn', 'cn',
+                 'data', 'callback', 'errback', 'submitted', 'deadline',
+                 'worker')
+    def __init__(self, f, args, kwargs, heap_size, timeout, pn, cn):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.heap_size = heap_size
+        self.timeout = timeout
+        self.pn = pn
+        self.cn = cn
+        try:
+            self.data = pickle.dumps((f, args, kwargs, heap_size),
+                                     pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            self.data = None
+        self.callback = None
+        self.errback = None
+        self.submitted = time.time()
+        self.deadline = None
+        self.worker = None
+
+class ProcessPool(object):
+    """Runs the tasks given to :func:`process` and :func:`processAsync` in
+    supybot.commands.processes long-lived worker processes.  Workers are
+    replaced after supybot.commands.processes.maxTasks tasks, or when a task
+    times out."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._workers = []
+        self._idle = []
+        self._waiting = collections.deque()
+        self._running = []
+        self._collector = None
+        self._wakeReader = self._wakeWriter = None
+        self._woken = False
+        self.tasks = 0
+        self.timeouts = 0
+        self.totalTime = 0.
+        self.maxTime = 0.
+
+    def _fill(self):
+        while len(self._workers) < conf.supybot.commands.processes():
+            worker = _Worker(_poolWorker, (), 'ProcessPool', 'worker', True)
+            self._workers.append(worker)
+            self._idle.append(worker)
+
+    def _acquire(self):
+        with self._lock:
+            self._fill()
+            if self._idle:
+                return self._idle.pop()
+            return None
+
+    def _release(self, worker, recycle=False):
+        if worker.pooled:
+            worker.tasks += 1
+            maxTasks = conf.supybot.commands.processes.maxTasks()
+            with self._lock:
+                if recycle or worker.tasks >= maxTasks or \
+                   len(self._workers) > conf.supybot.commands.processes():
+                    self._workers.remove(worker)
+                else:
+                    self._idle.append(worker)
+                    worker = None
+            self._wake()
+        if worker is not None:
+            worker.stop()
+
+    def _start(self, task, fork=True):
+        """Sends the task to an idle worker, or forks a process for it if it
+        can't be pickled or if all workers are busy and <fork> is True.
+        Returns the worker running the task, or None."""
+        worker = None
+        if task.data is not None:
+            worker = self._acquire()
+            if worker is not None:
+                try:
+                    worker.conn.send_bytes(task.data)
+                except OSError:
+                    self._release(worker, recycle=True)
+                    worker = None
+                    task.data = None
+            elif not fork:
+                return None
+        if worker is None:
+            worker = _Worker(_forkedWorker,
+                             (task.f, task.args, task.kwargs, task.heap_size),
+                             task.pn, task.cn, False)
+        if task.timeout is not None:
+            task.deadline = time.time() + task.timeout
+        task.worker = worker
+        return worker
+
+    def _finish(self, task, result):
+        """Releases the worker of a task, and returns the (status, value) of
+        the task, or None if it has to be run again in a forked process."""
+        worker = task.worker
+        task.worker = None
+        if result is None:
+            self.timeouts += 1
+            self._release(worker, recycle=True)
+            e = ProcessTimeoutError('%s.%s aborted due to timeout.' %
+                                    (task.pn, task.cn))
+            result = (_TASK_RAISED, e)
+        elif result[0] == _TASK_UNLOADABLE:
+            self._release(worker, recycle=True)
+            task.data = None
+            return None
+        else:
+            self._release(worker, recycle=not worker.process.is_alive())
+        elapsed = time.time() - task.submitted
+        self.tasks += 1
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        return result
+
+    def run(self, task):
+        """Runs a task, waits for it to complete and returns its (status,
+        value)."""
+        result = None
+        while result is None:
+            worker = self._start(task)
+            ready = multiprocessing.connection.wait(
+                [worker.conn, worker.process.sentinel], task.timeout)
+            result = self._finish(task, worker.result(ready) if ready else None)
+        return result
+
+    def submit(self, task):
+        """Queues a task, whose callback or errback will be called from the
+        main loop when it completes."""
+        with self._lock:
+            if self._collector is None:
+                (self._wakeReader, self._wakeWriter) = \
+                    multiprocessing.Pipe(duplex=False)
+                self._collector = world.SupyThread(target=self._collect,
+                                                   name='ProcessPool collector')
+                self._collector.daemon = True
+                self._collector.start()
+        self._waiting.append(task)
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            if self._wakeWriter is None or self._woken:
+                return
+            self._woken = True
+        self._wakeWriter.send_bytes(b'')
+
+    def _collect(self):
+        while True:
+            try:
+                self._collectOnce()
+            except Exception:
+                log.exception('Uncaught exception in the process pool:')
+
+    def _collectOnce(self):
+        # Without pooled workers, none will ever become idle, so tasks
+        # have to be run in forked processes.
+        fork = conf.supybot.commands.processes() == 0
+        while self._waiting:
+            if self._start(self._waiting[0], fork=fork) is None:
+                break
+            self._running.append(self._waiting.popleft())
+        objects = [self._wakeReader]
+        timeout = None
+        now = time.time()
+        for task in self._running:
+            objects.extend([task.worker.conn, task.worker.process.sentinel])
+            if task.deadline is not None:
+                remaining = max(task.deadline - now, 0)
+                timeout = remaining if timeout is None \
+                          else min(timeout, remaining)
+        ready = multiprocessing.connection.wait(objects, timeout)
+        if self._wakeReader in ready:
+            with self._lock:
+                self._woken = False
+                self._wakeReader.recv_bytes()
+        now = time.time()
+        for task in self._running[:]:
+            worker = task.worker
+            if worker.conn in ready or worker.process.sentinel in ready:
+                result = worker.result(ready)
+            elif task.deadline is not None and now >= task.deadline:
+                result = None
+            else:
+                continue
+            self._running.remove(task)
+            result = self._finish(task, result)
+            if result is None:
+                self._waiting.appendleft(task)
+            else:
+                schedule.addEvent(self._deliver, 0, args=[task, result])
+
+    def _deliver(self, task, result):
+        (status, value) = result
+        if status == _TASK_RAISED:
+            if task.errback is not None:
+                task.errback(value)
+            else:
+                log.error('Uncaught exception in %s.%s: %s', task.pn,
+                          task.cn, utils.exnToString(value))
+        elif task.callback is not None:
+            task.callback(value)
+
+    def stats(self):
+        """Returns the number of workers, how many of them are busy, how many
+        tasks are waiting for one, and the average and maximum time tasks
+        took to complete (including the time they waited)."""
+        with self._lock:
+            workers = len(self._workers)
+            busy = workers - len(self._idle)
+        average = self.totalTime / self.tasks if self.tasks else 0.
+        return {'workers': workers, 'busy': busy,
+                'waiting': len(self._waiting), 'tasks': self.tasks,
+                'timeouts': self.timeouts, 'averageTime': average,
+                'maxTime': self.maxTime}
+
+processPool = ProcessPool()
+
+def _processArgs(kwargs):
+    timeout = kwargs.pop('timeout', None)
+    heap_size = kwargs.pop('heap_size', None)
+    if resource and heap_size is None:
+        heap_size = resource.RLIM_INFINITY
+    pn = kwargs.pop('pn', 'Unknown')
+    cn = kwargs.pop('cn', 'unknown')
+    return (timeout, heap_size, pn, cn)
 
 def process(f, *args, **kwargs):
     """Runs a function <f> in a subprocess.
@@ -90,95 +423,63 @@ def process(f, *args, **kwargs):
     function to <timeout> seconds.
     <heap_size>, if supplied, limits the memory used by the target
     function."""
-    timeout = kwargs.pop('timeout', None)
-    heap_size = kwargs.pop('heap_size', None)
-    if resource and heap_size is None:
-        heap_size = resource.RLIM_INFINITY
+    (timeout, heap_size, pn, cn) = _processArgs(kwargs)
+
+    if world.disableMultiprocessing:
+        return f(*args, **kwargs)
+
+    task = _Task(f, args, kwargs, heap_size, timeout, pn, cn)
+    (status, value) = processPool.run(task)
+    if status == _TASK_RAISED:
+        raise value
+    else:
+        return value
+
+def processAsync(f, *args, **kwargs):
+    """Like :func:`process`, but returns immediately.
+
+    When <f> completes, <callback> is called with its return value, or
+    <errback> with the exception it raised (ProcessTimeoutError if it timed
+    out).  Both are called from the main loop."""
+    callback = kwargs.pop('callback', None)
+    errback = kwargs.pop('errback', None)
+    (timeout, heap_size, pn, cn) = _processArgs(kwargs)
 
     if world.disableMultiprocessing:
-        pn = kwargs.pop('pn', 'Unknown')
-        cn = kwargs.pop('cn', 'unknown')
-        try:
-            return f(*args, **kwargs)
-        except Exception as e:
-            raise e
-    
-    try:
-        q = multiprocessing.Queue()
-    except OSError:
-        log.error('Using multiprocessing.Queue raised an OSError.\n'
-                'This is probably caused by your system denying semaphore\n'
-                'usage. You should run these two commands:\n'
-                '\tsudo rmdir /dev/shm\n'
-                '\tsudo ln -Tsf /{run,dev}/shm\n'
-                '(See https://github.com/travis-ci/travis-core/issues/187\n'
-                'for more information about this bug.)\n')
-        raise
-    def newf(f, q, *args, **kwargs):
-        if resource:
-            rsrc = resource.RLIMIT_DATA
-            (soft, hard) = resource.getrlimit(rsrc)
-            soft = _rlimit_min(soft, heap_size)
-            hard = _rlimit_min(hard, heap_size)
-            resource.setrlimit(rsrc, (soft, hard))
         try:
-            r = f(*args, **kwargs)
-            q.put([False, r])
+            v = f(*args, **kwargs)
         except Exception as e:
-            q.put([True, e])
-    targetArgs = (f, q,) + args
-    p = callbacks.CommandProcess(target=newf,
-                                args=targetArgs, kwargs=kwargs)
-    p.start()
-    p.join(timeout)
-    if p.is_alive():
-        p.terminate()
-        q.close()
-        raise ProcessTimeoutError("%s aborted due to timeout." % (p.name,))
-    try:
-        raised, v = q.get(block=False)
-    except minisix.queue.Empty:
-        return None
-    finally:
-        q.close()
+            if errback is not None:
+                errback(e)
+        else:
+            if callback is not None:
+                callback(v)
+        return
+
+    task = _Task(f, args, kwargs, heap_size, timeout, pn, cn)
+    task.callback = callback
+    task.errback = errback
+    processPool.submit(task)
 
-    if raised:
-        raise v
+def _re_bool(s, reobj):
+    """Since we can't enqueue match objects into the multiprocessing queue,
+    we'll just wrap the function to return bools."""
+    if reobj.search(s) is not None:
+        return True
     else:
-        return v
+        return False
 
 def regexp_wrapper(s, reobj, timeout, plugin_name, fcn_name):
     '''A convenient wrapper to stuff regexp search queries through a subprocess.
 
     This is used because specially-crafted regexps can use exponential time
     and hang the bot.'''
-    def re_bool(s, reobj):
-        """Since we can't enqueue match objects into the multiprocessing queue,
-        we'll just wrap the function to return bools."""
-        if reobj.search(s) is not None:
-            return True
-        else:
-            return False
     try:
-        v = process(re_bool, s, reobj, timeout=timeout, pn=plugin_name, cn=fcn_name)
+        v = process(_re_bool, s, reobj, timeout=timeout, pn=plugin_name, cn=fcn_name)
         return v
     except ProcessTimeoutError:
         return None
 
-class UrlSnarfThread(world.SupyThread):
-    def __init__(self, *args, **kwargs):
-        assert 'url' in kwargs
-        kwargs['name'] = 'Thread #%s (for snarfing %s)' % \
-                         (world.threadsSpawned, kwargs.pop('url'))
-        super(UrlSnarfThread, self).__init__(*args, **kwargs)
-        self.setDaemon(True)
-
-    def run(self):
-        try:
-            super(UrlSnarfThread, self).run()
-        except utils.web.Error as e:
-            log.debug('Exception in urlSnarfer: %s', utils.exnToString(e))
-
 class SnarfQueue(ircutils.FloodQueue):
     timeout = conf.supybot.snarfThrottle
     def key(self, channel):
@@ -232,12 +533,17 @@ def urlSnarfer(f):
                 f(self, irc, msg, match, *L, **kwargs)
             finally:
                 _snarfLock.release()
+        def snarfInThread():
+            try:
+                doSnarf()
+            except utils.web.Error as e:
+                log.debug('Exception in urlSnarfer: %s',
+                          utils.exnToString(e))
         if threading.currentThread() is not world.mainThread:
             doSnarf()
-        else:
-            L = list(L)
-            t = UrlSnarfThread(target=doSnarf, url=url)
-            t.start()
+        elif not callbacks.threadPool(self.name()).submit(snarfInThread):
+            self.log.info('Not snarfing %s in %s: too many snarfers are '
+                          'already running.', url, channel)
     newf = utils.python.changeFunctionName(newf, f.__name__, f.__doc__)
     return newf
 
@@ -1103,7 +1409,7 @@ def _wrap(f, specList=[], name=None, checkDoc=True, **kw):
             self.log.debug('Refusing to call %s due to state.errored.', f)
         else:
             try:
-                f(self, irc, msg, args, *state.args, **state.kwargs)
+                return f(self, irc, msg, args, *state.args, **state.kwargs)
             except TypeError:
                 self.log.error('Spec: %s', specList)
                 self.log.error('Received args: %s', args)
@@ -1149,7 +1455,7 @@ __all__ = [
     # Decorators.
     'urlSnarfer', 'thread',
     # Functions.
-    'wrap', 'process', 'regexp_wrapper',
+    'wrap', 'process', 'processAsync', 'regexp_wrapper',
     # Stuff for testing.
     'Spec',
 ]
@@ -727,6 +727,11 @@ registerChannelValue(supybot.replies, 'possibleBug',
     <https://github.com/ProgVal/Limnoria/issues>."""),
     _("""Determines what message the bot sends when it thinks you've
     encountered a bug that the developers don't know about.""")))
+registerChannelValue(supybot.replies, 'busy',
+    registry.NormalizedString(_("""I'm too busy to do that right now, try again
+    in a few moments."""), _("""Determines what error message the bot sends when
+    too many commands of a plugin are already running.""")))
+
 ###
 # End supybot.replies.
 ###
@@ -823,6 +828,24 @@ registerGlobalValue(supybot.commands, 'allowShell',
     Setting this to False also disables plugins and commands that can be
     used to indirectly gain shell access.""")))
 
+registerGlobalValue(supybot.commands, 'processes',
+    registry.NonNegativeInteger(2, _("""Determines how many worker processes
+    the bot keeps around to run commands that need to be sandboxed in a
+    process of their own (eg. regexp searches).  If this is 0, a new process is
+    forked for each of them.""")))
+registerGlobalValue(supybot.commands.processes, 'maxTasks',
+    registry.PositiveInteger(100, _("""Determines how many commands a worker
+    process runs before being replaced with a fresh one.""")))
+
+registerGlobalValue(supybot.commands, 'threads',
+    registry.PositiveInteger(5, _("""Determines how many threads each plugin
+    may use at once to run threaded commands and snarfers.""")))
+registerGlobalValue(supybot.commands.threads, 'queue',
+    registry.NonNegativeInteger(20, _("""Determines how many threaded commands
+    and snarfers of a plugin may wait for one of its threads to be available.
+    When this many are already waiting, the bot replies with
+    supybot.replies.busy instead of running the command.""")))
+
 # supybot.commands.disabled moved to callbacks for canonicalName.
 
 ###
@@ -878,14 +901,23 @@ registerGlobalValue(supybot.drivers, 'poll',
     registry.PositiveFloat(1.0, _("""Determines the default length of time a
     driver should block waiting for input.""")))
 
+registerGlobalValue(supybot.drivers, 'readSize',
+    registry.PositiveInteger(16384, _("""Determines the maximum number of
+    bytes a driver reads from a connection at once.""")))
+
 class ValidDriverModule(registry.OnlySomeStrings):
     __slots__ = ()
-    validStrings = ('default', 'Socket', 'Twisted')
+    validStrings = ('default', 'Socket', 'Selectors', 'Asyncio', 'Twisted')
 
 registerGlobalValue(supybot.drivers, 'module',
     ValidDriverModule('default', _("""Determines what driver module the 
     bot will use. The default is Socket which is simple and stable 
-    and supports SSL. Twisted doesn't work if the IRC server which 
+    and supports SSL. Selectors works like Socket, but uses the most
+    efficient polling mechanism of your operating system and does not wait
+    for the next poll to send queued messages, which is better for bots
+    connected to many networks. Asyncio runs all connections and the
+    "async def" commands of plugins on a single asyncio event loop, which
+    also wakes up when scheduled events are due. Twisted doesn't work if the IRC server which 
     you are connecting to has IPv6 (most of them do).""")))
 
 registerGlobalValue(supybot.drivers, 'maxReconnectWait',
@@ -1072,6 +1104,23 @@ registerChannelValue(supybot.databases.plugins, 'requireRegistration',
     registry.Boolean(True, _("""Determines whether the bot will require user
     registration to use 'add' commands in database-based Supybot
     plugins.""")))
+registerGlobalValue(supybot.databases.plugins, 'journal',
+    registry.Boolean(False, _("""Determines whether the channel/user databases
+    of plugins (such as Seen, ChannelStats, and Herald) will only append the
+    entries that changed to a journal when flushed, instead of rewriting the
+    whole database.  The journal is merged into the database when it becomes
+    as big as the database itself.""")))
+
+class ChannelUserDatabase(registry.OnlySomeStrings):
+    validStrings = ('csv', 'sqlite3')
+registerGlobalValue(supybot.databases.plugins, 'channelUserDatabase',
+    ChannelUserDatabase('csv', _("""Determines how the channel/user databases
+    of plugins (such as Seen, ChannelStats, and Herald) are stored: 'csv'
+    keeps them in memory, in CSV files; 'sqlite3' keeps them in SQLite
+    databases, and only loads the entries that are used.  The first time an
+    SQLite database is used, the CSV database is imported into it.  Plugins
+    need to be reloaded for this to take effect.""")))
+
 registerChannelValue(supybot.databases.plugins, 'channelSpecific',
     ChannelSpecific(True, _("""Determines whether database-based plugins that
     can be channel-specific will be so.  This can be overridden by individual
@@ -1118,6 +1167,36 @@ registerGlobalValue(supybot.databases.types.cdb, 'maximumModifications',
 
 # XXX Configuration variables for dbi, sqlite, flat, mysql, etc.
 
+###
+# supybot.caches.  Their hits, misses, and evictions are shown by the
+# 'caches' command of the Status plugin.
+###
+registerGroup(supybot, 'caches')
+registerGlobalValue(supybot.caches, 'hostmaskPatterns',
+    registry.PositiveInteger(1000, _("""Determines how many compiled hostmask
+    patterns (used by ignores, bans, and user hostmasks) the bot keeps in
+    memory.""")))
+registerGlobalValue(supybot.caches, 'hostmaskMatches',
+    registry.PositiveInteger(1000, _("""Determines how many results of
+    matching a hostmask against a hostmask pattern the bot keeps in
+    memory.""")))
+registerGlobalValue(supybot.caches, 'users',
+    registry.PositiveInteger(1000, _("""Determines how many names and hostmasks
+    the user database remembers the user of.""")))
+registerGlobalValue(supybot.caches, 'capabilities',
+    registry.PositiveInteger(10000, _("""Determines how many results of
+    capability checks (for a given hostmask, capability, and channel) the bot
+    keeps in memory.""")))
+
+def _resizeCache(cache, value):
+    cache.resize(value())
+for (cache, value) in ((ircutils._patternCache,
+                        supybot.caches.hostmaskPatterns),
+                       (ircutils._hostmaskPatternEqualCache,
+                        supybot.caches.hostmaskMatches)):
+    _resizeCache(cache, value)
+    value.addCallback(_resizeCache, cache, value)
+
 ###
 # Protocol information.
 ###
@@ -1236,10 +1315,32 @@ registerGlobalValue(supybot.protocols.irc, 'maxHistoryLength',
     keep around in its history.  Changing this variable will not take effect
     on a network until it is reconnected.""")))
 
+registerGlobalValue(supybot.protocols.irc, 'maxChannelHistoryLength',
+    registry.NonNegativeInteger(0, _("""Determines how many old messages the
+    bot will keep around for each channel, in addition to its global history,
+    so that plugins looking for a channel's recent messages aren't affected by
+    the traffic of other channels.  0 disables per-channel history.  Changing
+    this variable will not take effect on a network until it is
+    reconnected.""")))
+registerGlobalValue(supybot.protocols.irc, 'maxNickHistoryLength',
+    registry.NonNegativeInteger(0, _("""Determines how many old messages the
+    bot will keep around for each nick in each channel, if per-channel history
+    is enabled.  0 disables per-nick history.  Changing this variable will not
+    take effect on a network until it is reconnected.""")))
+registerGlobalValue(supybot.protocols.irc.maxNickHistoryLength, 'nicks',
+    registry.PositiveInteger(100, _("""Determines how many nicks the bot will
+    keep per-nick history for in each channel; the history of the nicks that
+    spoke the least recently is forgotten first.  Changing this variable will
+    not take effect on a network until it is reconnected.""")))
+
 registerGlobalValue(supybot.protocols.irc, 'throttleTime',
     registry.Float(1.0, _("""A floating point number of seconds to throttle
     queued messages -- that is, messages will not be sent faster than once per
     throttleTime seconds.""")))
+registerGlobalValue(supybot.protocols.irc.throttleTime, 'burst',
+    registry.PositiveInteger(1, _("""Determines how many queued messages the
+    bot may send at once after being idle, before being throttled to one
+    message per throttleTime seconds.""")))
 
 registerGlobalValue(supybot.protocols.irc, 'ping',
     registry.Boolean(True, _("""Determines whether the bot will send PINGs to
@@ -1298,6 +1399,47 @@ registerGlobalValue(supybot.protocols.http, 'proxy',
     through.  The value should be of the form 'host:port'.""")))
 utils.web.proxy = supybot.protocols.http.proxy
 
+class HttpMaxConnections(registry.PositiveInteger):
+    """Value must be an integer greater than zero."""
+    __slots__ = ()
+    def setValue(self, v):
+        super(HttpMaxConnections, self).setValue(v)
+        utils.web.pool.setMaxConnections(self.value)
+
+registerGlobalValue(supybot.protocols.http, 'maxConnections',
+    HttpMaxConnections(16, _("""Determines how many HTTP requests the bot
+    will make at the same time.  Connections to HTTP servers are kept open
+    and reused for following requests to the same server.""")))
+
+class HttpCache(registry.Boolean):
+    """Value must be either True or False (or On or Off)."""
+    __slots__ = ()
+    def setValue(self, v):
+        super(HttpCache, self).setValue(v)
+        if self.value:
+            directory = supybot.directories.data.tmp.dirize('http-cache')
+            utils.web.cache = utils.web.ResponseCache(directory=directory)
+        else:
+            utils.web.cache = None
+
+registerGlobalValue(supybot.protocols.http, 'cache',
+    HttpCache(False, _("""Determines whether the bot will cache the
+    responses to its HTTP requests, in memory and in the temporary data
+    directory, as allowed by their Cache-Control, Expires, ETag, and
+    Last-Modified headers.""")))
+
+class HttpMaxResponseSize(registry.NonNegativeInteger):
+    """Value must be a non-negative integer."""
+    __slots__ = ()
+    def setValue(self, v):
+        super(HttpMaxResponseSize, self).setValue(v)
+        utils.web.maxResponseSize = self.value or None
+
+registerGlobalValue(supybot.protocols.http, 'maxResponseSize',
+    HttpMaxResponseSize(0, _("""Determines the maximum number of bytes
+    the bot will download when fetching a whole web page or file.  0 means
+    there is no limit.""")))
+
 def defaultHttpHeaders(network, channel):
     """Returns the default HTTP headers to use for this channel/network."""
     headers = utils.web.baseDefaultHeaders.copy()
@@ -1372,6 +1514,15 @@ registerGlobalValue(supybot.servers.http, 'keepAlive',
     registry.Boolean(False, _("""Determines whether the server will stay
     alive if no plugin is using it. This also means that the server will
     start even if it is not used.""")))
+registerGlobalValue(supybot.servers.http, 'threaded',
+    registry.Boolean(False, _("""Determines whether the server will handle
+    each connection in its own thread, so a slow client doesn't block the
+    others.  This also enables HTTP/1.1 persistent connections.  Changing this
+    variable will not take effect until the server is restarted.""")))
+registerGlobalValue(supybot.servers.http, 'timeout',
+    registry.PositiveFloat(15.0, _("""Determines how many seconds the server
+    will wait for a client's next request on a persistent connection before
+    closing it.  Only used if supybot.servers.http.threaded is True.""")))
 registerGlobalValue(supybot.servers.http, 'favicon',
     registry.String('', _("""Determines the path of the file served as
     favicon to browsers.""")))
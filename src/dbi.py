@@ -32,8 +32,10 @@ Module for some slight database-independence for simple databases.
 """
 
 import os
+import re
 import csv
 import math
+import threading
 
 from . import cdb, utils
 from .utils import minisix
@@ -51,6 +53,9 @@ class InvalidDBError(Exception):
 class MappingInterface(object):
     """This is a class to represent the underlying representation of a map
     from integer keys to strings."""
+    # Whether get() is cheap enough to be called for each record a query
+    # matches, rather than going over all records once.
+    fastGet = False
     def __init__(self, filename, **kwargs):
         """Feel free to ignore the filename."""
         raise NotImplementedError
@@ -277,7 +282,228 @@ class FlatfileMapping(MappingInterface):
         self.vacuum() # Should we do this?  It should be fine.
         
 
+class IndexedMapping(MappingInterface):
+    """Stores records in an append-only log, and keeps in memory the offset of
+    the latest version of each record in it.
+
+    Adding, setting, or removing a record appends a single entry to the log,
+    and getting a record is a single read, so they are all O(1).  When most of
+    the log is made of entries that were overwritten or removed, it is
+    compacted in a background thread; entries appended in the meantime are
+    copied over when the compacted log replaces the old one."""
+    fastGet = True
+    compactionRatio = 0.5
+    compactionMinimumSize = 64 * 1024
+    def __init__(self, filename, **kwargs):
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._compactor = None
+        if not os.path.exists(filename):
+            with open(filename, 'wb') as fd:
+                fd.write(b'#1\n')
+        self._fd = open(filename, 'a+b')
+        self._fd.seek(0)
+        data = self._fd.read()
+        self._index = {}
+        (end, self._obsolete, self.nextId) = self._replay(data, 0, self._index)
+        if end != len(data):
+            # The last entry was not completely written (eg. the bot crashed
+            # while writing it); ignore it.
+            self._fd.truncate(end)
+        self._size = end
+
+    _escapes = {'n': '\n', 'r': '\r'}
+    def _encode(self, s):
+        s = s.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r')
+        return s.encode('utf8')
+
+    def _decode(self, data):
+        s = data.decode('utf8')
+        if '\\' in s:
+            s = re.sub(r'\\(.)', lambda m: self._escapes.get(m.group(1),
+                                                             m.group(1)), s)
+        return s
+
+    def _replay(self, data, base, index):
+        """Applies the entries of the log in <data>, which starts at offset
+        <base> of the file, to <index>.  Returns the offset where the last
+        complete entry ends, the number of bytes made obsolete, and the next
+        id."""
+        obsolete = 0
+        nextId = 1
+        pos = 0
+        end = len(data)
+        while pos < end:
+            eol = data.find(b'\n', pos)
+            if eol == -1:
+                break
+            op = data[pos:pos+1]
+            if op == b'+':
+                colon = data.index(b':', pos)
+                id = int(data[pos+1:colon])
+                obsolete += self._entrySize(id, index.get(id))
+                index[id] = (base + colon + 1, eol - colon - 1)
+                nextId = max(nextId, id + 1)
+            elif op == b'-':
+                id = int(data[pos+1:eol])
+                obsolete += self._entrySize(id, index.pop(id, None))
+                obsolete += eol + 1 - pos
+            elif op == b'#':
+                nextId = max(nextId, int(data[pos+1:eol]))
+            else:
+                raise InvalidDBError('Invalid entry at offset %s of %s.' %
+                                     (base + pos, self.filename))
+            pos = eol + 1
+        return (pos, obsolete, nextId)
+
+    @staticmethod
+    def _entrySize(id, location):
+        if location is None:
+            return 0
+        return len(b'+%d:' % id) + location[1] + 1
+
+    def _append(self, entry):
+        offset = self._size
+        self._fd.write(entry)
+        self._fd.flush()
+        self._size += len(entry)
+        return offset
+
+    def get(self, id):
+        id = int(id)
+        with self._lock:
+            try:
+                (offset, length) = self._index[id]
+            except KeyError:
+                raise NoRecordError(id)
+            self._fd.seek(offset)
+            data = self._fd.read(length)
+        return self._decode(data)
+
+    def set(self, id, s):
+        id = int(id)
+        data = self._encode(s)
+        prefix = b'+%d:' % id
+        with self._lock:
+            offset = self._append(prefix + data + b'\n')
+            self._obsolete += self._entrySize(id, self._index.get(id))
+            self._index[id] = (offset + len(prefix), len(data))
+            self.nextId = max(self.nextId, id + 1)
+        self._maybeCompact()
+
+    def add(self, s):
+        with self._lock:
+            id = self.nextId
+            self.set(id, s)
+            return id
+
+    def remove(self, id):
+        id = int(id)
+        entry = b'-%d\n' % id
+        with self._lock:
+            if id not in self._index:
+                raise NoRecordError(id)
+            self._append(entry)
+            self._obsolete += self._entrySize(id, self._index.pop(id))
+            self._obsolete += len(entry)
+        self._maybeCompact()
+
+    def __iter__(self):
+        with self._lock:
+            index = sorted(self._index.items())
+            self._fd.seek(0)
+            data = self._fd.read(self._size)
+        for (id, (offset, length)) in index:
+            yield (id, self._decode(data[offset:offset+length]))
+
+    def __len__(self):
+        return len(self._index)
+
+    def _needsCompaction(self):
+        return self._size >= self.compactionMinimumSize and \
+               self._obsolete >= self._size * self.compactionRatio
+
+    def _maybeCompact(self):
+        with self._lock:
+            if self._compactor is not None or not self._needsCompaction():
+                return
+            self._compactor = threading.Thread(target=self._compact,
+                    name='Compacting %s' % os.path.basename(self.filename))
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _compact(self):
+        try:
+            with self._lock:
+                if self._fd is None:
+                    return
+                index = sorted(self._index.items())
+                end = self._size
+                nextId = self.nextId
+            reader = open(self.filename, 'rb')
+            out = utils.file.AtomicFile(self.filename, 'wb',
+                                        makeBackupIfSmaller=False)
+            try:
+                header = b'#%d\n' % nextId
+                out.write(header)
+                pos = len(header)
+                newIndex = {}
+                for (id, (offset, length)) in index:
+                    reader.seek(offset)
+                    prefix = b'+%d:' % id
+                    out.write(prefix + reader.read(length) + b'\n')
+                    newIndex[id] = (pos + len(prefix), length)
+                    pos += len(prefix) + length + 1
+                with self._lock:
+                    if self._fd is None:
+                        out.rollback()
+                        return
+                    # Copy what was written while we were compacting.
+                    reader.seek(end)
+                    tail = reader.read(self._size - end)
+                    out.write(tail)
+                    (_, obsolete, _) = self._replay(tail, pos, newIndex)
+                    reader.close()
+                    self._fd.close()
+                    out.close()
+                    self._fd = open(self.filename, 'a+b')
+                    self._index = newIndex
+                    self._size = pos + len(tail)
+                    self._obsolete = obsolete
+            except:
+                out.rollback()
+                raise
+            finally:
+                reader.close()
+        finally:
+            self._compactor = None
+
+    def vacuum(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        self._compact()
+
+    def flush(self):
+        with self._lock:
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        if self._fd is not None and self._needsCompaction():
+            # Entries made obsolete while the last compaction was running.
+            self._compact()
+        with self._lock:
+            if self._fd is not None:
+                self._fd.close()
+                self._fd = None
+
+
 class CdbMapping(MappingInterface):
+    fastGet = True
     def __init__(self, filename, **kwargs):
         self.filename = filename
         self._openCdb() # So it can be overridden later.
@@ -322,17 +548,73 @@ class CdbMapping(MappingInterface):
         self.db.close()
 
 
+_wordRe = re.compile(r'\w+')
+def words(s):
+    """Returns the set of (lowercased) words in <s>, as they are indexed for
+    DB.select's words argument."""
+    return set(_wordRe.findall(str(s).lower()))
+
+def globWords(glob, anchored=True):
+    """Returns the words that are in any string <glob> matches, so they can be
+    given to DB.select.  If <anchored> is False, <glob> may match only the end
+    of the string (like the regexp utils.python.glob2re returns does when used
+    with search)."""
+    ret = set()
+    chunks = re.split(r'[*?]|\[[^]]*\]', glob)
+    for (i, chunk) in enumerate(chunks):
+        for m in _wordRe.finditer(chunk):
+            # A word next to a wildcard may only be part of a word of the
+            # string.
+            if m.start() == 0 and (i != 0 or not anchored):
+                continue
+            if m.end() == len(chunk) and i != len(chunks) - 1:
+                continue
+            ret.add(m.group().lower())
+    return ret
+
 class DB(object):
     Mapping = 'flat' # This is a good, sane default.
     Record = None
-    def __init__(self, filename, Mapping=None, Record=None):
+    # Fields of the records that select() can look up without going over all
+    # the records: the values of those in indexes, and the words of those in
+    # textIndexes.
+    indexes = ()
+    textIndexes = ()
+    def __init__(self, filename, Mapping=None, Record=None,
+                 indexes=None, textIndexes=None):
         if Record is not None:
             self.Record = Record
         if Mapping is not None:
             self.Mapping = Mapping
+        if indexes is not None:
+            self.indexes = indexes
+        if textIndexes is not None:
+            self.textIndexes = textIndexes
         if isinstance(self.Mapping, minisix.string_types):
             self.Mapping = Mappings[self.Mapping]
         self.map = self.Mapping(filename)
+        # Maps (field, value) -- or (None, word) -- to the ids of the records
+        # having it, and ids to the keys they are indexed under.
+        self._index = {}
+        self._indexed = {}
+        if self.indexes or self.textIndexes:
+            for record in self:
+                self._indexRecord(record.id, record)
+
+    def _indexRecord(self, id, record):
+        keys = set((field, getattr(record, field)) for field in self.indexes)
+        for field in self.textIndexes:
+            keys.update((None, word) for word in words(getattr(record, field)))
+        for key in keys:
+            self._index.setdefault(key, set()).add(id)
+        self._indexed[id] = keys
+
+    def _unindexRecord(self, id):
+        for key in self._indexed.pop(id, ()):
+            ids = self._index[key]
+            ids.discard(id)
+            if not ids:
+                del self._index[key]
 
     def _newRecord(self, id, s):
         record = self.Record(id=id)
@@ -346,24 +628,59 @@ class DB(object):
     def set(self, id, record):
         s = record.serialize()
         self.map.set(id, s)
+        if self.indexes or self.textIndexes:
+            self._unindexRecord(id)
+            self._indexRecord(id, record)
 
     def add(self, record):
         s = record.serialize()
         id = self.map.add(s)
         record.id = id
+        if self.indexes or self.textIndexes:
+            self._indexRecord(id, record)
         return id
 
     def remove(self, id):
         self.map.remove(id)
+        self._unindexRecord(id)
 
     def __iter__(self):
         for (id, s) in self.map:
             # We don't need to yield the id because it's in the record.
             yield self._newRecord(id, s)
 
-    def select(self, p):
-        for record in self:
-            if p(record):
+    def _lookup(self, words, criteria):
+        """Returns the ids of the records matching the indexed criteria, or
+        None if none of them is indexed."""
+        keys = [(None, word.lower()) for word in words]
+        if keys and not self.textIndexes:
+            raise ValueError('%s has no text index.' % self.__class__.__name__)
+        keys.extend((field, criteria.pop(field)) for field in list(criteria)
+                    if field in self.indexes)
+        if not keys:
+            return None
+        sets = [self._index.get(key, ()) for key in keys]
+        sets.sort(key=len)
+        return set(sets[0]).intersection(*sets[1:])
+
+    def select(self, p=None, words=(), **criteria):
+        """Yields the records whose fields have the values given as keyword
+        arguments, whose text-indexed fields contain all <words>, and for
+        which p(record) is true.  Indexed fields and words are looked up in
+        the indexes, and only the records they match are read."""
+        ids = self._lookup(words, criteria)
+        if ids is None:
+            records = iter(self)
+        elif self.map.fastGet:
+            records = (self.get(id) for id in sorted(ids))
+        else:
+            records = (self._newRecord(id, s) for (id, s) in self.map
+                       if id in ids)
+        for record in records:
+            if any(getattr(record, field) != value
+                   for (field, value) in criteria.items()):
+                continue
+            if p is None or p(record):
                 yield record
 
     def random(self):
@@ -373,7 +690,10 @@ class DB(object):
             return None
 
     def size(self):
-        return ilen(self.map)
+        try:
+            return len(self.map)
+        except TypeError:
+            return ilen(self.map)
 
     def flush(self):
         self.map.flush()
@@ -387,6 +707,7 @@ class DB(object):
 Mappings = {
     'cdb': CdbMapping,
     'flat': FlatfileMapping,
+    'indexed': IndexedMapping,
     }
 
 
@@ -0,0 +1,324 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Contains a driver based on asyncio.  All connections share a single event
+loop, which is also used to run the ``async def`` commands of plugins; it
+runs until the next scheduled event is due, or until the driver loop is
+woken up.
+"""
+
+import ssl
+import time
+import asyncio
+import ipaddress
+
+from .. import conf, drivers, schedule, utils, world
+from ..utils.str import decode_raw_line
+
+class AsyncioRunnerDriver(drivers.IrcDriver):
+    """Runs the event loop shared by all connections of the Asyncio
+    driver."""
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._stopHandle = None
+        self._stopAt = None
+        drivers.addWakeupCallback(self.wakeup)
+        super(AsyncioRunnerDriver, self).__init__()
+
+    def name(self):
+        return self.__class__.__name__
+
+    def die(self):
+        global runner
+        drivers.removeWakeupCallback(self.wakeup)
+        for driver in AsyncioDriver._instances[:]:
+            driver.die()
+        self.loop.close()
+        if runner is self:
+            runner = None
+        super(AsyncioRunnerDriver, self).die()
+
+    def wakeup(self):
+        """Makes the event loop send queued messages and recompute when the
+        next scheduled event is due.  Safe to call from any thread."""
+        try:
+            self.loop.call_soon_threadsafe(self._wakeup)
+        except RuntimeError:
+            # The loop is closed; we are dying.
+            pass
+
+    def _wakeup(self):
+        for driver in AsyncioDriver._instances[:]:
+            driver.flush()
+        if self._stopHandle is not None:
+            self._scheduleStop()
+
+    def _getTimeout(self):
+        """Returns how long the event loop can run without delaying a
+        scheduled event or a throttled message."""
+        now = time.time()
+        timeout = conf.supybot.drivers.poll()
+        try:
+            timeout = min(timeout, schedule.schedule.schedule[0][0] - now)
+        except IndexError:
+            pass
+        for driver in AsyncioDriver._instances:
+            if driver.irc is not None and driver.irc.queue:
+                timeout = min(timeout, driver.irc.throttle.delay(now))
+        return max(timeout, 0)
+
+    def _scheduleStop(self):
+        """Sets a call_at timer handing control back to the driver loop
+        when there is something to do outside the event loop."""
+        when = self.loop.time() + self._getTimeout()
+        if self._stopHandle is not None:
+            if self._stopAt <= when:
+                return
+            self._stopHandle.cancel()
+        self._stopAt = when
+        self._stopHandle = self.loop.call_at(when, self.loop.stop)
+
+    def run(self):
+        self._scheduleStop()
+        try:
+            self.loop.run_forever()
+        except Exception:
+            drivers.log.exception('Uncaught exception in event loop:')
+        finally:
+            self._stopHandle.cancel()
+            self._stopHandle = None
+
+def getRunner():
+    """Returns the event loop runner shared by all connections, starting it
+    if needed."""
+    global runner
+    if runner is None:
+        runner = AsyncioRunnerDriver()
+    return runner
+
+class AsyncioDriver(drivers.IrcDriver, drivers.ServersMixin):
+    # Connected drivers
+    _instances = []
+
+    def __init__(self, irc):
+        assert irc is not None
+        self.irc = irc
+        self.loop = getRunner().loop
+        drivers.IrcDriver.__init__(self, irc)
+        drivers.ServersMixin.__init__(self, irc)
+        self._attempt = -1
+        self.servers = ()
+        self.task = None
+        self.writer = None
+        self.reconnectHandle = None
+        self.zombie = False
+        self.connected = False
+        self.resetDelay()
+        self.connect()
+
+    def getDelay(self):
+        ret = self.currentDelay
+        self.currentDelay = min(self.currentDelay * 2,
+                                conf.supybot.drivers.maxReconnectWait())
+        return ret
+
+    def resetDelay(self):
+        self.currentDelay = 10.0
+
+    def _getNextServer(self):
+        oldServer = getattr(self, 'currentServer', None)
+        server = drivers.ServersMixin._getNextServer(self)
+        if self.currentServer != oldServer:
+            self.resetDelay()
+        return server
+
+    def name(self):
+        return '%s(%s)' % (self.__class__.__name__, self.irc)
+
+    def run(self):
+        # I/O is done by the event loop; we only flush messages queued while
+        # it was not running.
+        self.flush()
+
+    def flush(self):
+        """Writes all the messages the Irc object is willing to give us."""
+        if not self.connected:
+            return
+        msgs = self.irc.takeMsgs()
+        if msgs and self.connected:
+            self.writer.writelines([str(msg).encode() for msg in msgs])
+
+    def connect(self):
+        self.reconnectHandle = None
+        self.task = self.loop.create_task(self._connection())
+
+    def reconnect(self, wait=False, reset=True):
+        if self.reconnectHandle is not None:
+            self.reconnectHandle.cancel()
+            self.reconnectHandle = None
+        if self.connected:
+            drivers.log.reconnect(self.irc.network)
+        self._close()
+        if reset:
+            drivers.log.debug('Resetting %s.', self.irc)
+            self.irc.reset()
+        if wait:
+            self.scheduleReconnect()
+        else:
+            self.connect()
+
+    def scheduleReconnect(self):
+        delay = self.getDelay()
+        if not world.dying:
+            drivers.log.reconnect(self.irc.network, time.time() + delay)
+        self.reconnectHandle = self.loop.call_later(delay, self.reconnect)
+
+    def _close(self):
+        if self.task is not None:
+            # When called from the task itself (eg. reconnect() called by a
+            # ping timeout while handling a message), this makes it stop at
+            # its next await.
+            self.task.cancel()
+            self.task = None
+        if self in self._instances:
+            self._instances.remove(self)
+        self.connected = False
+        if self.writer is not None:
+            # Buffered data is still sent before the connection is closed.
+            self.writer.close()
+            self.writer = None
+
+    def die(self):
+        self.zombie = True
+        if self.reconnectHandle is not None:
+            self.reconnectHandle.cancel()
+            self.reconnectHandle = None
+        self._close()
+        drivers.log.die(self.irc)
+        drivers.IrcDriver.die(self)
+
+    async def _open(self, server, network_config):
+        (host, port) = server
+        if network_config.socksproxy():
+            drivers.log.error('The Asyncio driver does not support socks '
+                              'proxies, using direct connection instead.')
+        addresses = []
+        for (_, _, _, _, sockaddr) in \
+                await self.loop.getaddrinfo(host, port):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        address = addresses[self._attempt % len(addresses)]
+        kwargs = {}
+        if utils.net.isIPV4(address) and conf.supybot.protocols.irc.vhost():
+            kwargs['local_addr'] = (conf.supybot.protocols.irc.vhost(), 0)
+        elif utils.net.isIPV6(address) and \
+                conf.supybot.protocols.irc.vhostv6():
+            kwargs['local_addr'] = (conf.supybot.protocols.irc.vhostv6(), 0)
+        if network_config.ssl():
+            certfile = network_config.certfile() or \
+                    conf.supybot.protocols.irc.certfile() or None
+            verify = conf.supybot.protocols.ssl.verifyCertificates()
+            if not verify:
+                drivers.log.warning('Not checking SSL certificates, '
+                        'connections are vulnerable to man-in-the-middle '
+                        'attacks. Set supybot.protocols.ssl.'
+                        'verifyCertificates to "true" to enable validity '
+                        'checks.')
+            kwargs['ssl'] = utils.net.ssl_context(certfile=certfile,
+                    verify=verify,
+                    trusted_fingerprints=
+                        network_config.ssl.serverFingerprints(),
+                    ca_file=network_config.ssl.authorityCertificate())
+            kwargs['server_hostname'] = host
+        elif not network_config.requireStarttls() and \
+                not ipaddress.ip_address(address).is_loopback:
+            drivers.log.warning(('Connection to network %s '
+                'does not use SSL/TLS, which makes it vulnerable to '
+                'man-in-the-middle attacks and passive eavesdropping. '
+                'You should consider upgrading your connection to SSL/TLS '
+                '<http://docs.limnoria.net/en/latest/use/faq.html#how-to-make-a-connection-secure>')
+                % self.irc.network)
+        (reader, writer) = await asyncio.open_connection(address, port,
+                                                          **kwargs)
+        fingerprints = network_config.ssl.serverFingerprints()
+        if network_config.ssl() and fingerprints and \
+                conf.supybot.protocols.ssl.verifyCertificates():
+            try:
+                utils.net.check_certificate_fingerprint(
+                        writer.get_extra_info('ssl_object'), fingerprints)
+            except ssl.CertificateError:
+                writer.close()
+                raise
+        return (reader, writer)
+
+    async def _connection(self):
+        self._attempt += 1
+        network_config = getattr(conf.supybot.networks, self.irc.network)
+        server = self._getNextServer()
+        drivers.log.connect(self.currentServer)
+        try:
+            (reader, self.writer) = await asyncio.wait_for(
+                    self._open(server, network_config),
+                    max(10, conf.supybot.drivers.poll()*10))
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            # ssl.CertificateError is a ValueError on Python < 3.7
+            drivers.log.connectError(self.currentServer, e)
+            self.task = None
+            self.scheduleReconnect()
+            return
+        self.connected = True
+        self.resetDelay()
+        self._instances.append(self)
+        self.flush()
+        inbuffer = drivers.LineBuffer()
+        try:
+            while True:
+                data = await reader.read(conf.supybot.drivers.readSize())
+                if not data:
+                    drivers.log.disconnect(self.currentServer)
+                    break
+                inbuffer.feed(data)
+                for line in inbuffer.lines():
+                    msg = drivers.parseMsg(decode_raw_line(line))
+                    if msg is not None and self.irc is not None:
+                        self.irc.feedMsg(msg)
+                self.flush()
+        except OSError as e:
+            drivers.log.disconnect(self.currentServer, e)
+        self.task = None
+        self._close()
+        if not self.zombie:
+            self.scheduleReconnect()
+
+
+Driver = AsyncioDriver
+runner = None
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
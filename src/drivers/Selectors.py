@@ -0,0 +1,202 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+"""
+Contains a socket driver based on the selectors module.  Connections are
+registered once with the operating system's most efficient polling mechanism
+(epoll, kqueue, ...), and the driver loop sleeps until a socket is ready, a
+message is queued, or a scheduled event is due.
+"""
+
+import time
+import socket
+import selectors
+
+from .. import conf, drivers, schedule
+from . import Socket
+
+class SelectorsRunnerDriver(drivers.IrcDriver):
+    """Waits for I/O on all the connections of the Selectors driver at
+    once."""
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        (self._wakeupReader, self._wakeupWriter) = socket.socketpair()
+        self._wakeupReader.setblocking(False)
+        self._wakeupWriter.setblocking(False)
+        self.selector.register(self._wakeupReader, selectors.EVENT_READ)
+        drivers.addWakeupCallback(self.wakeup)
+        super(SelectorsRunnerDriver, self).__init__()
+
+    def name(self):
+        return self.__class__.__name__
+
+    def die(self):
+        global poller
+        drivers.removeWakeupCallback(self.wakeup)
+        self.selector.close()
+        self._wakeupReader.close()
+        self._wakeupWriter.close()
+        if poller is self:
+            poller = None
+        super(SelectorsRunnerDriver, self).die()
+
+    def wakeup(self):
+        """Interrupts the current (or next) wait for I/O."""
+        try:
+            self._wakeupWriter.send(b'\0')
+        except OSError:
+            # Either the buffer is full, so there is already a wakeup
+            # pending, or we are dying.
+            pass
+
+    def _drainWakeup(self):
+        try:
+            while self._wakeupReader.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _getTimeout(self):
+        """Returns how long we can wait for I/O without delaying a scheduled
+        event or a throttled message."""
+        now = time.time()
+        timeout = conf.supybot.drivers.poll()
+        try:
+            timeout = min(timeout, schedule.schedule.schedule[0][0] - now)
+        except IndexError:
+            pass
+        for inst in SelectorsDriver._instances:
+            if inst.irc is None:
+                continue
+            elif inst.irc.fastqueue:
+                return 0
+            elif inst.irc.queue:
+                timeout = min(timeout, inst.irc.throttle.delay(now))
+        return max(timeout, 0)
+
+    def run(self):
+        for inst in SelectorsDriver._instances[:]:
+            if not inst.connected or inst.conn._closed:
+                inst._removeInstance()
+            elif inst.conn.fileno() == -1:
+                inst.reconnect()
+        try:
+            events = self.selector.select(self._getTimeout())
+        except Exception:
+            drivers.log.exception('Uncaught exception in selector:')
+            return
+        wokenUp = False
+        for (key, mask) in events:
+            inst = key.data
+            if inst is None:
+                self._drainWakeup()
+                wokenUp = True
+                continue
+            if mask & selectors.EVENT_READ:
+                inst._read()
+                # SSL sockets may have already decrypted data the selector
+                # will not tell us about.
+                while inst.connected and \
+                        getattr(inst.conn, 'pending', lambda: 0)():
+                    inst._read()
+            if mask & selectors.EVENT_WRITE and inst.connected:
+                inst._sendIfMsgs()
+        if wokenUp:
+            # Most likely a message was queued, send it right away.
+            for inst in SelectorsDriver._instances[:]:
+                if inst.irc and not inst.irc.zombie:
+                    inst._sendIfMsgs()
+
+def getPoller():
+    """Returns the poller shared by all connections, starting it if
+    needed."""
+    global poller
+    if poller is None:
+        poller = SelectorsRunnerDriver()
+    return poller
+
+class SelectorsDriver(Socket.SocketDriver):
+    _instances = []
+    _events = None
+
+    def __init__(self, irc):
+        getPoller()
+        Socket.SocketDriver.__init__(self, irc)
+
+    def _addInstance(self):
+        Socket.SocketDriver._addInstance(self)
+        self._events = selectors.EVENT_READ
+        getPoller().selector.register(self.conn, self._events, self)
+
+    def _removeInstance(self):
+        if self._events is not None and poller is not None:
+            self._events = None
+            try:
+                poller.selector.unregister(self.conn)
+            except (KeyError, ValueError):
+                pass
+        Socket.SocketDriver._removeInstance(self)
+
+    def _updateEvents(self):
+        """Only asks for write-readiness notifications when we actually have
+        something to write."""
+        if self._events is None or poller is None:
+            return
+        events = selectors.EVENT_READ
+        if self.outbuffer:
+            events |= selectors.EVENT_WRITE
+        if events != self._events:
+            self._events = events
+            poller.selector.modify(self.conn, events, self)
+
+    def _sendIfMsgs(self):
+        Socket.SocketDriver._sendIfMsgs(self)
+        self._updateEvents()
+
+    def _checkAndWriteOrReconnect(self):
+        Socket.SocketDriver._checkAndWriteOrReconnect(self)
+        if self.connected and self._events is None:
+            self._addInstance()
+
+    def run(self):
+        # Waiting for I/O is done once for all connections by the poller, so
+        # we only have to handle timers and flush queued messages here.
+        now = time.time()
+        if self.nextReconnectTime is not None and now > self.nextReconnectTime:
+            self.reconnect()
+        elif self.writeCheckTime is not None and now > self.writeCheckTime:
+            self._checkAndWriteOrReconnect()
+        if self.connected:
+            self._sendIfMsgs()
+
+
+Driver = SelectorsDriver
+poller = None
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
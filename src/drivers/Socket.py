@@ -41,6 +41,8 @@ import threading
 import select
 import socket
 import sys
+import itertools
+import collections
 
 try:
     import ipaddress  # Python >= 3.3 or backported ipaddress
@@ -55,11 +57,17 @@ from ..utils.str import decode_raw_line
 try:
     import ssl
     SSLError = ssl.SSLError
+    SSLSocket = ssl.SSLSocket
 except:
     drivers.log.debug('ssl module is not available, '
                       'cannot connect to SSL servers.')
     class SSLError(Exception):
         pass
+    class SSLSocket(object):
+        pass
+
+# Most systems do not allow writing more buffers at once (IOV_MAX).
+MAX_WRITE_BUFFERS = 1024
 
 class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
     _instances = []
@@ -73,8 +81,9 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self._attempt = -1
         self.servers = ()
         self.eagains = 0
-        self.inbuffer = b''
-        self.outbuffer = ''
+        self.inbuffer = drivers.LineBuffer()
+        # Encoded lines (or what is left of them) waiting to be written.
+        self.outbuffer = collections.deque()
         self.zombie = False
         self.connected = False
         self.writeCheckTime = None
@@ -111,8 +120,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         # hasn't finished yet.  We'll keep track of how many we get.
         if e.args[0] != 11 or self.eagains > 120:
             drivers.log.disconnect(self.currentServer, e)
-            if self in self._instances:
-                self._instances.remove(self)
+            self._removeInstance()
             try:
                 self.conn.close()
             except:
@@ -123,22 +131,43 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             log.debug('Got EAGAIN, current count: %s.', self.eagains)
             self.eagains += 1
 
+    def _writeOutbuffer(self):
+        """Writes as much of the output buffer as the socket accepts, and
+        drops whatever was written from it."""
+        if isinstance(self.conn, SSLSocket) or \
+           not hasattr(self.conn, 'sendmsg'):
+            # SSL sockets do not support scatter/gather writes; join the
+            # buffers once, so the remainder does not have to be joined again
+            # next time.
+            if len(self.outbuffer) > 1:
+                data = b''.join(self.outbuffer)
+                self.outbuffer.clear()
+                self.outbuffer.append(data)
+            sent = self.conn.send(self.outbuffer[0])
+        else:
+            sent = self.conn.sendmsg(
+                list(itertools.islice(self.outbuffer, MAX_WRITE_BUFFERS)))
+        while sent:
+            data = self.outbuffer[0]
+            if sent >= len(data):
+                sent -= len(data)
+                self.outbuffer.popleft()
+            else:
+                self.outbuffer[0] = memoryview(data)[sent:]
+                break
+
     def _sendIfMsgs(self):
         if not self.connected:
             return
         if not self.zombie:
-            msgs = [self.irc.takeMsg()]
-            while msgs[-1] is not None:
-                msgs.append(self.irc.takeMsg())
-            del msgs[-1]
-            self.outbuffer += ''.join(map(str, msgs))
-        if self.outbuffer:
-            try:
+            for msg in self.irc.takeMsgs():
                 if minisix.PY2:
-                    sent = self.conn.send(self.outbuffer)
+                    self.outbuffer.append(str(msg))
                 else:
-                    sent = self.conn.send(self.outbuffer.encode())
-                self.outbuffer = self.outbuffer[sent:]
+                    self.outbuffer.append(str(msg).encode())
+        if self.outbuffer:
+            try:
+                self._writeOutbuffer()
                 self.eagains = 0
             except socket.error as e:
                 self._handleSocketError(e)
@@ -158,7 +187,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                         (minisix.PY3 and inst.conn._closed) or \
                         (minisix.PY2 and
                             inst.conn._sock.__class__ is socket._closedsocket):
-                    cls._instances.remove(inst)
+                    inst._removeInstance()
                 elif inst.conn.fileno() == -1:
                     inst.reconnect()
             if not cls._instances:
@@ -196,11 +225,12 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
     def _read(self):
         """Called by _select() when we can read data."""
         try:
-            self.inbuffer += self.conn.recv(1024)
+            n = self.inbuffer.recvInto(self.conn,
+                                       conf.supybot.drivers.readSize())
+            if not n:
+                raise socket.error('Connection closed by peer')
             self.eagains = 0 # If we successfully recv'ed, we can reset this.
-            lines = self.inbuffer.split(b'\n')
-            self.inbuffer = lines.pop()
-            for line in lines:
+            for line in self.inbuffer.lines():
                 line = decode_raw_line(line)
 
                 msg = drivers.parseMsg(line)
@@ -228,8 +258,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self.nextReconnectTime = None
         if self.connected:
             drivers.log.reconnect(self.irc.network)
-            if self in self._instances:
-                self._instances.remove(self)
+            self._removeInstance()
             try:
                 self.conn.shutdown(socket.SHUT_RDWR)
             except: # "Transport endpoint not connected"
@@ -241,6 +270,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
             self.irc.reset()
         else:
             drivers.log.debug('Not resetting %s.', self.irc)
+        self.inbuffer = drivers.LineBuffer()
         if wait:
             self.scheduleReconnect()
             return
@@ -302,7 +332,8 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                     % self.irc.network)
 
             def setTimeout():
-                self.conn.settimeout(conf.supybot.drivers.poll())
+                if self.conn.fileno() != -1: # Not closed since then
+                    self.conn.settimeout(conf.supybot.drivers.poll())
             conf.supybot.drivers.poll.addCallback(setTimeout)
             setTimeout()
             self.connected = True
@@ -319,8 +350,18 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
                 drivers.log.connectError(self.currentServer, e)
                 self.scheduleReconnect()
             return
+        self._addInstance()
+
+    def _addInstance(self):
+        """Makes the connection visible to the class-wide I/O loop."""
         self._instances.append(self)
 
+    def _removeInstance(self):
+        """Removes the connection from the class-wide I/O loop.  Must be
+        called before the socket is closed."""
+        if self in self._instances:
+            self._instances.remove(self)
+
     def _checkAndWriteOrReconnect(self):
         self.writeCheckTime = None
         drivers.log.debug('Checking whether we are connected.')
@@ -345,8 +386,7 @@ class SocketDriver(drivers.IrcDriver, drivers.ServersMixin):
         self.nextReconnectTime = when
 
     def die(self):
-        if self in self._instances:
-            self._instances.remove(self)
+        self._removeInstance()
         self.zombie = True
         if self.nextReconnectTime is not None:
             self.nextReconnectTime = None
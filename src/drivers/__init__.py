@@ -40,6 +40,7 @@ from ..utils import minisix
 _drivers = {}
 _deadDrivers = set()
 _newDrivers = []
+_wakeupCallbacks = []
 
 class IrcDriver(object):
     """Base class for drivers."""
@@ -96,6 +97,24 @@ def remove(name):
     """Removes the driver with the given name from the loop."""
     _deadDrivers.add(name)
 
+def addWakeupCallback(f):
+    """Registers a function called by wakeup(); drivers blocking on I/O use
+    it to interrupt their wait."""
+    if f not in _wakeupCallbacks:
+        _wakeupCallbacks.append(f)
+
+def removeWakeupCallback(f):
+    """Unregisters a function added with addWakeupCallback."""
+    if f in _wakeupCallbacks:
+        _wakeupCallbacks.remove(f)
+
+def wakeup():
+    """Tells the driver loop there is new work (a queued message, a newly
+    scheduled event, ...), so drivers that support it stop waiting for I/O
+    instead of sleeping until the next poll.  Safe to call from any thread."""
+    for f in _wakeupCallbacks:
+        f()
+
 def run():
     """Runs the whole driver loop."""
     for (name, driver) in _drivers.items():
@@ -126,6 +145,75 @@ def run():
             del _drivers[name]
         _drivers[name] = driver
 
+class LineBuffer(object):
+    """Splits a stream of bytes into lines, without rescanning the bytes that
+    were already received.
+
+    Data is read straight into a reusable bytearray (with
+    :meth:`recvInto`) or appended to it (with :meth:`feed`), and
+    :meth:`lines` only looks at the bytes received since its last call
+    to know whether there are new complete lines."""
+    __slots__ = ('_buffer', '_view', '_start', '_end', '_scanned')
+    def __init__(self, size=4096):
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0 # Start of the first incomplete line
+        self._end = 0 # End of the received data
+        self._scanned = 0 # There is no separator between _start and that
+
+    def __len__(self):
+        """Returns the number of buffered bytes not yet returned as a
+        line."""
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """Makes room for size more bytes after the received data."""
+        # Move the incomplete line to the beginning of the buffer; through a
+        # copy, as the source and destination may overlap.
+        length = self._end - self._start
+        self._buffer[:length] = bytes(self._view[self._start:self._end])
+        self._scanned -= self._start
+        self._start = 0
+        self._end = length
+        if len(self._buffer) - length < size:
+            # The buffer can't be resized while there is a view on it.
+            self._view.release()
+            self._buffer.extend(bytes(length + size - len(self._buffer)))
+            self._view = memoryview(self._buffer)
+
+    def recvInto(self, sock, size):
+        """Receives up to size bytes from the socket.  Returns the number of
+        bytes received, which is 0 if the connection was closed."""
+        if len(self._buffer) - self._end < size:
+            self._reserve(size)
+        n = sock.recv_into(self._view[self._end:], size)
+        self._end += n
+        return n
+
+    def feed(self, data):
+        """Appends data received by other means."""
+        size = len(data)
+        if len(self._buffer) - self._end < size:
+            self._reserve(size)
+        self._buffer[self._end:self._end+size] = data
+        self._end += size
+
+    def lines(self):
+        """Returns the list of complete lines received so far, without their
+        trailing \\n."""
+        end = self._end
+        i = self._buffer.rfind(b'\n', self._scanned, end)
+        if i == -1:
+            self._scanned = end
+            return []
+        lines = bytes(self._view[self._start:i]).split(b'\n')
+        if i + 1 == end:
+            # Everything was consumed, start over at the beginning.
+            self._start = self._end = self._scanned = 0
+        else:
+            self._start = self._scanned = i + 1
+        return lines
+
 class Log(object):
     """This is used to have a nice, consistent interface for drivers to use."""
     def connect(self, server):
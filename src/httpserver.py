@@ -34,6 +34,7 @@ An embedded and centralized HTTP server for Supybot's plugins.
 import os
 import cgi
 import socket
+import threading
 from threading import Thread
 
 import supybot.log as log
@@ -45,8 +46,10 @@ _ = PluginInternationalization()
 
 if minisix.PY2:
     from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 else:
     from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
 
 configGroup = conf.supybot.servers.http
 
@@ -164,12 +167,14 @@ def get_template(filename):
         with open(path + '.example', 'r') as fd:
             return fd.read()
 
-class RealSupyHTTPServer(HTTPServer):
+class RealSupyHTTPServer(ThreadingMixIn, HTTPServer):
     # TODO: make this configurable
     timeout = 0.5
     running = False
+    daemon_threads = True
 
     def __init__(self, address, protocol, callback):
+        self.threaded = configGroup.threaded()
         self.protocol = protocol
         if protocol == 4:
             self.address_family = socket.AF_INET
@@ -186,6 +191,12 @@ class RealSupyHTTPServer(HTTPServer):
             self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, v)
         HTTPServer.server_bind(self)
 
+    def process_request(self, request, client_address):
+        if self.threaded:
+            ThreadingMixIn.process_request(self, request, client_address)
+        else:
+            HTTPServer.process_request(self, request, client_address)
+
     def hook(self, subdir, callback):
         if subdir in self.callbacks:
             log.warning(('The HTTP subdirectory `%s` was already hooked but '
@@ -205,6 +216,7 @@ class RealSupyHTTPServer(HTTPServer):
 
 class TestSupyHTTPServer(RealSupyHTTPServer):
     def __init__(self, *args, **kwargs):
+        self.threaded = False
         self.callbacks = {}
     def serve_forever(self, *args, **kwargs):
         pass
@@ -216,7 +228,34 @@ if world.testing:
 else:
     SupyHTTPServer = RealSupyHTTPServer
 
+# The request handler of the request being processed by the current thread,
+# used by SupyHTTPServerCallback's shortcuts.
+_requests = threading.local()
+
 class SupyHTTPRequestHandler(BaseHTTPRequestHandler):
+    _hasContentLength = False
+
+    def setup(self):
+        if self.server.threaded:
+            self.protocol_version = 'HTTP/1.1'
+            self.timeout = configGroup.timeout()
+            # Headers and body are written separately; don't let Nagle's
+            # algorithm delay the body until the client ACKs the headers.
+            self.disable_nagle_algorithm = True
+        BaseHTTPRequestHandler.setup(self)
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'content-length':
+            self._hasContentLength = True
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        if not self._hasContentLength and \
+                self.protocol_version >= 'HTTP/1.1':
+            # The client can't know where the response ends otherwise.
+            self.send_header('Connection', 'close')
+        BaseHTTPRequestHandler.end_headers(self)
+
     def do_X(self, callbackMethod, *args, **kwargs):
         if self.path == '/':
             callback = SupyIndex()
@@ -233,16 +272,20 @@ class SupyHTTPRequestHandler(BaseHTTPRequestHandler):
             except KeyError:
                 callback = Supy404()
 
-        # Some shortcuts
-        for name in ('send_response', 'send_header', 'end_headers', 'rfile',
-                'wfile', 'headers'):
-            setattr(callback, name, getattr(self, name))
         # We call doX, because this is more supybotic than do_X.
         path = self.path
         if not callback.fullpath:
             path = '/' + path.split('/', 2)[-1]
-        getattr(callback, callbackMethod)(self, path,
-                *args, **kwargs)
+        self._hasContentLength = False
+        previous = getattr(_requests, 'handler', None)
+        _requests.handler = self
+        try:
+            getattr(callback, callbackMethod)(self, path,
+                    *args, **kwargs)
+        finally:
+            _requests.handler = previous
+        if not self._hasContentLength:
+            self.close_connection = True
 
     def do_GET(self):
         self.do_X('doGet')
@@ -290,6 +333,18 @@ class SupyHTTPServerCallback(log.Firewalled):
                      }
 
 
+    # Shortcuts to the request handler of the current request, so they are
+    # safe to use when requests are served concurrently.
+    def _handlerAttribute(name):
+        return property(lambda self: getattr(_requests.handler, name))
+    send_response = _handlerAttribute('send_response')
+    send_header = _handlerAttribute('send_header')
+    end_headers = _handlerAttribute('end_headers')
+    rfile = _handlerAttribute('rfile')
+    wfile = _handlerAttribute('wfile')
+    headers = _handlerAttribute('headers')
+    del _handlerAttribute
+
     fullpath = False
     name = "Unnamed plugin"
     defaultResponse = _("""
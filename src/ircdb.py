@@ -105,6 +105,18 @@ _unwildcard_remover = utils.str.MultipleRemover('!@*?')
 def unWildcardHostmask(hostmask):
     return _unwildcard_remover(hostmask)
 
+###
+# checkCapability caches its results until anything they depend on changes,
+# which bumps this generation counter.
+###
+_capabilitiesGeneration = 0
+def invalidateCapabilities(*args, **kwargs):
+    """Invalidates the results of checkCapability cached so far.  Called
+    when capabilities, users, or channels change; the arguments are
+    ignored, so it can be used as a registry callback."""
+    global _capabilitiesGeneration
+    _capabilitiesGeneration += 1
+
 _invert = invertCapability
 class CapabilitySet(set):
     """A subclass of set handling basic capability stuff."""
@@ -122,11 +134,13 @@ class CapabilitySet(set):
         if self.__parent.__contains__(inverted):
             self.__parent.remove(inverted)
         self.__parent.add(capability)
+        invalidateCapabilities()
 
     def remove(self, capability):
         """Removes a capability from the set."""
         capability = ircutils.toLower(capability)
         self.__parent.remove(capability)
+        invalidateCapabilities()
 
     def __contains__(self, capability):
         capability = ircutils.toLower(capability)
@@ -283,8 +297,10 @@ class IrcUser(object):
                     elif hostmask == authmask:
                         return True
             finally:
-                while removals:
-                    self.auth.remove(removals.pop())
+                if removals:
+                    while removals:
+                        self.auth.remove(removals.pop())
+                    users.reindexUser(self)
         for pat in self.hostmasks:
             if ircutils.hostmaskPatternEqual(pat, hostmask):
                 return pat
@@ -296,10 +312,12 @@ class IrcUser(object):
         if len(unWildcardHostmask(hostmask)) < 3:
             raise ValueError('Hostmask must contain at least 3 non-wildcard characters.')
         self.hostmasks.add(hostmask)
+        users.reindexUser(self)
 
     def removeHostmask(self, hostmask):
         """Removes a hostmask from the user's hostmasks."""
         self.hostmasks.remove(hostmask)
+        users.reindexUser(self)
 
     def checkNick(self, network, nick):
         """Checks a given nick against the user's nicks."""
@@ -339,14 +357,14 @@ class IrcUser(object):
                 return False
             uniqued = list(filter(uniqueHostmask, reversed(self.auth)))
             self.auth = list(reversed(uniqued))
+            users.reindexUser(self)
         else:
             raise ValueError('secure flag set, unmatched hostmask')
 
     def clearAuth(self):
         """Unsets a user's authenticated hostmask."""
-        for (when, hostmask) in self.auth:
-            users.invalidateCache(hostmask=hostmask)
         self.auth = []
+        users.reindexUser(self)
 
     def preserve(self, fd, indent=''):
         def write(s):
@@ -379,8 +397,8 @@ class IrcChannel(object):
                  capabilities=None, lobotomized=False, defaultAllow=True):
         self.defaultAllow = defaultAllow
         self.expiredBans = []
-        self.bans = bans or {}
-        self.ignores = ignores or {}
+        self.bans = ircutils.ExpiringHostmaskDict(bans or {})
+        self.ignores = ircutils.ExpiringHostmaskDict(ignores or {})
         self.silences = silences or []
         self.exceptions = exceptions or []
         self.capabilities = capabilities or CapabilitySet()
@@ -412,15 +430,8 @@ class IrcChannel(object):
     def checkBan(self, hostmask):
         """Checks whether a given hostmask is banned by the channel banlist."""
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
-        now = time.time()
-        for (pattern, expiration) in list(self.bans.items()):
-            if now < expiration or not expiration:
-                if ircutils.hostmaskPatternEqual(pattern, hostmask):
-                    return True
-            else:
-                self.expiredBans.append((pattern, expiration))
-                del self.bans[pattern]
-        return False
+        self.expiredBans.extend(self.bans.expire())
+        return self.bans.match(hostmask)
 
     def addIgnore(self, hostmask, expiration=0):
         """Adds an ignore to the channel ignore list."""
@@ -445,6 +456,7 @@ class IrcChannel(object):
     def setDefaultCapability(self, b):
         """Sets the default capability in the channel."""
         self.defaultAllow = b
+        invalidateCapabilities()
 
     def _checkCapability(self, capability, ignoreOwner=False):
         """Checks whether a certain capability is allowed by the channel."""
@@ -466,15 +478,9 @@ class IrcChannel(object):
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
         if self.checkBan(hostmask):
             return True
-        now = time.time()
-        for (pattern, expiration) in list(self.ignores.items()):
-            if now < expiration or not expiration:
-                if ircutils.hostmaskPatternEqual(pattern, hostmask):
-                    return True
-            else:
-                del self.ignores[pattern]
-                # Later we may wish to keep expiredIgnores, but not now.
-        return False
+        # Later we may wish to keep expiredIgnores, but not now.
+        self.ignores.expire()
+        return self.ignores.match(hostmask)
 
     def preserve(self, fd, indent=''):
         def write(s):
@@ -621,14 +627,20 @@ class DuplicateHostmask(ValueError):
 class UsersDictionary(utils.IterableMap):
     """A simple serialized-to-file User Database."""
     __slots__ = ('noFlush', 'filename', 'users', '_nameCache',
-            '_hostmaskCache')
+            '_hostmaskCache', '_hostmaskIndex', '_indexedHostmasks')
     def __init__(self):
         self.noFlush = False
         self.filename = None
         self.users = {}
         self.nextId = 0
-        self._nameCache = utils.structures.CacheDict(1000)
-        self._hostmaskCache = utils.structures.CacheDict(1000)
+        size = conf.supybot.caches.users()
+        self._nameCache = utils.structures.CacheDict(size, 'users.names')
+        self._hostmaskCache = utils.structures.CacheDict(size,
+                                                         'users.hostmasks')
+        # Hostmasks and authenticated hostmasks of users, so getUserId only
+        # has to check the users whose hostmasks may match.
+        self._hostmaskIndex = ircutils.HostmaskIndex()
+        self._indexedHostmasks = {} # {id: [hostmask, ...]}
 
     # This is separate because the Creator has to access our instance.
     def open(self, filename):
@@ -655,6 +667,9 @@ class UsersDictionary(utils.IterableMap):
             self.users.clear()
             self._nameCache.clear()
             self._hostmaskCache.clear()
+            self._hostmaskIndex.clear()
+            self._indexedHostmasks.clear()
+            invalidateCapabilities()
             try:
                 self.open(self.filename)
             except EnvironmentError as e:
@@ -684,6 +699,8 @@ class UsersDictionary(utils.IterableMap):
         if self.flush in world.flushers:
             world.flushers.remove(self.flush)
         self.users.clear()
+        self._hostmaskIndex.clear()
+        self._indexedHostmasks.clear()
 
     def items(self):
         return self.users.items()
@@ -695,17 +712,13 @@ class UsersDictionary(utils.IterableMap):
                 return self._hostmaskCache[s]
             except KeyError:
                 ids = {}
-                for (id, user) in self.users.items():
-                    x = user.checkHostmask(s)
+                for id in self._hostmaskIndex.candidates(s):
+                    x = self.users[id].checkHostmask(s)
                     if x:
                         ids[id] = x
                 if len(ids) == 1:
                     id = list(ids.keys())[0]
                     self._hostmaskCache[s] = id
-                    try:
-                        self._hostmaskCache[id].add(s)
-                    except KeyError:
-                        self._hostmaskCache[id] = set([s])
                     return id
                 elif len(ids) == 0:
                     raise KeyError(s)
@@ -715,6 +728,7 @@ class UsersDictionary(utils.IterableMap):
                     for (id, hostmask) in ids.items():
                         log.error('Removing %q from user %s.', hostmask, id)
                         self.users[id].removeHostmask(hostmask)
+                        self.reindexUser(self.users[id])
                     raise DuplicateHostmask('Ids %r matched.' % ids)
         else: # Not a hostmask, must be a name.
             s = s.lower()
@@ -724,7 +738,6 @@ class UsersDictionary(utils.IterableMap):
                 for (id, user) in self.users.items():
                     if s == user.name.lower():
                         self._nameCache[s] = id
-                        self._nameCache[id] = s
                         return id
                 else:
                     raise KeyError(s)
@@ -764,22 +777,34 @@ class UsersDictionary(utils.IterableMap):
 
     def invalidateCache(self, id=None, hostmask=None, name=None):
         if hostmask is not None:
-            if hostmask in self._hostmaskCache:
-                id = self._hostmaskCache.pop(hostmask)
-                self._hostmaskCache[id].remove(hostmask)
-                if not self._hostmaskCache[id]:
-                    del self._hostmaskCache[id]
+            id = self._hostmaskCache.pop(hostmask, id)
         if name is not None:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
+            id = self._nameCache.pop(name.lower(), id)
         if id is not None:
-            if id in self._nameCache:
-                del self._nameCache[self._nameCache[id]]
-                del self._nameCache[id]
-            if id in self._hostmaskCache:
-                for hostmask in self._hostmaskCache[id]:
-                    del self._hostmaskCache[hostmask]
-                del self._hostmaskCache[id]
+            for cache in (self._nameCache, self._hostmaskCache):
+                for key in [key for (key, v) in cache.items() if v == id]:
+                    del cache[key]
+
+    def reindexUser(self, user):
+        """Updates the hostmask index after the hostmasks or authenticated
+        hostmasks of the given user changed.  Does nothing if the user is
+        not in this database."""
+        if user.id in self.users and self.users[user.id] is user:
+            invalidateCapabilities()
+            self.invalidateCache(user.id)
+            self._unindexUser(user.id)
+            self._indexUser(user)
+
+    def _indexUser(self, user):
+        hostmasks = list(user.hostmasks)
+        hostmasks.extend(mask for (_, mask) in user.auth)
+        for hostmask in hostmasks:
+            self._hostmaskIndex.add(hostmask, user.id)
+        self._indexedHostmasks[user.id] = hostmasks
+
+    def _unindexUser(self, id):
+        for hostmask in self._indexedHostmasks.pop(id, ()):
+            self._hostmaskIndex.remove(hostmask, id)
 
     def setUser(self, user, flush=True):
         """Sets a user (given its id) to the IrcUser given it."""
@@ -803,21 +828,20 @@ class UsersDictionary(utils.IterableMap):
                 for otherHostmask in u.hostmasks:
                     if ircutils.hostmaskPatternEqual(hostmask, otherHostmask):
                         raise DuplicateHostmask(u.name, hostmask)
+        invalidateCapabilities()
         self.invalidateCache(user.id)
+        self._unindexUser(user.id)
         self.users[user.id] = user
+        self._indexUser(user)
         if flush:
             self.flush()
 
     def delUser(self, id):
         """Removes a user from the database."""
         del self.users[id]
-        if id in self._nameCache:
-            del self._nameCache[self._nameCache[id]]
-            del self._nameCache[id]
-        if id in self._hostmaskCache:
-            for hostmask in list(self._hostmaskCache[id]):
-                del self._hostmaskCache[hostmask]
-            del self._hostmaskCache[id]
+        invalidateCapabilities()
+        self.invalidateCache(id)
+        self._unindexUser(id)
         self.flush()
 
     def newUser(self):
@@ -881,6 +905,7 @@ class ChannelsDictionary(utils.IterableMap):
         """Reloads the channel database from its file."""
         if self.filename is not None:
             self.channels.clear()
+            invalidateCapabilities()
             try:
                 self.open(self.filename)
             except EnvironmentError as e:
@@ -902,6 +927,7 @@ class ChannelsDictionary(utils.IterableMap):
         """Sets a given channel to the IrcChannel object given."""
         channel = channel.lower()
         self.channels[channel] = ircChannel
+        invalidateCapabilities()
         self.flush()
 
     def items(self):
@@ -912,7 +938,7 @@ class IgnoresDB(object):
     __slots__ = ('filename', 'hostmasks')
     def __init__(self):
         self.filename = None
-        self.hostmasks = {}
+        self.hostmasks = ircutils.ExpiringHostmaskDict()
 
     def open(self, filename):
         self.filename = filename
@@ -963,14 +989,8 @@ class IgnoresDB(object):
             log.warning('IgnoresDB.reload called without self.filename.')
 
     def checkIgnored(self, prefix):
-        now = time.time()
-        for (hostmask, expiration) in list(self.hostmasks.items()):
-            if expiration and now > expiration:
-                del self.hostmasks[hostmask]
-            else:
-                if ircutils.hostmaskPatternEqual(hostmask, prefix):
-                    return True
-        return False
+        self.hostmasks.expire()
+        return self.hostmasks.match(prefix)
 
     def add(self, hostmask, expiration=0):
         assert ircutils.isUserHostmask(hostmask), 'got %s' % hostmask
@@ -1005,6 +1025,11 @@ except EnvironmentError as e:
     log.warning('Couldn\'t open ignore database: %s', e)
 
 
+def _resizeUsersCaches():
+    users._nameCache.resize(conf.supybot.caches.users())
+    users._hostmaskCache.resize(conf.supybot.caches.users())
+conf.supybot.caches.users.addCallback(_resizeUsersCaches)
+
 world.flushers.append(users.flush)
 world.flushers.append(ignores.flush)
 world.flushers.append(channels.flush)
@@ -1069,6 +1094,13 @@ def _checkCapabilityForUnknownUser(capability, users=users, channels=channels,
     else:
         return _x(capability, conf.supybot.capabilities.default())
 
+_capabilitiesCache = utils.structures.CacheDict(
+    conf.supybot.caches.capabilities(), 'capabilities')
+_capabilitiesCacheGeneration = 0
+def _resizeCapabilitiesCache():
+    _capabilitiesCache.resize(conf.supybot.caches.capabilities())
+conf.supybot.caches.capabilities.addCallback(_resizeCapabilitiesCache)
+
 def checkCapability(hostmask, capability, users=users, channels=channels,
                     ignoreOwner=False, ignoreChannelOp=False,
                     ignoreDefaultAllow=False):
@@ -1092,6 +1124,27 @@ def checkCapability(hostmask, capability, users=users, channels=channels,
             '@' not in hostmask or
             '__no_testcap__' not in hostmask.split('@')[1]):
         return _x(capability, True)
+    global _capabilitiesCacheGeneration
+    generation = _capabilitiesGeneration
+    if generation != _capabilitiesCacheGeneration:
+        _capabilitiesCache.clear()
+        _capabilitiesCacheGeneration = generation
+    key = (hostmask, capability, users, channels,
+           ignoreOwner, ignoreChannelOp, ignoreDefaultAllow)
+    try:
+        return _capabilitiesCache[key]
+    except KeyError:
+        pass
+    ret = _checkCapability(hostmask, capability, users, channels,
+                           ignoreOwner, ignoreChannelOp, ignoreDefaultAllow)
+    if generation == _capabilitiesGeneration:
+        # Do not cache results computed while something changed (for
+        # instance, getChannel creating a channel).
+        _capabilitiesCache[key] = ret
+    return ret
+
+def _checkCapability(hostmask, capability, users, channels,
+                     ignoreOwner, ignoreChannelOp, ignoreDefaultAllow):
     try:
         u = users.getUser(hostmask)
         if u.secure and not u.checkHostmask(hostmask, useAuth=False):
@@ -1204,5 +1257,10 @@ conf.registerGlobalValue(conf.supybot.capabilities, 'private',
     registry.SpaceSeparatedListOfStrings([], """Determines what capabilities
     the bot will never tell to a non-admin whether or not a user has them."""))
 
+for value in (conf.supybot.capabilities,
+              conf.supybot.capabilities.registeredUsers,
+              conf.supybot.capabilities.default):
+    value.addCallback(invalidateCapabilities)
+
 
 # vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
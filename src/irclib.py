@@ -30,10 +30,12 @@
 import re
 import copy
 import time
+import heapq
 import random
 import base64
 import textwrap
 import warnings
+import itertools
 import collections
 
 try:
@@ -53,10 +55,9 @@ try:
 except ImportError:
     scram = None
 
-from . import conf, ircdb, ircmsgs, ircutils, log, utils, world
+from . import conf, drivers, ircdb, ircmsgs, ircutils, log, utils, world
 from .utils.str import rsplit
-from .utils.iter import chain
-from .utils.structures import smallqueue, RingBuffer
+from .utils.structures import smallqueue, CacheDict, RingBuffer, TokenBucket
 
 MAX_LINE_SIZE = 512 # Including \r\n
 
@@ -185,25 +186,27 @@ class IrcCallback(IrcCommandDispatcher, log.Firewalled):
         pass
 
 ###
-# Basic queue for IRC messages.  It doesn't presently (but should at some
-# later point) reorder messages based on priority or penalty calculations.
+# Basic queue for IRC messages.  Messages are ordered by priority class first,
+# and then served round-robin between their targets, so a plugin flooding a
+# channel does not delay replies to everyone else.
 ###
 _high = frozenset(['MODE', 'KICK', 'PONG', 'NICK', 'PASS', 'CAPAB', 'REMOVE'])
 _low = frozenset(['PRIVMSG', 'PING', 'WHO', 'NOTICE', 'JOIN'])
 class IrcMsgQueue(object):
-    """Class for a queue of IrcMsgs.  Eventually, it should be smart.
+    """Class for a queue of IrcMsgs.
 
-    Probably smarter than it is now, though it's gotten quite a bit smarter
-    than it originally was.  A method to "score" methods, and a heapq to
-    maintain a priority queue of the messages would be the ideal way to do
-    intelligent queuing.
+    We keep track of 'high priority' messages, 'low priority' messages, and
+    normal messages, and make sure to return the 'high priority' ones before
+    the normal ones before the 'low priority' ones.
 
-    As it stands, however, we simply keep track of 'high priority' messages,
-    'low priority' messages, and normal messages, and just make sure to return
-    the 'high priority' ones before the normal ones before the 'low priority'
-    ones.
+    Within a priority class, messages are grouped by target (their first
+    argument), and targets take turns: the n-th pending message of a target is
+    scheduled in the n-th round after the current one.  All of this is kept in
+    a single heap of (priority, turn, sequence number, message) entries,
+    which keeps messages of a given target in FIFO order.
     """
-    __slots__ = ('msgs', 'highpriority', 'normal', 'lowpriority', 'lastJoin')
+    __slots__ = ('_heap', '_msgs', '_turns', '_targetTurns', '_counter',
+                 'lastJoin')
     def __init__(self, iterable=()):
         self.reset()
         for msg in iterable:
@@ -212,9 +215,36 @@ class IrcMsgQueue(object):
     def reset(self):
         """Clears the queue."""
         self.lastJoin = 0
-        self.highpriority = smallqueue()
-        self.normal = smallqueue()
-        self.lowpriority = smallqueue()
+        self._heap = []
+        self._msgs = collections.Counter()
+        self._turns = [0, 0, 0]
+        self._targetTurns = {}
+        self._counter = itertools.count()
+
+    @staticmethod
+    def _priority(msg):
+        if msg.command in _high:
+            return 0
+        elif msg.command in _low:
+            return 2
+        else:
+            return 1
+
+    def _push(self, msg):
+        priority = self._priority(msg)
+        key = (priority, ircutils.toLower(msg.args[0]) if msg.args else '')
+        turn = max(self._targetTurns.get(key, 0), self._turns[priority]) + 1
+        self._targetTurns[key] = turn
+        heapq.heappush(self._heap, (priority, turn, next(self._counter), msg))
+
+    def _pop(self):
+        (priority, turn, _, msg) = heapq.heappop(self._heap)
+        self._turns[priority] = turn
+        key = (priority, ircutils.toLower(msg.args[0]) if msg.args else '')
+        if self._targetTurns.get(key) == turn:
+            # That was the last pending message for this target.
+            del self._targetTurns[key]
+        return msg
 
     def enqueue(self, msg):
         """Enqueues a given message."""
@@ -224,50 +254,43 @@ class IrcMsgQueue(object):
             log.info('Not adding message %q to queue, already added.', s)
             return False
         else:
-            if msg.command in _high:
-                self.highpriority.enqueue(msg)
-            elif msg.command in _low:
-                self.lowpriority.enqueue(msg)
-            else:
-                self.normal.enqueue(msg)
+            self._push(msg)
+            self._msgs[msg] += 1
             return True
 
     def dequeue(self):
         """Dequeues a given message."""
-        msg = None
-        if self.highpriority:
-            msg = self.highpriority.dequeue()
-        elif self.normal:
-            msg = self.normal.dequeue()
-        elif self.lowpriority:
-            msg = self.lowpriority.dequeue()
-            if msg.command == 'JOIN':
-                limit = conf.supybot.protocols.irc.queuing.rateLimit.join()
-                now = time.time()
-                if self.lastJoin + limit <= now:
-                    self.lastJoin = now
-                else:
-                    self.lowpriority.enqueue(msg)
-                    msg = None
+        if not self._heap:
+            return None
+        msg = self._pop()
+        if msg.command == 'JOIN':
+            limit = conf.supybot.protocols.irc.queuing.rateLimit.join()
+            now = time.time()
+            if self.lastJoin + limit <= now:
+                self.lastJoin = now
+            else:
+                self._push(msg)
+                return None
+        count = self._msgs[msg] - 1
+        if count:
+            self._msgs[msg] = count
+        else:
+            del self._msgs[msg]
         return msg
 
     def __contains__(self, msg):
-        return msg in self.normal or \
-               msg in self.lowpriority or \
-               msg in self.highpriority
+        return msg in self._msgs
 
     def __bool__(self):
-        return bool(self.highpriority or self.normal or self.lowpriority)
+        return bool(self._heap)
     __nonzero__ = __bool__
 
     def __len__(self):
-        return len(self.highpriority)+len(self.lowpriority)+len(self.normal)
+        return len(self._heap)
 
     def __repr__(self):
         name = self.__class__.__name__
-        return '%s(%r)' % (name, list(chain(self.highpriority,
-                                            self.normal,
-                                            self.lowpriority)))
+        return '%s(%r)' % (name, [entry[-1] for entry in sorted(self._heap)])
     __str__ = __repr__
 
 
@@ -389,6 +412,74 @@ class ChannelState(utils.python.Object):
 
 Batch = collections.namedtuple('Batch', 'type arguments messages')
 
+def _msgChannel(msg):
+    channel = msg.channel
+    if channel is None and msg.args and ircutils.isChannel(msg.args[0]):
+        # Outgoing messages don't have their channel set.
+        channel = msg.args[0]
+    return channel
+
+def _lastMsgs(msgs, nick=None, predicate=None, limit=None):
+    ret = []
+    for msg in msgs:
+        if nick is not None and not ircutils.nickEqual(msg.nick, nick):
+            continue
+        if predicate is not None and not predicate(msg):
+            continue
+        ret.append(msg)
+        if limit is not None and len(ret) >= limit:
+            break
+    return ret
+
+class ChannelHistory(object):
+    """Keeps the most recent messages of each channel, and optionally of each
+    nick in each channel, in their own ring buffers.  Only the buffers of the
+    <maxNicks> most recently active nicks of each channel are kept.
+
+    Messages are stored by reference, so they share their memory with the
+    global history."""
+    def __init__(self, channelLength, nickLength=0, maxNicks=100):
+        self.channelLength = channelLength
+        self.nickLength = nickLength
+        self.maxNicks = maxNicks
+        self.channels = ircutils.IrcDict()
+        self.nicks = ircutils.IrcDict()
+
+    def append(self, channel, msg):
+        try:
+            self.channels[channel].append(msg)
+        except KeyError:
+            self.channels[channel] = RingBuffer(self.channelLength, [msg])
+        if self.nickLength and msg.prefix:
+            try:
+                nicks = self.nicks[channel]
+            except KeyError:
+                nicks = self.nicks[channel] = CacheDict(self.maxNicks)
+            nick = ircutils.toLower(msg.nick)
+            try:
+                nicks[nick].append(msg)
+            except KeyError:
+                nicks[nick] = RingBuffer(self.nickLength, [msg])
+
+    def remove(self, channel):
+        """Forgets the messages of <channel>."""
+        self.channels.pop(channel, None)
+        self.nicks.pop(channel, None)
+
+    def last(self, channel, nick=None, predicate=None, limit=None):
+        """Returns the most recent messages of <channel>, newest first.  See
+        IrcState.last."""
+        if nick is not None and self.nickLength:
+            nicks = self.nicks.get(channel, {})
+            msgs = nicks.get(ircutils.toLower(nick))
+            if msgs is not None:
+                return _lastMsgs(reversed(msgs), None, predicate, limit)
+            # The buffer of that nick may have been dropped, while some of
+            # its messages are still in the channel's.
+        msgs = self.channels.get(channel, ())
+        return _lastMsgs(reversed(msgs), nick, predicate, limit)
+
+
 class IrcState(IrcCommandDispatcher, log.Firewalled):
     """Maintains state of the Irc connection.  Should also become smarter.
     """
@@ -411,14 +502,25 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         self.ircd = None
         self.supported = supported
         self.history = history
+        self.channelHistory = self._makeChannelHistory()
         self.channels = channels
         self.nicksToHostmasks = nicksToHostmasks
         self.batches = {}
 
+    def _makeChannelHistory(self):
+        channelLength = conf.supybot.protocols.irc.maxChannelHistoryLength()
+        if channelLength:
+            nickLength = conf.supybot.protocols.irc.maxNickHistoryLength()
+            maxNicks = conf.supybot.protocols.irc.maxNickHistoryLength.nicks()
+            return ChannelHistory(channelLength, nickLength, maxNicks)
+        else:
+            return None
+
     def reset(self):
         """Resets the state to normal, unconnected state."""
         self.history.reset()
         self.history.resize(conf.supybot.protocols.irc.maxHistoryLength())
+        self.channelHistory = self._makeChannelHistory()
         self.ircd = None
         self.channels.clear()
         self.supported.clear()
@@ -445,6 +547,7 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def copy(self):
         ret = self.__class__()
         ret.history = copy.deepcopy(self.history)
+        ret.channelHistory = copy.deepcopy(self.channelHistory)
         ret.nicksToHostmasks = copy.deepcopy(self.nicksToHostmasks)
         ret.channels = copy.deepcopy(self.channels)
         ret.batches = copy.deepcopy(self.batches)
@@ -453,6 +556,10 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
     def addMsg(self, irc, msg):
         """Updates the state based on the irc object and the message."""
         self.history.append(msg)
+        if self.channelHistory is not None:
+            channel = _msgChannel(msg)
+            if channel is not None:
+                self.channelHistory.append(channel, msg)
         if ircutils.isUserHostmask(msg.prefix) and not msg.command == 'NICK':
             self.nicksToHostmasks[msg.nick] = msg.prefix
         if 'batch' in msg.server_tags:
@@ -464,6 +571,22 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         if method is not None:
             method(irc, msg)
 
+    def last(self, channel, nick=None, predicate=None, limit=None):
+        """Returns the most recent messages sent to <channel>, newest first.
+        If <nick> is given, only messages from <nick> are returned; if
+        <predicate> is given, only the messages it returns true for.  At most
+        <limit> messages are returned, if given.
+
+        This uses the per-channel history if it is enabled (see
+        supybot.protocols.irc.maxChannelHistoryLength), and scans the global
+        history otherwise."""
+        if self.channelHistory is not None:
+            return self.channelHistory.last(channel, nick, predicate, limit)
+        def inChannel(msg):
+            return ircutils.strEqual(_msgChannel(msg) or '', channel) and \
+                    (predicate is None or predicate(msg))
+        return _lastMsgs(reversed(self.history), nick, inChannel, limit)
+
     def getTopic(self, channel):
         """Returns the topic for a given channel."""
         return self.channels[channel].topic
@@ -654,6 +777,8 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
                 continue
             if ircutils.strEqual(msg.nick, irc.nick):
                 del self.channels[channel]
+                if self.channelHistory is not None:
+                    self.channelHistory.remove(channel)
             else:
                 chan.removeUser(msg.nick)
 
@@ -663,6 +788,8 @@ class IrcState(IrcCommandDispatcher, log.Firewalled):
         for user in users.split(','):
             if ircutils.strEqual(user, irc.nick):
                 del self.channels[channel]
+                if self.channelHistory is not None:
+                    self.channelHistory.remove(channel)
                 return
             else:
                 chan.removeUser(user)
@@ -745,7 +872,8 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
     """
     __firewalled__ = {'die': None,
                       'feedMsg': None,
-                      'takeMsg': None,}
+                      'takeMsg': None,
+                      'takeMsgs': lambda self: [],}
     _nickSetters = set(['001', '002', '003', '004', '250', '251', '252',
                         '254', '255', '265', '266', '372', '375', '376',
                         '333', '353', '332', '366', '005'])
@@ -846,7 +974,9 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
     def queueMsg(self, msg):
         """Queues a message to be sent to the server."""
         if not self.zombie:
-            return self.queue.enqueue(msg)
+            ret = self.queue.enqueue(msg)
+            drivers.wakeup()
+            return ret
         else:
             log.warning('Refusing to queue %r; %s is a zombie.', msg, self)
             return False
@@ -855,19 +985,18 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         """Queues a message to be sent to the server *immediately*"""
         if not self.zombie:
             self.fastqueue.enqueue(msg)
+            drivers.wakeup()
         else:
             log.warning('Refusing to send %r; %s is a zombie.', msg, self)
 
-    def takeMsg(self):
-        """Called by the IrcDriver; takes a message to be sent."""
-        if not self.callbacks:
-            log.critical('No callbacks in %s.', self)
-        now = time.time()
+    def _dequeueMsg(self, now):
+        """Returns the next message that may be sent, before it goes through
+        out-filters, or None."""
         msg = None
         if self.fastqueue:
             msg = self.fastqueue.dequeue()
         elif self.queue:
-            if now-self.lastTake <= conf.supybot.protocols.irc.throttleTime():
+            if not self.throttle.take(now):
                 log.debug('Irc.takeMsg throttling.')
             else:
                 self.lastTake = now
@@ -886,15 +1015,31 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
                 now = str(int(now))
                 self.outstandingPing = True
                 self.queueMsg(ircmsgs.ping(now))
-        if msg:
-            for callback in reversed(self.callbacks):
+        return msg
+
+    def _filterMsgs(self, msgs):
+        """Runs a batch of messages through the outFilter of every callback,
+        and returns those that are left."""
+        for callback in reversed(self.callbacks):
+            filtered = []
+            for msg in msgs:
                 self._setMsgChannel(msg)
-                msg = callback.outFilter(self, msg)
+                try:
+                    msg = callback.outFilter(self, msg)
+                except Exception:
+                    # Drop that message only, not the rest of the batch.
+                    log.exception('Uncaught exception in %s.outFilter:',
+                                  callback.name())
+                    continue
                 if msg is None:
                     log.debug('%s.outFilter returned None.', callback.name())
-                    return self.takeMsg()
-                world.debugFlush()
-            if len(str(msg)) > MAX_LINE_SIZE:
+                else:
+                    filtered.append(msg)
+            msgs = filtered
+            world.debugFlush()
+        for msg in msgs:
+            s = str(msg)
+            if len(s) > MAX_LINE_SIZE:
                 # Yes, this violates the contract, but at this point it doesn't
                 # matter.  That's why we gotta go munging in private attributes
                 #
@@ -903,23 +1048,53 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
                 # this issue, there's no fundamental reason to make it a
                 # warning.
                 log.debug('Truncating %r, message is too long.', msg)
-                msg._str = msg._str[:MAX_LINE_SIZE-2] + '\r\n'
-                msg._len = len(str(msg))
+                s = msg._str = s[:MAX_LINE_SIZE-2] + '\r\n'
+                msg._len = len(s)
             # I don't think we should do this.  Why should it matter?  If it's
             # something important, then the server will send it back to us,
             # and if it's just a privmsg/notice/etc., we don't care.
             # On second thought, we need this for testing.
             if world.testing:
                 self.state.addMsg(self, msg)
-            log.debug('Outgoing message (%s): %s', self.network, str(msg).rstrip('\r\n'))
-            return msg
-        elif self.zombie:
+            log.debug('Outgoing message (%s): %s', self.network, s.rstrip('\r\n'))
+        return msgs
+
+    def _dieIfZombie(self):
+        if self.zombie:
             # We kill the driver here so it doesn't continue to try to
             # take messages from us.
             self.driver.die()
             self._reallyDie()
+
+    def takeMsg(self):
+        """Called by the IrcDriver; takes a message to be sent."""
+        if not self.callbacks:
+            log.critical('No callbacks in %s.', self)
+        msg = self._dequeueMsg(time.time())
+        while msg is not None:
+            msgs = self._filterMsgs([msg])
+            if msgs:
+                return msgs[0]
+            msg = self._dequeueMsg(time.time())
+        self._dieIfZombie()
+        return None
+
+    def takeMsgs(self):
+        """Called by the IrcDriver; takes all the messages that may be sent
+        right now, and runs them through out-filters as a single batch."""
+        if not self.callbacks:
+            log.critical('No callbacks in %s.', self)
+        now = time.time()
+        msgs = []
+        msg = self._dequeueMsg(now)
+        while msg is not None:
+            msgs.append(msg)
+            msg = self._dequeueMsg(now)
+        if msgs:
+            msgs = self._filterMsgs(msgs)
         else:
-            return None
+            self._dieIfZombie()
+        return msgs
 
     def _tagMsg(self, msg):
         """Sets attribute on an incoming IRC message. Will usually only be
@@ -1049,6 +1224,8 @@ class Irc(IrcCommandDispatcher, log.Firewalled):
         self.prefix = '%s!%s@%s' % (self.nick, self.ident, 'unset.domain')
         # The rest.
         self.lastTake = 0
+        throttleTime = conf.supybot.protocols.irc.throttleTime
+        self.throttle = TokenBucket(throttleTime, throttleTime.burst)
         self.server = 'unset'
         self.afterConnect = False
         self.startedAt = time.time()
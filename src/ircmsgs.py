@@ -38,7 +38,7 @@ object (which, as you'll read later, is quite...full-featured :))
 import re
 import time
 import base64
-import datetime
+import calendar
 import warnings
 import functools
 
@@ -73,13 +73,26 @@ def parse_server_tags(s):
             server_tags[tag] = None
         else:
             (key, value) = tag.split('=', 1)
-            value = unescape_server_tag_value(value)
+            if '\\' in value:
+                value = unescape_server_tag_value(value)
             if value == '':
                 # "Implementations MUST interpret empty tag values (e.g. foo=)
                 # as equivalent to missing tag values (e.g. foo)."
                 value = None
             server_tags[key] = value
     return server_tags
+_server_time_re = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(\.\d+)?Z$')
+def parse_server_time(s):
+    """Returns the timestamp of a server-time tag value, like
+    2011-10-19T16:40:51.620Z.  Raises ValueError if it is malformed."""
+    m = _server_time_re.match(s)
+    if m is None:
+        raise ValueError('Invalid server time: %r' % s)
+    fraction = m.group(7)
+    timestamp = calendar.timegm(tuple(map(int, m.group(1, 2, 3, 4, 5, 6))))
+    return timestamp + float(fraction) if fraction else float(timestamp)
+
 def format_server_tags(server_tags):
     parts = []
     for (key, value) in server_tags.items():
@@ -119,9 +132,13 @@ class IrcMsg(object):
     # It's too useful to be able to tag IrcMsg objects with extra, unforeseen
     # data.  Goodbye, __slots__.
     # On second thought, let's use methods for tagging.
+    # nick, user, host, server_tags, and time of parsed messages are only
+    # computed when first accessed (see __getattr__), as most messages never
+    # have them read.
     __slots__ = ('args', 'command', 'host', 'nick', 'prefix', 'user',
                  '_hash', '_str', '_repr', '_len', 'tags', 'reply_env',
-                 'server_tags', 'time', 'channel')
+                 'server_tags', 'time', 'channel',
+                 '_raw_server_tags', '_received_at')
     def __init__(self, s='', command='', args=(), prefix='', msg=None,
             reply_env=None):
         assert not (msg and s), 'IrcMsg.__init__ cannot accept both s and msg'
@@ -141,9 +158,11 @@ class IrcMsg(object):
                 self._str = s
                 if s[0] == '@':
                     (server_tags, s) = s.split(' ', 1)
-                    self.server_tags = parse_server_tags(server_tags[1:])
+                    self._raw_server_tags = server_tags[1:]
+                    self._received_at = time.time()
                 else:
                     self.server_tags = {}
+                    self.time = time.time()
                 if s[0] == ':':
                     self.prefix, s = s[1:].split(None, 1)
                 else:
@@ -155,13 +174,6 @@ class IrcMsg(object):
                 else:
                     self.args = s.split()
                 self.command = self.args.pop(0)
-                if 'time' in self.server_tags:
-                    s = self.server_tags['time']
-                    date = datetime.datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%fZ')
-                    date = minisix.make_datetime_utc(date)
-                    self.time = minisix.datetime__timestamp(date)
-                else:
-                    self.time = time.time()
             except (IndexError, ValueError):
                 raise MalformedIrcMsg(repr(originalString))
         else:
@@ -195,10 +207,6 @@ class IrcMsg(object):
                 self.time = None
                 self.server_tags = {}
         self.args = tuple(self.args)
-        if isUserHostmask(self.prefix):
-            (self.nick,self.user,self.host)=ircutils.splitHostmask(self.prefix)
-        else:
-            (self.nick, self.user, self.host) = (self.prefix,)*3
 
     def __str__(self):
         if self._str is not None:
@@ -271,6 +279,22 @@ class IrcMsg(object):
         if attr.startswith('__'): # Since PEP 487, Python calls __set_name__
             raise AttributeError("'%s' object has no attribute '%s'" %
                     (self.__class__.__name__, attr))
+        if attr in ('nick', 'user', 'host'):
+            if isUserHostmask(self.prefix):
+                (self.nick, self.user, self.host) = \
+                        ircutils.splitHostmask(self.prefix)
+            else:
+                (self.nick, self.user, self.host) = (self.prefix,)*3
+            return getattr(self, attr)
+        elif attr == 'server_tags':
+            self.server_tags = parse_server_tags(self._raw_server_tags)
+            return self.server_tags
+        elif attr == 'time':
+            try:
+                self.time = parse_server_time(self.server_tags['time'])
+            except (KeyError, ValueError):
+                self.time = self._received_at
+            return self.time
         if attr in self.tags:
             warnings.warn("msg.<tagname> is deprecated. Use "
                     "msg.tagged('<tagname>') or msg.tags['<tagname>']"
@@ -41,6 +41,7 @@ from __future__ import print_function
 import re
 import sys
 import time
+import heapq
 import base64
 import random
 import string
@@ -167,35 +168,38 @@ def areReceivers(s, strictRfc=True, nicklen=None, chantypes='#&!',
             channellen=channellen)
     return all([nick(x) or chan(x) for x in s.split(',')])
 
-_patternCache = utils.structures.CacheDict(1000)
+def _hostmaskPatternRegexp(pattern):
+    # We make our own regexps, rather than use fnmatch, because fnmatch's
+    # case-insensitivity is not IRC's case-insensitity.
+    fd = minisix.io.StringIO()
+    for c in pattern:
+        if c == '*':
+            fd.write('.*')
+        elif c == '?':
+            fd.write('.')
+        elif c in '[{':
+            fd.write(r'[\[{]')
+        elif c in '}]':
+            fd.write(r'[}\]]')
+        elif c in '|\\':
+            fd.write(r'[|\\]')
+        elif c in '^~':
+            fd.write('[~^]')
+        else:
+            fd.write(re.escape(c))
+    return fd.getvalue()
+
+_patternCache = utils.structures.CacheDict(1000, 'hostmaskPatterns')
 def _hostmaskPatternEqual(pattern, hostmask):
     try:
         return _patternCache[pattern](hostmask) is not None
     except KeyError:
-        # We make our own regexps, rather than use fnmatch, because fnmatch's
-        # case-insensitivity is not IRC's case-insensitity.
-        fd = minisix.io.StringIO()
-        for c in pattern:
-            if c == '*':
-                fd.write('.*')
-            elif c == '?':
-                fd.write('.')
-            elif c in '[{':
-                fd.write(r'[\[{]')
-            elif c in '}]':
-                fd.write(r'[}\]]')
-            elif c in '|\\':
-                fd.write(r'[|\\]')
-            elif c in '^~':
-                fd.write('[~^]')
-            else:
-                fd.write(re.escape(c))
-        fd.write('$')
-        f = re.compile(fd.getvalue(), re.I).match
+        f = re.compile(_hostmaskPatternRegexp(pattern) + '$', re.I).match
         _patternCache[pattern] = f
         return f(hostmask) is not None
 
-_hostmaskPatternEqualCache = utils.structures.CacheDict(1000)
+_hostmaskPatternEqualCache = utils.structures.CacheDict(1000,
+                                                        'hostmaskMatches')
 def hostmaskPatternEqual(pattern, hostmask):
     """pattern, hostmask => bool
     Returns True if hostmask matches the hostmask pattern pattern."""
@@ -206,6 +210,157 @@ def hostmaskPatternEqual(pattern, hostmask):
         _hostmaskPatternEqualCache[(pattern, hostmask)] = b
         return b
 
+# Only ASCII characters are used as keys, as they are the only ones toLower
+# normalizes the same way _hostmaskPatternEqual compares them.
+_hostmaskHeadRe = re.compile(r'[^*?\x80-\U0010ffff]*')
+_hostmaskTailRe = re.compile(r'[^*?\x80-\U0010ffff]*\Z')
+class HostmaskIndex(object):
+    """Maps hostmask patterns to values, and returns the values whose
+    patterns may match a given hostmask without trying each pattern.
+
+    Patterns are bucketed by the literal text after their last wildcard
+    (usually '@' and the host suffix) or before their first one (usually
+    the nick), whichever is longer.  Patterns with neither are always
+    candidates.  Candidates still have to be checked with
+    hostmaskPatternEqual."""
+    __slots__ = ('_heads', '_tails', '_wildcards')
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # {length: {literal text: {value: number of patterns}}}
+        self._heads = {}
+        self._tails = {}
+        self._wildcards = {}
+
+    def _bucket(self, pattern, create):
+        pattern = toLower(pattern)
+        head = _hostmaskHeadRe.match(pattern).group()
+        tail = _hostmaskTailRe.search(pattern).group()
+        if tail and len(tail) >= len(head):
+            (buckets, key) = (self._tails, tail)
+        elif head:
+            (buckets, key) = (self._heads, head)
+        else:
+            return (None, None, self._wildcards)
+        if create:
+            byKey = buckets.setdefault(len(key), {})
+            return (buckets, key, byKey.setdefault(key, {}))
+        else:
+            return (buckets, key, buckets[len(key)][key])
+
+    def add(self, pattern, value):
+        """Adds value to the values of pattern.  A value added n times for
+        the same pattern has to be removed n times."""
+        (_, _, bucket) = self._bucket(pattern, create=True)
+        bucket[value] = bucket.get(value, 0) + 1
+
+    def remove(self, pattern, value):
+        """Removes value from the values of pattern.  Raises KeyError if
+        it was not added."""
+        (buckets, key, bucket) = self._bucket(pattern, create=False)
+        if bucket[value] > 1:
+            bucket[value] -= 1
+            return
+        del bucket[value]
+        if not bucket and buckets is not None:
+            byKey = buckets[len(key)]
+            del byKey[key]
+            if not byKey:
+                del buckets[len(key)]
+
+    def candidates(self, hostmask):
+        """Returns the set of values whose patterns may match hostmask."""
+        hostmask = toLower(hostmask)
+        values = set(self._wildcards)
+        for (length, byKey) in self._heads.items():
+            bucket = byKey.get(hostmask[:length])
+            if bucket:
+                values.update(bucket)
+        for (length, byKey) in self._tails.items():
+            bucket = byKey.get(hostmask[-length:])
+            if bucket:
+                values.update(bucket)
+        return values
+
+class ExpiringHostmaskDict(dict):
+    """A dictionary mapping hostmask patterns to the time they expire at (or
+    0 if they never expire), used for bans and ignores.
+
+    match() checks a hostmask against all the patterns with a single regexp,
+    compiled again after the patterns change, and expirations are kept in a
+    heap so expire() only looks at the patterns which did expire."""
+    __slots__ = ('_match', '_expirations')
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self._match = None
+        self._expirations = [] # heap of (expiration, pattern)
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __setitem__(self, pattern, expiration):
+        dict.__setitem__(self, pattern, expiration)
+        self._match = None
+        if expiration:
+            heapq.heappush(self._expirations, (expiration, pattern))
+
+    def __delitem__(self, pattern):
+        dict.__delitem__(self, pattern)
+        self._match = None
+
+    def pop(self, pattern, *args):
+        self._match = None
+        return dict.pop(self, pattern, *args)
+
+    def popitem(self):
+        self._match = None
+        return dict.popitem(self)
+
+    def setdefault(self, pattern, expiration=0):
+        if pattern not in self:
+            self[pattern] = expiration
+        return self[pattern]
+
+    def update(self, *args, **kwargs):
+        for (pattern, expiration) in dict(*args, **kwargs).items():
+            self[pattern] = expiration
+
+    def clear(self):
+        dict.clear(self)
+        self._match = None
+        self._expirations = []
+
+    def expire(self, now=None):
+        """Removes the patterns which expired before now (defaults to the
+        current time), and returns them as a list of (pattern, expiration)
+        pairs."""
+        if now is None:
+            now = time.time()
+        expired = []
+        heap = self._expirations
+        while heap and heap[0][0] < now:
+            (expiration, pattern) = heapq.heappop(heap)
+            # The pattern may have been removed or given another expiration
+            # since it was pushed.
+            if dict.get(self, pattern) == expiration:
+                del self[pattern]
+                expired.append((pattern, expiration))
+        return expired
+
+    def match(self, hostmask):
+        """Returns whether hostmask matches one of the patterns, including
+        expired ones which were not removed by expire() yet."""
+        if not self:
+            return False
+        # Read self._match only once, as another thread may reset it.
+        match = self._match
+        if match is None:
+            regexp = '|'.join(map(_hostmaskPatternRegexp, self))
+            match = self._match = re.compile('(?:%s)$' % regexp, re.I).match
+        return match(hostmask) is not None
+
 def banmask(hostmask):
     """Returns a properly generic banning hostmask for a hostmask.
 
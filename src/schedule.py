@@ -89,6 +89,7 @@ class Schedule(drivers.IrcDriver):
         with self.lock:
             self.events[name] = f
             heapq.heappush(self.schedule, mytuple((t, name, args, kwargs)))
+        drivers.wakeup()
         return name
 
     def removeEvent(self, name):
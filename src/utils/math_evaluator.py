@@ -189,3 +189,60 @@ class SafeEvalVisitor(ast.NodeVisitor):
 def safe_eval(text, allow_ints, variables=None):
     node = ast.parse(text, mode='eval')
     return SafeEvalVisitor(allow_ints, variables=variables).visit(node)
+
+
+def _call(f, *args):
+    return f(*args)
+
+class SafeCompileVisitor(SafeEvalVisitor):
+    """Compiles an expression to a function taking a dict mapping each
+    variable to a column (a sequence of its values, all columns having the
+    same length n) and n, and returning the list of the values of the
+    expression for each row."""
+    def __init__(self, allow_ints, variables):
+        super(SafeCompileVisitor, self).__init__(allow_ints)
+        self._variables = frozenset(variables)
+
+    def visit_Num(self, node):
+        x = self._convert_num(node.n)
+        return lambda columns, n: [x] * n
+
+    def visit_Name(self, node):
+        id_ = node.id.lower()
+        if id_ in self._variables:
+            return lambda columns, n: columns[id_]
+        elif id_ in self._env:
+            x = self._env[id_]
+            return lambda columns, n: [x] * n
+        else:
+            raise NameError(node.id)
+
+    def visit_Call(self, node):
+        func = self.visit(node.func)
+        args = [self.visit(arg) for arg in node.args]
+        return lambda columns, n: list(map(_call, func(columns, n),
+                                           *[arg(columns, n) for arg in args]))
+
+    def visit_UnaryOp(self, node):
+        op = UNARY_OPS.get(node.op.__class__)
+        if op:
+            operand = self.visit(node.operand)
+            return lambda columns, n: list(map(op, operand(columns, n)))
+        else:
+            raise InvalidNode('illegal operator %s' % node.op.__class__.__name__)
+
+    def visit_BinOp(self, node):
+        op = BIN_OPS.get(node.op.__class__)
+        if op:
+            left = self.visit(node.left)
+            right = self.visit(node.right)
+            return lambda columns, n: list(map(op, left(columns, n),
+                                               right(columns, n)))
+        else:
+            raise InvalidNode('illegal operator %s' % node.op.__class__.__name__)
+
+def safe_compile(text, allow_ints, variables):
+    """Parses and checks the expression <text> once, so it can then be
+    evaluated on many rows of <variables> at once; see SafeCompileVisitor."""
+    node = ast.parse(text, mode='eval')
+    return SafeCompileVisitor(allow_ints, variables).visit(node)
@@ -32,6 +32,7 @@ Data structures for Python.
 """
 
 import time
+import weakref
 import collections.abc
 
 
@@ -358,6 +359,71 @@ class TimeoutQueue(object):
         self._clearOldElements()
         return len(self.queue)
 
+class TokenBucket(object):
+    """Rate limiter allowing up to `burst` events at once, and one more event
+    every `period` seconds after that.  Both `period` and `burst` may be
+    callables (eg. registry values), in which case they are read each time
+    they are needed."""
+    __slots__ = ('period', 'burst', 'tokens', 'last')
+    def __init__(self, period, burst=1):
+        self.period = period
+        self.burst = burst
+        self.reset()
+
+    def reset(self):
+        """Refills the bucket."""
+        self.tokens = None
+        self.last = None
+
+    def __repr__(self):
+        return '%s(period=%r, burst=%r)' % (self.__class__.__name__,
+                                            self._getPeriod(),
+                                            self._getBurst())
+
+    def _getPeriod(self):
+        if callable(self.period):
+            return self.period()
+        else:
+            return self.period
+
+    def _getBurst(self):
+        if callable(self.burst):
+            return self.burst()
+        else:
+            return self.burst
+
+    def _refill(self, now):
+        period = self._getPeriod()
+        burst = max(self._getBurst(), 1)
+        if self.tokens is None or period <= 0:
+            self.tokens = burst
+        else:
+            elapsed = max(now - self.last, 0)
+            self.tokens = min(burst, self.tokens + elapsed/period)
+        self.last = now
+
+    def take(self, now=None):
+        """Consumes a token and returns True if one is available, returns
+        False otherwise."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        else:
+            return False
+
+    def delay(self, now=None):
+        """Returns the number of seconds until a token is available."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        else:
+            return (1 - self.tokens) * self._getPeriod()
+
 class MaxLengthQueue(queue):
     __slots__ = ('length',)
     def __init__(self, length, seq=()):
@@ -428,17 +494,56 @@ class MultiSet(object):
 
 
 class CacheDict(collections.abc.MutableMapping):
-    __slots__ = ('d', 'max')
-    def __init__(self, max, **kwargs):
-        self.d = dict(**kwargs)
+    """A dictionary holding at most max items.  When it is full, the least
+    recently used item is removed to make room for a new one.
+
+    Lookups are counted in the hits and misses attributes, and items removed
+    to make room for new ones in the evictions attribute.  Caches given a name are listed by CacheDict.named()."""
+    __slots__ = ('d', 'max', 'name', 'hits', 'misses', 'evictions',
+                 '__weakref__')
+    _named = weakref.WeakValueDictionary() # {id(cache): cache}
+    def __init__(self, max, name=None, **kwargs):
+        self.d = collections.OrderedDict(**kwargs)
+        self.max = max
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if name is not None:
+            self._named[id(self)] = self
+
+    def __repr__(self):
+        return 'CacheDict(%r, name=%r)' % (self.max, self.name)
+
+    @classmethod
+    def named(cls):
+        """Returns the caches that were given a name, sorted by name."""
+        return sorted(cls._named.values(), key=lambda cache: cache.name)
+
+    def resize(self, max):
+        """Sets the maximum number of items, removing the least recently
+        used ones if there are too many."""
         self.max = max
+        while len(self.d) > max:
+            self.d.popitem(last=False)
+            self.evictions += 1
 
     def __getitem__(self, key):
-        return self.d[key]
+        try:
+            value = self.d[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self.d.move_to_end(key)
+        return value
 
     def __setitem__(self, key, value):
-        if len(self.d) >= self.max:
-            self.d.clear()
+        if key in self.d:
+            self.d.move_to_end(key)
+        elif len(self.d) >= self.max:
+            self.d.popitem(last=False)
+            self.evictions += 1
         self.d[key] = value
 
     def __delitem__(self, key):
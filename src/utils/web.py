@@ -28,9 +28,18 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import io
+import os
 import re
+import json
+import time
 import base64
 import socket
+import hashlib
+import threading
+import collections
+import email.message
+import email.utils
 
 sockerrors = (socket.error,)
 try:
@@ -44,12 +53,16 @@ from . import minisix
 if minisix.PY2:
     import urllib
     import urllib2
+    import httplib as http_client
     from httplib import InvalidURL
     from urlparse import urlsplit, urlunsplit, urlparse
     from htmlentitydefs import entitydefs, name2codepoint
     from HTMLParser import HTMLParser
     from cgi import escape as html_escape
     Request = urllib2.Request
+    HTTPHandler = urllib2.HTTPHandler
+    HTTPSHandler = urllib2.HTTPSHandler
+    build_opener = urllib2.build_opener
     urlquote = urllib.quote
     urlquote_plus = urllib.quote_plus
     urlunquote = urllib.unquote
@@ -59,6 +72,7 @@ if minisix.PY2:
     from urllib2 import HTTPError, URLError
     from urllib import splithost, splituser
 else:
+    import http.client as http_client
     from http.client import InvalidURL
     from urllib.parse import urlsplit, urlunsplit, urlparse
     from html.entities import entitydefs, name2codepoint
@@ -66,6 +80,9 @@ else:
     from html import escape as html_escape
     import urllib.request, urllib.parse, urllib.error
     Request = urllib.request.Request
+    HTTPHandler = urllib.request.HTTPHandler
+    HTTPSHandler = urllib.request.HTTPSHandler
+    build_opener = urllib.request.build_opener
     urlquote = urllib.parse.quote
     urlquote_plus = urllib.parse.quote_plus
     urlunquote = urllib.parse.unquote
@@ -127,6 +144,431 @@ defaultHeaders = baseDefaultHeaders.copy()
 # application-specific function.  Feel free to use a callable here.
 proxy = None
 
+# Maximum number of bytes getUrlTargetAndContent reads when it isn't given a
+# size; None means no limit.  Overridable by other modules.
+maxResponseSize = None
+
+class ConnectionPool(object):
+    """Keeps the idle persistent connections of finished requests, so the
+    following requests to the same host can reuse them, and limits how many
+    requests are made at the same time."""
+    def __init__(self, maxConnections=16, maxIdleConnections=4):
+        self.maxIdleConnections = maxIdleConnections
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.setMaxConnections(maxConnections)
+
+    def setMaxConnections(self, maxConnections):
+        self.semaphore = threading.BoundedSemaphore(maxConnections)
+
+    def get(self, key):
+        with self.lock:
+            connections = self.connections.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def put(self, key, connection):
+        with self.lock:
+            connections = self.connections.setdefault(key, [])
+            if len(connections) < self.maxIdleConnections:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = {}
+        for L in connections.values():
+            for connection in L:
+                connection.close()
+
+pool = ConnectionPool()
+
+class _PooledResponse(http_client.HTTPResponse):
+    _release = None
+    _closing = False
+    def _close_conn(self):
+        # Called when the whole body was read, or by close().
+        reusable = not self._closing and not self.will_close
+        http_client.HTTPResponse._close_conn(self)
+        self._releaseConnection(reusable)
+
+    def close(self):
+        # fp is only closed before close() is called if the whole body was
+        # read, which is required to send another request on the connection.
+        reusable = self.fp is None and not self.will_close
+        self._closing = True
+        http_client.HTTPResponse.close(self)
+        self._releaseConnection(reusable)
+
+    def _releaseConnection(self, reusable):
+        release = self._release
+        if release is not None:
+            self._release = None
+            release(reusable)
+
+class _PooledConnectionMixin(object):
+    response_class = _PooledResponse
+    def getresponse(self):
+        response = super(_PooledConnectionMixin, self).getresponse()
+        # The response references the connection to release it; if the
+        # connection referenced it back, a response dropped without being
+        # closed would only be released by the cyclic garbage collector.
+        self._HTTPConnection__response = None
+        return response
+
+class _PooledHTTPConnection(_PooledConnectionMixin,
+                            http_client.HTTPConnection):
+    pass
+
+class _PooledHTTPSConnection(_PooledConnectionMixin,
+                             http_client.HTTPSConnection):
+    pass
+
+class _PooledHandler(object):
+    def _open(self, connectionClass, req, **kwargs):
+        if req._tunnel_host:
+            # Connections to a proxy are not worth pooling.
+            return self.do_open(connectionClass.__bases__[-1], req, **kwargs)
+        host = req.host
+        if not host:
+            raise URLError('no host given')
+        key = (connectionClass, host)
+        headers = dict(req.unredirected_hdrs)
+        headers.update((k, v) for (k, v) in req.headers.items()
+                       if k not in headers)
+        headers = dict((k.title(), v) for (k, v) in headers.items())
+        timeout = req.timeout
+        if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        method = req.get_method()
+        # The semaphore is held until the response is released, so the
+        # body being downloaded counts as well.
+        semaphore = pool.semaphore
+        if timeout is None:
+            semaphore.acquire()
+        elif not semaphore.acquire(timeout=timeout):
+            raise URLError('too many HTTP requests in progress')
+        try:
+            connection = pool.get(key)
+            while True:
+                reused = connection is not None
+                if reused:
+                    connection.timeout = timeout
+                    if connection.sock is not None:
+                        connection.sock.settimeout(timeout)
+                else:
+                    connection = connectionClass(host, timeout=timeout,
+                                                 **kwargs)
+                try:
+                    connection.request(method, req.selector, req.data,
+                                       headers)
+                    response = connection.getresponse()
+                except sockerrors + (http_client.BadStatusLine,) as e:
+                    connection.close()
+                    if reused and method in ('GET', 'HEAD') and \
+                       req.data is None and \
+                       not isinstance(e, socket.timeout):
+                        # The server closed the idle connection; retry on
+                        # a new one.  Other requests may have been
+                        # processed already, so they are not sent twice.
+                        connection = None
+                        continue
+                    raise URLError(e)
+                except:
+                    connection.close()
+                    raise
+                break
+        except:
+            semaphore.release()
+            raise
+        def release(reusable):
+            try:
+                if reusable and connection.sock is not None:
+                    pool.put(key, connection)
+                else:
+                    connection.close()
+            finally:
+                semaphore.release()
+        response._release = release
+        if response.isclosed():
+            # There is no body (eg. HEAD requests).
+            response._releaseConnection(not response.will_close)
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+class PooledHTTPHandler(_PooledHandler, HTTPHandler):
+    """Opens HTTP URLs with connections from utils.web.pool."""
+    def http_open(self, req):
+        return self._open(_PooledHTTPConnection, req)
+
+class PooledHTTPSHandler(_PooledHandler, HTTPSHandler):
+    """Opens HTTPS URLs with connections from utils.web.pool."""
+    def https_open(self, req):
+        kwargs = {'context': self._context}
+        if getattr(self, '_check_hostname', None) is not None:
+            kwargs['check_hostname'] = self._check_hostname
+        return self._open(_PooledHTTPSConnection, req, **kwargs)
+
+_opener = build_opener(PooledHTTPHandler, PooledHTTPSHandler)
+
+def _urlopen(request, timeout):
+    if proxy is not None and proxy():
+        # The proxy is set up in urllib's global opener.
+        return urlopen(request, timeout=timeout)
+    return _opener.open(request, timeout=timeout)
+
+class CachedResponse(io.BytesIO):
+    """A file object for a response served from a ResponseCache."""
+    def __init__(self, entry):
+        io.BytesIO.__init__(self, entry['body'])
+        self.url = entry['url']
+        self.status = self.code = 200
+        self.reason = self.msg = 'OK'
+        self.headers = email.message.Message()
+        for (name, value) in entry['headers']:
+            self.headers[name] = value
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.status
+
+    def info(self):
+        return self.headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+class _CachingResponse(object):
+    """Wraps a response, and stores it in a ResponseCache once its whole body
+    has been read."""
+    def __init__(self, fd, cache, key):
+        self._fd = fd
+        self._cache = cache
+        self._key = key
+        self._chunks = []
+        self._size = 0
+
+    def __getattr__(self, name):
+        return getattr(self._fd, name)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _feed(self, data, complete):
+        if self._chunks is None:
+            return data
+        self._size += len(data)
+        if self._size > self._cache.maxBodySize:
+            self._chunks = None
+        else:
+            self._chunks.append(data)
+            if complete or self._fd.isclosed():
+                self._cache.store(self._key, self._fd, b''.join(self._chunks))
+                self._chunks = None
+        return data
+
+    def read(self, *args):
+        data = self._fd.read(*args)
+        return self._feed(data, not args or args[0] is None or
+                                args[0] < 0 or not data)
+
+    def readline(self, *args):
+        data = self._fd.readline(*args)
+        return self._feed(data, not data)
+
+    def close(self):
+        self._chunks = None
+        self._fd.close()
+
+def _parseCacheControl(headers):
+    directives = {}
+    for value in headers.get_all('Cache-Control') or ():
+        for directive in value.split(','):
+            (name, _, arg) = directive.strip().partition('=')
+            directives[name.lower()] = arg.strip('"')
+    return directives
+
+class ResponseCache(object):
+    """Caches the responses to GET requests in memory, and on disk if it is
+    given a directory.  Responses are reused as long as their Cache-Control
+    or Expires headers say they are fresh, and are then revalidated with the
+    ETag and Last-Modified headers they came with."""
+    def __init__(self, size=100, directory=None, diskSize=1000,
+                 maxBodySize=1024*1024):
+        self.size = size
+        self.directory = directory
+        self.diskSize = diskSize
+        self.maxBodySize = maxBodySize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._writes = 0
+
+    def _filename(self, key):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                return entry
+        if self.directory is None:
+            return None
+        try:
+            with open(self._filename(key), 'rb') as fd:
+                entry = json.loads(fd.readline().decode('utf8'))
+                entry['body'] = fd.read()
+        except (EnvironmentError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def set(self, key, entry):
+        self._remember(key, entry)
+        if self.directory is None:
+            return
+        entry = dict(entry)
+        body = entry.pop('body')
+        entry['key'] = key
+        filename = self._filename(key)
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(filename + '.tmp', 'wb') as fd:
+                fd.write(json.dumps(entry).encode('utf8'))
+                fd.write(b'\n')
+                fd.write(body)
+            os.rename(filename + '.tmp', filename)
+        except EnvironmentError:
+            return
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self._prune()
+
+    def _prune(self):
+        try:
+            filenames = [os.path.join(self.directory, name)
+                         for name in os.listdir(self.directory)]
+            if len(filenames) > self.diskSize:
+                filenames.sort(key=os.path.getmtime)
+                for filename in filenames[:-self.diskSize]:
+                    os.remove(filename)
+        except EnvironmentError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                os.remove(os.path.join(self.directory, name))
+
+    def _expires(self, headers, now):
+        directives = _parseCacheControl(headers)
+        if 'no-cache' in directives:
+            return now
+        if 'max-age' in directives:
+            try:
+                age = int(headers.get('Age') or 0)
+                return now + int(directives['max-age']) - age
+            except ValueError:
+                return now
+        if headers.get('Expires'):
+            date = email.utils.parsedate_tz(headers['Expires'])
+            if date is not None:
+                return email.utils.mktime_tz(date)
+        return now
+
+    def _key(self, request):
+        return '%s %s' % (request.get_full_url(),
+                          request.get_header('Accept-language', ''))
+
+    def open(self, request, timeout):
+        """Opens the request, using a cached response if there is a fresh
+        one, or revalidating it if there is a stale one.  Requests with
+        credentials or cookies are not cached, as the key doesn't cover
+        them."""
+        if request.has_header('Authorization') or \
+                request.has_header('Cookie'):
+            return _urlopen(request, timeout)
+        key = self._key(request)
+        entry = self.get(key)
+        now = time.time()
+        if entry is not None:
+            if entry['expires'] > now:
+                return CachedResponse(entry)
+            if entry['etag']:
+                request.add_unredirected_header('If-None-Match',
+                                                entry['etag'])
+            if entry['lastModified']:
+                request.add_unredirected_header('If-Modified-Since',
+                                                entry['lastModified'])
+        try:
+            fd = _urlopen(request, timeout)
+        except HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+            e.close()
+            entry = dict(entry)
+            entry['expires'] = self._expires(e.headers, now)
+            self.set(key, entry)
+            return CachedResponse(entry)
+        if fd.getcode() != 200:
+            return fd
+        directives = _parseCacheControl(fd.headers)
+        if 'no-store' in directives:
+            return fd
+        vary = set(name.strip().lower()
+                   for name in (fd.headers.get('Vary') or '').split(','))
+        if vary - set(['', 'accept-language']):
+            # Depends on headers (or '*') the key doesn't include.
+            return fd
+        if not fd.headers.get('ETag') and \
+                not fd.headers.get('Last-Modified') and \
+                self._expires(fd.headers, now) <= now:
+            return fd
+        return _CachingResponse(fd, self, key)
+
+    def store(self, key, fd, body):
+        now = time.time()
+        headers = [(name, value) for (name, value) in fd.headers.items()
+                   if name.lower() not in ('connection', 'keep-alive',
+                                           'transfer-encoding')]
+        self.set(key, {
+            'url': fd.geturl(),
+            'headers': headers,
+            'body': body,
+            'expires': self._expires(fd.headers, now),
+            'etag': fd.headers.get('ETag'),
+            'lastModified': fd.headers.get('Last-Modified'),
+            })
+
+# The ResponseCache used by getUrlFd for GET requests, or None to disable
+# caching.  Overridable by other modules.
+cache = None
+
 def getUrlFd(url, headers=None, data=None, timeout=None):
     """getUrlFd(url, headers=None, data=None, timeout=None)
 
@@ -138,6 +580,7 @@ def getUrlFd(url, headers=None, data=None, timeout=None):
     if minisix.PY3 and isinstance(data, str):
         data = data.encode()
     try:
+        user = None
         if not isinstance(url, Request):
             (scheme, loc, path, query, frag) = urlsplit(url)
             (user, host) = splituser(loc)
@@ -149,7 +592,10 @@ def getUrlFd(url, headers=None, data=None, timeout=None):
         else:
             request = url
             request.add_data(data)
-        fd = urlopen(request, timeout=timeout)
+        if cache is not None and not user and \
+                request.get_method() == 'GET' and request.data is None:
+            return cache.open(request, timeout)
+        fd = _urlopen(request, timeout)
         return fd
     except socket.timeout as e:
         raise Error(TIMED_OUT)
@@ -174,14 +620,20 @@ def getUrlTargetAndContent(url, size=None, headers=None, data=None, timeout=None
     urllib.request.Request's arguments."""
     fd = getUrlFd(url, headers=headers, data=data, timeout=timeout)
     try:
-        if size is None:
+        if size is None and maxResponseSize is not None:
+            text = fd.read(maxResponseSize + 1)
+            if len(text) > maxResponseSize:
+                raise Error('Response is larger than %i bytes.' %
+                            maxResponseSize)
+        elif size is None:
             text = fd.read()
         else:
             text = fd.read(size)
     except socket.timeout:
         raise Error(TIMED_OUT)
-    target = fd.geturl()
-    fd.close()
+    finally:
+        target = fd.geturl()
+        fd.close()
     return (target, text)
 
 def getUrlContent(*args, **kwargs):
@@ -38,6 +38,7 @@ import time
 import atexit
 import select
 import threading
+import collections
 import multiprocessing
 
 import re
@@ -63,6 +64,83 @@ class SupyThread(threading.Thread, object):
         super(SupyThread, self).__init__(*args, **kwargs)
         log.debug('Spawning thread %q.', self.getName())
 
+class ThreadPool(object):
+    """A bounded pool of threads.  Threads are started when tasks are
+    submitted, up to <maxThreads> of them, and exit after being idle for
+    <idleTimeout> seconds.  At most <maxQueued> tasks wait for a thread when
+    all of them are busy; further tasks are rejected.  <maxThreads> and
+    <maxQueued> may be callables (eg. registry values)."""
+    idleTimeout = 60
+    def __init__(self, name, maxThreads, maxQueued):
+        self.name = name
+        self.maxThreads = maxThreads
+        self.maxQueued = maxQueued
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.threads = 0
+        self.idle = 0
+        self.running = 0
+        self.maxRunning = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
+    def _get(self, value):
+        if callable(value):
+            return value()
+        else:
+            return value
+
+    def submit(self, f, *args, **kwargs):
+        """Runs f(*args, **kwargs) in a thread of the pool and returns True,
+        or returns False if the pool is too busy to accept it."""
+        task = (f, args, kwargs)
+        with self.cond:
+            if self.idle <= len(self.queue):
+                if self.threads < self._get(self.maxThreads):
+                    # The new thread is given the task directly, so it
+                    # doesn't count against maxQueued while it starts.
+                    self.threads += 1
+                    self.running += 1
+                    self.maxRunning = max(self.maxRunning, self.running)
+                    t = SupyThread(target=self._work, args=(task,),
+                                   name='Thread #%s (for %s)' %
+                                   (threadsSpawned, self.name))
+                    t.daemon = True
+                    t.start()
+                    return True
+                elif len(self.queue) >= self._get(self.maxQueued):
+                    self.rejected += 1
+                    return False
+            self.queue.append(task)
+            self.cond.notify()
+        return True
+
+    def _work(self, task):
+        while True:
+            (f, args, kwargs) = task
+            try:
+                f(*args, **kwargs)
+            except Exception:
+                log.exception('Uncaught exception in thread pool %s:',
+                              self.name)
+            with self.cond:
+                self.running -= 1
+                self.completed += 1
+                self.idle += 1
+                while not self.queue:
+                    if not self.cond.wait(self.idleTimeout) and \
+                       not self.queue:
+                        self.idle -= 1
+                        self.threads -= 1
+                        return
+                self.idle -= 1
+                task = self.queue.popleft()
+                self.running += 1
+                self.maxRunning = max(self.maxRunning, self.running)
+
 processesSpawned = 1 # Starts at one for the initial process.
 class SupyProcess(multiprocessing.Process):
     def __init__(self, *args, **kwargs):
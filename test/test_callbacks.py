@@ -30,10 +30,14 @@
 
 from supybot.test import *
 
+import asyncio
+import threading
+
 import supybot.conf as conf
 import supybot.utils as utils
 import supybot.ircmsgs as ircmsgs
 import supybot.utils.minisix as minisix
+import supybot.commands as commands
 import supybot.callbacks as callbacks
 
 tokenize = callbacks.tokenize
@@ -625,6 +629,94 @@ class RichReplyMethodsTestCase(PluginTestCase):
         self.assertNotError('config capabilities.private ""')
 
 
+class ThreadedCommandTestCase(PluginTestCase):
+    plugins = ()
+    class Threaded(callbacks.Plugin):
+        threaded = True
+        def __init__(self, irc):
+            self.__parent = super(ThreadedCommandTestCase.Threaded, self)
+            self.__parent.__init__(irc)
+            self.event = threading.Event()
+        def wait(self, irc, msg, args):
+            """takes no arguments"""
+            self.event.wait(5)
+            irc.reply('done waiting')
+    def testBusy(self):
+        cb = self.Threaded(self.irc)
+        self.irc.addCallback(cb)
+        with conf.supybot.commands.threads.context(1), \
+             conf.supybot.commands.threads.queue.context(1):
+            self.feedMsg('wait')
+            self.feedMsg('wait')
+            self.assertRegexp('wait', 'too busy')
+            pool = callbacks.threadPool('Threaded')
+            completed = pool.completed
+            cb.event.set()
+            # Wait for both replies, so they come before the error of the
+            # empty commands below.
+            start = time.time()
+            while pool.completed < completed + 2 and time.time()-start < 5:
+                time.sleep(0.01)
+            self.assertResponse(' ', 'done waiting')
+            self.assertResponse(' ', 'done waiting')
+        self.assertEqual(pool.rejected, 1)
+        self.assertEqual(pool.threads, 1)
+
+    def testPoolQueue(self):
+        event = threading.Event()
+        pool = world.ThreadPool('test', 1, 1)
+        # The task given to the new thread doesn't take the queue's place,
+        # even if the thread didn't start yet.
+        self.assertTrue(pool.submit(event.wait, 5))
+        self.assertTrue(pool.submit(event.wait, 5))
+        self.assertFalse(pool.submit(event.wait, 5))
+        event.set()
+        self.assertEqual(pool.rejected, 1)
+
+class AsyncCommandTestCase(PluginTestCase):
+    plugins = ('Utilities',)
+    class Async(callbacks.Plugin):
+        async def sleep(self, irc, msg, args):
+            """takes no arguments"""
+            await asyncio.sleep(0.01)
+            irc.reply('slept')
+        def wrapped(self, irc, msg, args, n):
+            """<n>"""
+            async def f():
+                await asyncio.sleep(0.01)
+                irc.reply(n * 2)
+            return f()
+        wrapped = commands.wrap(wrapped, ['int'])
+        async def fail(self, irc, msg, args):
+            """takes no arguments"""
+            await asyncio.sleep(0.01)
+            raise callbacks.Error('failed')
+        async def cancel(self, irc, msg, args):
+            """takes no arguments"""
+            raise asyncio.CancelledError()
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.irc.addCallback(self.Async(self.irc))
+
+    def testAsyncCommand(self):
+        self.assertResponse('sleep', 'slept')
+        self.assertResponse('wrapped 21', '42')
+        self.assertResponse('echo [wrapped 2]', '4')
+
+    def testAsyncCommandError(self):
+        self.assertResponse('fail', 'Error: failed')
+
+    def testAsyncCommandCancelled(self):
+        self.assertNoResponse('cancel', timeout=0.1)
+        self.assertResponse('sleep', 'slept')
+
+    def testAsyncCommandsShareLoop(self):
+        self.assertResponse('sleep', 'slept')
+        spawned = world.threadsSpawned
+        for i in range(3):
+            self.assertResponse('sleep', 'slept')
+        self.assertEqual(world.threadsSpawned, spawned)
+
 class SourceNestedPluginTestCase(PluginTestCase):
     plugins = ('Utilities',)
     class E(callbacks.Plugin):
@@ -0,0 +1,173 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+from supybot.test import *
+
+import os
+
+import supybot.cdb as cdb
+
+class CdbTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize('test_cdb.db')
+        self.removeFiles()
+
+    def tearDown(self):
+        self.removeFiles()
+        SupyTestCase.tearDown(self)
+
+    def removeFiles(self):
+        for filename in (self.filename, self.filename + '.journal',
+                         self.filename + '.journal.merging'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def make(self, items):
+        maker = cdb.Maker(self.filename)
+        for (key, value) in items:
+            maker.add(key, value)
+        maker.finish()
+
+    def testReader(self):
+        items = [('key%s' % i, 'value%s' % i) for i in range(1000)]
+        items.append(('clé', 'valeur é'))
+        items.append(('key3', 'again'))
+        self.make(items)
+        for useMmap in (True, False):
+            reader = cdb.Reader(self.filename, useMmap=useMmap)
+            try:
+                self.assertEqual(len(reader), 1002)
+                self.assertEqual(reader['key42'], 'value42')
+                self.assertEqual(reader['clé'], 'valeur é')
+                self.assertEqual(reader.findall('key3'), ['value3', 'again'])
+                self.assertIn('key999', reader)
+                self.assertNotIn('key1000', reader)
+                self.assertRaises(KeyError, reader.__getitem__, 'key1000')
+                self.assertEqual(reader.get('key1000', 'default'), 'default')
+                self.assertEqual(reader.get_many(['key1', 'nope', 'clé']),
+                                 ['value1', None, 'valeur é'])
+                self.assertEqual(list(reader.items()), items)
+            finally:
+                reader.close()
+
+    def testReaderWriter(self):
+        self.make([('a', '1'), ('b', '2'), ('c', '3')])
+        db = cdb.open_db(self.filename, 'c')
+        db['b'] = 'changed'
+        db['d'] = '4'
+        del db['c']
+        self.assertNotIn('c', db)
+        self.assertEqual(db.get_many(['a', 'b', 'c', 'd']),
+                         ['1', 'changed', None, '4'])
+        db.close()
+        db = cdb.open_db(self.filename, 'c')
+        self.assertEqual(sorted(db.items()),
+                         [('a', '1'), ('b', 'changed'), ('d', '4')])
+        del db['a']
+        db.flush()
+        self.assertNotIn('a', db)
+        db['a'] = '5'
+        self.assertEqual(db['a'], '5')
+        db.close()
+
+    def testBackgroundMerge(self):
+        self.make([('a', '1'), ('b', '2')])
+        db = cdb.open_db(self.filename, 'c', maxmods=2)
+        db['c'] = '3'
+        db['a'] = 'changed'
+        self.assertIsNone(db._merger)
+        del db['b'] # Over the limit, starts merging.
+        db['d'] = '4'
+        db['c'] = 'changed too'
+        self.assertEqual(db.get_many(['a', 'b', 'c', 'd']),
+                         ['changed', None, 'changed too', '4'])
+        db.join()
+        self.assertIsNone(db._merging)
+        self.assertEqual(sorted(db.items()),
+                         [('a', 'changed'), ('c', 'changed too'), ('d', '4')])
+        reader = cdb.Reader(self.filename)
+        self.assertEqual(sorted(reader.items()),
+                         [('a', 'changed'), ('c', '3')])
+        reader.close()
+        db.close()
+        reader = cdb.Reader(self.filename)
+        self.assertEqual(sorted(reader.items()),
+                         [('a', 'changed'), ('c', 'changed too'), ('d', '4')])
+        reader.close()
+
+    def testItemsDoesNotLock(self):
+        self.make([('a', '1'), ('b', '2')])
+        db = cdb.open_db(self.filename, 'c')
+        items = db.items()
+        self.assertIn(next(items), [('a', '1'), ('b', '2')])
+        # The items are being iterated over in the main thread; the merge
+        # must not wait for it.
+        db['c'] = '3'
+        db.flush()
+        merger = db._merger
+        merger.join(5)
+        self.assertFalse(merger.is_alive())
+        self.assertEqual(db['c'], '3')
+        self.assertEqual(len(list(items)), 1)
+        db.close()
+
+    def testRecoverJournals(self):
+        self.make([('a', '1'), ('b', '2')])
+        with open(self.filename + '.journal.merging', 'w') as fd:
+            fd.write('+1,3:a->old\n-1,0:b->\n+1,1:c->3\n')
+        with open(self.filename + '.journal', 'w') as fd:
+            fd.write('+1,3:a->new\n-1,0:c->\n')
+        db = cdb.open_db(self.filename, 'c')
+        self.assertEqual(sorted(db.items()), [('a', 'new')])
+        self.assertFalse(os.path.exists(self.filename + '.journal.merging'))
+        db.close()
+
+    def testShelf(self):
+        values = {'a': {'x': 'caf\xe9\r\n'}, 'b': [1, b'\r\x00\xff']}
+        db = cdb.shelf(self.filename)
+        for (key, value) in values.items():
+            db[key] = value
+        self.assertEqual(db.get_many(['a', 'b', 'c']),
+                         [values['a'], values['b'], None])
+        # Replayed from the journal.
+        db._closeFiles()
+        db = cdb.shelf(self.filename)
+        self.assertEqual(dict(db.items()), values)
+        db['c'] = 3
+        db.close()
+        # Merged into the CDB.
+        db = cdb.shelf(self.filename)
+        self.assertEqual(db.get_many(['a', 'b', 'c']),
+                         [values['a'], values['b'], 3])
+        db.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -28,13 +28,19 @@
 # POSSIBILITY OF SUCH DAMAGE.
 ###
 
+import os
+import re
 import sys
+import time
 import getopt
 
 from supybot.test import *
 
 from supybot.commands import *
 import supybot.conf as conf
+import supybot.world as world
+import supybot.schedule as schedule
+import supybot.commands as commands
 import supybot.irclib as irclib
 import supybot.ircmsgs as ircmsgs
 import supybot.utils.minisix as minisix
@@ -203,6 +209,103 @@ class FirstTestCase(CommandsTestCase):
         spec = [first('regexpMatcher', 'regexpReplacer'), 'text']
         self.assertStateErrored(spec, ['s/foo/bar/', 'x' * 512], errored=False)
 
+@unittest.skipIf(world.disableMultiprocessing,
+                 'Test requires multiprocessing to be enabled')
+class ProcessTestCase(SupyTestCase):
+    def testProcess(self):
+        self.assertEqual(process(sum, [1, 2, 3]), 6)
+        self.assertEqual(process(divmod, 7, 2, pn='Test', cn='divmod'),
+                         (3, 1))
+        self.assertRaises(ZeroDivisionError, process, divmod, 1, 0)
+        # Not picklable, runs in a process of its own.
+        self.assertEqual(process(lambda x: x*2, 21), 42)
+        self.assertTrue(regexp_wrapper('foo', re.compile('o+'), timeout=1,
+                                       plugin_name='Test', fcn_name='re'))
+
+    def testTimeout(self):
+        stats = commands.processPool.stats()
+        self.assertRaises(commands.ProcessTimeoutError, process,
+                          time.sleep, 10, timeout=0.2)
+        self.assertEqual(process(sum, [1, 2], timeout=1), 3)
+        self.assertEqual(commands.processPool.stats()['timeouts'],
+                         stats['timeouts'] + 1)
+
+    def testWorkersReused(self):
+        with conf.supybot.commands.processes.context(1):
+            process(sum, [])
+            spawned = world.processesSpawned
+            for i in range(5):
+                process(sum, [])
+            self.assertEqual(world.processesSpawned, spawned)
+            with conf.supybot.commands.processes.maxTasks.context(2):
+                for i in range(4):
+                    process(sum, [])
+            self.assertGreater(world.processesSpawned, spawned)
+
+    def testOrphanedWorkerExits(self):
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                worker = commands._Worker(commands._poolWorker, (),
+                                          'Test', 'orphan', True)
+                os.write(w, str(worker.process.pid).encode())
+            finally:
+                # Die without closing the pipe to the worker, like a killed
+                # bot would.
+                os._exit(0)
+        os.close(w)
+        try:
+            workerPid = int(os.read(r, 20))
+        finally:
+            os.close(r)
+            os.waitpid(pid, 0)
+        start = time.time()
+        while time.time() - start < 10:
+            try:
+                os.kill(workerPid, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        else:
+            os.kill(workerPid, 9)
+            self.fail('orphaned worker did not exit')
+
+    def testProcessAsync(self):
+        results = []
+        processAsync(sum, [1, 2, 3], callback=results.append)
+        processAsync(divmod, 1, 0, errback=results.append)
+        processAsync(time.sleep, 10, timeout=0.2, errback=results.append)
+        processAsync(lambda: 'forked', callback=results.append)
+        start = time.time()
+        while len(results) < 4 and time.time() - start < 5:
+            time.sleep(0.01)
+            schedule.run()
+        self.assertEqual(len(results), 4, results)
+        self.assertIn(6, results)
+        self.assertIn('forked', results)
+        self.assertEqual(
+            sorted(type(r).__name__ for r in results
+                   if isinstance(r, Exception)),
+            ['ProcessTimeoutError', 'ZeroDivisionError'])
+
+    def testProcessAsyncWithoutWorkers(self):
+        results = []
+        # A new pool, so there is no idle worker left by other tests.
+        (pool, commands.processPool) = \
+            (commands.processPool, commands.ProcessPool())
+        try:
+            with conf.supybot.commands.processes.context(0):
+                processAsync(sum, [1, 2, 3], callback=results.append)
+                start = time.time()
+                while not results and time.time() - start < 5:
+                    time.sleep(0.01)
+                    schedule.run()
+        finally:
+            commands.processPool = pool
+        self.assertEqual(results, [6])
+
 class GetoptTestCase(PluginTestCase):
     plugins = ('Misc',) # We put something so it does not complain
     class Foo(callbacks.Plugin):
@@ -0,0 +1,198 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+from supybot.test import *
+
+import os
+
+import supybot.dbi as dbi
+
+class MappingTestMixin(object):
+    mapping = None
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize(
+            'test_dbi.%s.db' % self.mapping)
+        self.removeFile()
+        self.map = dbi.Mappings[self.mapping](self.filename)
+
+    def tearDown(self):
+        self.map.close()
+        self.removeFile()
+        SupyTestCase.tearDown(self)
+
+    def removeFile(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def reopen(self):
+        self.map.close()
+        self.map = dbi.Mappings[self.mapping](self.filename)
+
+    def testAddGetSetRemove(self):
+        ids = [self.map.add('record %s' % i) for i in range(5)]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(self.map.get(ids[2]), 'record 2')
+        self.map.set(ids[2], 'changed')
+        self.assertEqual(self.map.get(ids[2]), 'changed')
+        self.map.remove(ids[3])
+        self.assertRaises(dbi.NoRecordError, self.map.get, ids[3])
+        self.assertEqual(sorted(self.map),
+                         [(ids[0], 'record 0'), (ids[1], 'record 1'),
+                          (ids[2], 'changed'), (ids[4], 'record 4')])
+        self.reopen()
+        self.assertEqual(self.map.get(ids[2]), 'changed')
+        self.assertRaises(dbi.NoRecordError, self.map.get, ids[3])
+        self.assertNotIn(self.map.add('new'), ids)
+
+class FlatfileMappingTestCase(MappingTestMixin, SupyTestCase):
+    mapping = 'flat'
+
+class CdbMappingTestCase(MappingTestMixin, SupyTestCase):
+    mapping = 'cdb'
+
+class IndexedMappingTestCase(MappingTestMixin, SupyTestCase):
+    mapping = 'indexed'
+
+    def testEscaping(self):
+        s = 'line 1\nline 2\r\\n \\ é'
+        id = self.map.add(s)
+        self.assertEqual(self.map.get(id), s)
+        self.reopen()
+        self.assertEqual(self.map.get(id), s)
+        self.assertEqual(list(self.map), [(id, s)])
+
+    def testIncompleteEntry(self):
+        id = self.map.add('foo')
+        self.map.close()
+        with open(self.filename, 'ab') as fd:
+            fd.write(b'+2:unfinish')
+        self.map = dbi.IndexedMapping(self.filename)
+        self.assertEqual(list(self.map), [(id, 'foo')])
+        self.assertEqual(self.map.add('bar'), id + 1)
+        self.reopen()
+        self.assertEqual(list(self.map), [(id, 'foo'), (id + 1, 'bar')])
+
+    def testVacuum(self):
+        ids = [self.map.add(str(i)) for i in range(10)]
+        for id in ids[5:]:
+            self.map.remove(id)
+        for id in ids[:3]:
+            self.map.set(id, 'x')
+        size = os.path.getsize(self.filename)
+        self.map.vacuum()
+        self.assertLess(os.path.getsize(self.filename), size)
+        expected = [(ids[0], 'x'), (ids[1], 'x'), (ids[2], 'x'),
+                    (ids[3], '3'), (ids[4], '4')]
+        self.assertEqual(list(self.map), expected)
+        self.assertEqual(self.map.get(ids[4]), '4')
+        # Removed ids are not given out again.
+        self.assertEqual(self.map.add('y'), ids[-1] + 1)
+        self.reopen()
+        self.assertEqual(list(self.map), expected + [(ids[-1] + 1, 'y')])
+
+    def testBackgroundCompaction(self):
+        self.map.compactionMinimumSize = 0
+        id = self.map.add('foo')
+        for i in range(100):
+            self.map.set(id, str(i))
+        self.map.close()
+        self.assertLess(os.path.getsize(self.filename), 100)
+        self.reopen()
+        self.assertEqual(list(self.map), [(id, '99')])
+
+
+class IndexTestCase(SupyTestCase):
+    class Record(dbi.Record):
+        __fields__ = ['by', 'text']
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filenames = []
+
+    def tearDown(self):
+        for filename in self.filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        SupyTestCase.tearDown(self)
+
+    def openDb(self, mapping):
+        filename = conf.supybot.directories.data.dirize(
+            'test_dbi.index.%s.db' % mapping)
+        self.filenames.append(filename)
+        return dbi.DB(filename, Mapping=mapping, Record=self.Record,
+                      indexes=['by'], textIndexes=['text'])
+
+    def assertSelect(self, db, ids, *args, **kwargs):
+        self.assertEqual(sorted(r.id for r in db.select(*args, **kwargs)),
+                         ids)
+
+    def testSelect(self):
+        for mapping in ('flat', 'indexed'):
+            db = self.openDb(mapping)
+            a = db.add(self.Record(by=1, text='Hello world'))
+            b = db.add(self.Record(by=2, text='hello there, world'))
+            c = db.add(self.Record(by=1, text='goodbye'))
+            self.assertSelect(db, [a, c], by=1)
+            self.assertSelect(db, [a, b], words=['hello', 'World'])
+            self.assertSelect(db, [a], words=['world'], by=1)
+            self.assertSelect(db, [b], lambda r: 'there' in r.text,
+                              words=['world'])
+            self.assertSelect(db, [], words=['hell'])
+            self.assertSelect(db, [a, b, c], lambda r: True)
+            record = db.get(c)
+            record.by = 2
+            record.text = 'hello again'
+            db.set(c, record)
+            self.assertSelect(db, [a], by=1)
+            self.assertSelect(db, [a, b, c], words=['hello'])
+            self.assertSelect(db, [], words=['goodbye'])
+            db.remove(a)
+            self.assertSelect(db, [], by=1)
+            self.assertSelect(db, [b, c], words=['hello'])
+            db.close()
+            # The indexes are rebuilt when the database is opened.
+            db = self.openDb(mapping)
+            self.assertSelect(db, [b, c], by=2)
+            self.assertSelect(db, [b], words=['world'])
+            db.close()
+
+    def testGlobWords(self):
+        self.assertEqual(dbi.globWords('* hello wor*'), set(['hello']))
+        self.assertEqual(dbi.globWords('hello wor*'), set(['hello']))
+        self.assertEqual(dbi.globWords('hello wor*', anchored=False), set())
+        self.assertEqual(dbi.globWords('a *B c?d e [f]g h*'),
+                         set(['a', 'e']))
+        self.assertEqual(dbi.globWords('Foo bar'), set(['foo', 'bar']))
+        self.assertEqual(dbi.globWords('Foo bar', anchored=False),
+                         set(['bar']))
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,198 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+from supybot.test import *
+
+import socket
+import threading
+
+import supybot.conf as conf
+import supybot.drivers as drivers
+import supybot.irclib as irclib
+import supybot.ircmsgs as ircmsgs
+import supybot.schedule as schedule
+import supybot.drivers.Asyncio as Asyncio
+import supybot.drivers.Selectors as Selectors
+
+class LineBufferTestCase(SupyTestCase):
+    def testFeed(self):
+        buf = drivers.LineBuffer(size=8)
+        buf.feed(b'foo')
+        self.assertEqual(buf.lines(), [])
+        buf.feed(b' bar\r\nbaz\nq')
+        self.assertEqual(buf.lines(), [b'foo bar\r', b'baz'])
+        self.assertEqual(len(buf), 1)
+        buf.feed(b'ux\n' + b'x' * 100)
+        self.assertEqual(buf.lines(), [b'qux'])
+        self.assertEqual(len(buf), 100)
+        buf.feed(b'\n\n')
+        self.assertEqual(buf.lines(), [b'x' * 100, b''])
+        self.assertEqual(len(buf), 0)
+
+    def testRecvInto(self):
+        (a, b) = socket.socketpair()
+        try:
+            buf = drivers.LineBuffer(size=4)
+            a.sendall(b'PING :foo\r\nPING')
+            self.assertEqual(buf.recvInto(b, 1024), 15)
+            self.assertEqual(buf.lines(), [b'PING :foo\r'])
+            a.sendall(b' :bar\r\n')
+            buf.recvInto(b, 1024)
+            self.assertEqual(buf.lines(), [b'PING :bar\r'])
+            a.close()
+            self.assertEqual(buf.recvInto(b, 1024), 0)
+        finally:
+            b.close()
+
+class DriverTestMixin(object):
+    """Connects a driver to a local socket standing in for an IRC server."""
+    driverModule = None
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        # Drivers block for that long when there is nothing to do.
+        self.oldPoll = conf.supybot.drivers.poll()
+        conf.supybot.drivers.poll.setValue(0.1)
+        self.server = socket.socket()
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        conf.registerNetwork('drivertest', ssl=False)
+        network = conf.supybot.networks.drivertest
+        network.servers.setValue(['127.0.0.1:%s' %
+                                  self.server.getsockname()[1]])
+        self.irc = irclib.Irc('drivertest')
+        self.driver = drivers.newDriver(self.irc, self.driverModule)
+        # Newly added drivers only run from the next iteration.
+        drivers.run()
+        drivers.run()
+        (self.client, _) = self.server.accept()
+        self.client.settimeout(1)
+        drivers.run()
+
+    def tearDown(self):
+        self.driver.die()
+        self.irc._reallyDie()
+        drivers.run()
+        self.client.close()
+        self.server.close()
+        conf.supybot.drivers.poll.setValue(self.oldPoll)
+        SupyTestCase.tearDown(self)
+
+    def _recv(self):
+        data = b''
+        while not data.endswith(b'\r\n'):
+            data += self.client.recv(4096)
+        return data
+
+    def testReadAndWrite(self):
+        self.assertIn(b'NICK', self._recv())
+        self.client.sendall(b'PING :foo\r\n')
+        drivers.run()
+        drivers.run()
+        self.assertIn(b'PONG :foo\r\n', self._recv())
+
+    def testWriteBatch(self):
+        msgs = [ircmsgs.privmsg('#foo', '%s %s' % (i, 'x'*400))
+                for i in range(500)]
+        for msg in msgs:
+            self.irc.sendMsg(msg)
+        expected = ''.join(map(str, msgs)).encode()
+        data = b''
+        while not data.endswith(expected):
+            drivers.run()
+            try:
+                data += self.client.recv(65536)
+            except socket.timeout:
+                self.fail('Only received %s bytes.' % len(data))
+
+class WakeupTestMixin(object):
+    """For drivers which do not wait for the next poll to send messages."""
+    def testSendFromThread(self):
+        self._recv() # connection messages
+        def f():
+            self.irc.sendMsg(ircmsgs.privmsg('#foo', 'bar'))
+            # Makes the driver loop return, in case sending the message did
+            # not.
+            schedule.addEvent(lambda: None, time.time())
+        t = threading.Timer(0.1, f)
+        with conf.supybot.drivers.poll.context(10):
+            t.start()
+            start = time.time()
+            drivers.run()
+            self.assertLess(time.time() - start, 5)
+        self.assertEqual(self._recv(), b'PRIVMSG #foo :bar\r\n')
+
+class SocketDriverTestCase(DriverTestMixin, SupyTestCase):
+    driverModule = 'Socket'
+
+class SelectorsDriverTestCase(WakeupTestMixin, DriverTestMixin,
+                              SupyTestCase):
+    driverModule = 'Selectors'
+    def tearDown(self):
+        DriverTestMixin.tearDown(self)
+        Selectors.poller.die()
+        drivers.run()
+
+    def testRegistered(self):
+        self.assertIn(self.driver, Selectors.SelectorsDriver._instances)
+        self.assertIs(Selectors.poller.selector.get_key(self.driver.conn).data,
+                      self.driver)
+        self.driver.die()
+        self.assertNotIn(self.driver,
+                         Selectors.SelectorsDriver._instances)
+        self.assertRaises(KeyError, Selectors.poller.selector.get_key,
+                          self.driver.conn)
+
+class AsyncioDriverTestCase(WakeupTestMixin, DriverTestMixin, SupyTestCase):
+    driverModule = 'Asyncio'
+    def tearDown(self):
+        DriverTestMixin.tearDown(self)
+        Asyncio.runner.die()
+        drivers.run()
+
+    def testConnected(self):
+        self.assertIn(self.driver, Asyncio.AsyncioDriver._instances)
+        self.driver.die()
+        self.assertNotIn(self.driver, Asyncio.AsyncioDriver._instances)
+
+    def testStopsForScheduledEvent(self):
+        with conf.supybot.drivers.poll.context(10):
+            schedule.addEvent(lambda: None, time.time() + 0.1)
+            start = time.time()
+            Asyncio.runner.run()
+            self.assertLess(time.time() - start, 5)
+
+    def testReconnect(self):
+        self._recv()
+        self.client.close()
+        drivers.run()
+        self.assertNotIn(self.driver, Asyncio.AsyncioDriver._instances)
+        self.assertIsNotNone(self.driver.reconnectHandle)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -0,0 +1,109 @@
+###
+# Copyright (c) 2020, The Limnoria Contributors
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+###
+
+
+from supybot.test import *
+
+import threading
+
+import supybot.httpserver as httpserver
+
+if minisix.PY2:
+    import httplib as http_client
+else:
+    import http.client as http_client
+
+class Callback(httpserver.SupyHTTPServerCallback):
+    name = 'test'
+    def __init__(self):
+        self.slow = threading.Event()
+    def doGet(self, handler, path):
+        if path == '/slow':
+            self.slow.wait(5)
+        response = path.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        if path != '/nolength':
+            self.send_header('Content-Length', len(response))
+        self.end_headers()
+        self.wfile.write(response)
+
+class ThreadedHTTPServerTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        with conf.supybot.servers.http.threaded.context(True):
+            self.server = httpserver.RealSupyHTTPServer(('127.0.0.1', 0), 4,
+                    httpserver.SupyHTTPRequestHandler)
+        self.callback = Callback()
+        self.server.hook('test', self.callback)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.server_address[1]
+
+    def tearDown(self):
+        self.callback.slow.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        SupyTestCase.tearDown(self)
+
+    def get(self, connection, path):
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return (response, response.read())
+
+    def testKeepAlive(self):
+        connection = http_client.HTTPConnection('127.0.0.1', self.port)
+        (response, body) = self.get(connection, '/test/foo')
+        self.assertEqual(body, b'/foo')
+        self.assertFalse(response.will_close)
+        sock = connection.sock
+        (response, body) = self.get(connection, '/test/bar')
+        self.assertEqual(body, b'/bar')
+        self.assertTrue(connection.sock is sock)
+        # Without a Content-Length, the connection has to be closed for the
+        # client to find the end of the response.
+        (response, body) = self.get(connection, '/test/nolength')
+        self.assertEqual(body, b'/nolength')
+        self.assertTrue(response.will_close)
+        connection.close()
+
+    def testConcurrentRequests(self):
+        slow = http_client.HTTPConnection('127.0.0.1', self.port)
+        slow.request('GET', '/test/slow')
+        fast = http_client.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        (response, body) = self.get(fast, '/test/fast')
+        self.assertEqual(body, b'/fast')
+        self.callback.slow.set()
+        self.assertEqual(slow.getresponse().read(), b'/slow')
+        slow.close()
+        fast.close()
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
@@ -304,6 +304,20 @@ class IrcUserTestCase(IrcdbTestCase):
         u = ircdb.IrcUser(capabilities=('foo',))
         self.assertRaises(KeyError, u.removeCapability, 'bar')
 
+class IgnoresDBTestCase(IrcdbTestCase):
+    def testCheckIgnored(self):
+        ignores = ircdb.IgnoresDB()
+        self.assertFalse(ignores.checkIgnored('foo!bar@baz'))
+        ignores.add('*!*@baz')
+        ignores.add('qux!*@*', time.time() + 10)
+        self.assertTrue(ignores.checkIgnored('foo!bar@baz'))
+        self.assertTrue(ignores.checkIgnored('qux!bar@quux'))
+        timeFastForward(11)
+        self.assertFalse(ignores.checkIgnored('qux!bar@quux'))
+        self.assertEqual(list(ignores.hostmasks), ['*!*@baz'])
+        ignores.remove('*!*@baz')
+        self.assertFalse(ignores.checkIgnored('foo!bar@baz'))
+
 class IrcChannelTestCase(IrcdbTestCase):
     def testInit(self):
         c = ircdb.IrcChannel()
@@ -400,6 +414,41 @@ class UsersDictionaryTestCase(IrcdbTestCase):
         u2.addHostmask('*!xyzzy@baz.domain.c?m')
         self.assertRaises(ValueError, self.users.setUser, u2)
 
+    def testGetUserManyUsers(self):
+        for i in range(100):
+            u = self.users.newUser()
+            u.name = 'user%s' % i
+            u.addHostmask('*!*@host%s.example.org' % i)
+            u.addHostmask('nick%s!*@*' % i)
+            self.users.setUser(u)
+        self.assertEqual(self.users.getUser('a!b@host42.example.org').name,
+                         'user42')
+        self.assertEqual(self.users.getUser('NICK7!b@c').name, 'user7')
+        self.assertRaises(KeyError, self.users.getUser, 'a!b@example.org')
+        u = self.users.getUser('user3')
+        u.removeHostmask('*!*@host3.example.org')
+        u.addHostmask('*!*@*.example.net')
+        self.users.setUser(u)
+        self.assertRaises(KeyError, self.users.getUser,
+                          'a!b@host3.example.org')
+        self.assertEqual(self.users.getUser('a!b@c.example.net'), u)
+        self.users.delUser(u.id)
+        self.assertRaises(KeyError, self.users.getUser, 'a!b@c.example.net')
+
+    def testGetUserAuth(self):
+        u = self.users.newUser()
+        u.name = 'foo'
+        u.addHostmask('*!*@foo.example.org')
+        self.users.setUser(u)
+        hostmask = 'foo!bar@elsewhere.example.net'
+        self.assertRaises(KeyError, self.users.getUser, hostmask)
+        u.addAuth(hostmask)
+        self.users.setUser(u)
+        self.assertEqual(self.users.getUser(hostmask), u)
+        u.clearAuth()
+        self.users.setUser(u)
+        self.assertRaises(KeyError, self.users.getUser, hostmask)
+
 
 class CheckCapabilityTestCase(IrcdbTestCase):
     filename = os.path.join(conf.supybot.directories.conf(),
@@ -549,6 +598,31 @@ class CheckCapabilityTestCase(IrcdbTestCase):
         self.assertTrue(self.checkCapability(self.antichanfoo,
                                              self.antichancap))
 
+    def testCachedResultsInvalidated(self):
+        u = self.users.getUser('nothing')
+        self.assertTrue(self.checkCapability(self.nothing, self.cap))
+        u.addCapability(self.anticap)
+        self.assertFalse(self.checkCapability(self.nothing, self.cap))
+        u.removeCapability(self.anticap)
+        self.assertTrue(self.checkCapability(self.nothing, self.cap))
+        with conf.supybot.capabilities.default.context(False):
+            self.assertFalse(self.checkCapability(self.nothing, self.cap))
+        self.assertTrue(self.checkCapability(self.nothing, self.cap))
+        conf.supybot.capabilities().add(self.anticap)
+        try:
+            self.assertFalse(self.checkCapability(self.nothing, self.cap))
+        finally:
+            conf.supybot.capabilities().remove(self.anticap)
+        self.assertTrue(self.checkCapability(self.nothing, self.cap))
+
+        c = self.channels.getChannel(self.channel)
+        self.assertTrue(self.checkCapability(self.nothing, self.chancap))
+        c.addCapability(self.anticap)
+        self.assertFalse(self.checkCapability(self.nothing, self.chancap))
+        c.removeCapability(self.anticap)
+        c.setDefaultCapability(False)
+        self.assertFalse(self.checkCapability(self.nothing, self.chancap))
+
     def testSecurefoo(self):
         self.assertTrue(self.checkCapability(self.securefoo, self.cap))
         id = self.users.getUserId(self.securefoo)
@@ -269,6 +269,40 @@ class IrcMsgQueueTestCase(SupyTestCase):
         self.assertEqual(self.mode, q.dequeue())
         self.assertEqual(self.msg, q.dequeue())
 
+    def testRoundRobinTargets(self):
+        q = irclib.IrcMsgQueue()
+        flood = [ircmsgs.privmsg('#foo', str(i)) for i in range(5)]
+        for msg in flood:
+            q.enqueue(msg)
+        bar = ircmsgs.privmsg('#bar', 'hi')
+        baz = ircmsgs.privmsg('#BAZ', 'hi')
+        baz2 = ircmsgs.privmsg('#baz', 'there')
+        q.enqueue(bar)
+        q.enqueue(baz)
+        q.enqueue(baz2)
+        self.assertEqual(q.dequeue(), flood[0])
+        self.assertEqual(q.dequeue(), bar)
+        self.assertEqual(q.dequeue(), baz)
+        self.assertEqual(q.dequeue(), flood[1])
+        self.assertEqual(q.dequeue(), baz2)
+        # A target becoming active again does not get ahead of the others.
+        q.enqueue(bar)
+        self.assertEqual(q.dequeue(), flood[2])
+        self.assertEqual(q.dequeue(), bar)
+        self.assertEqual(q.dequeue(), flood[3])
+        self.assertEqual(q.dequeue(), flood[4])
+        self.assertEqual(q.dequeue(), None)
+
+    def testDuplicatesCounted(self):
+        q = irclib.IrcMsgQueue()
+        q.enqueue(self.msg)
+        q.enqueue(self.msg)
+        self.assertIn(self.msg, q)
+        q.dequeue()
+        self.assertIn(self.msg, q)
+        q.dequeue()
+        self.assertNotIn(self.msg, q)
+
 
 class ChannelStateTestCase(SupyTestCase):
     def testPickleCopy(self):
@@ -365,6 +399,68 @@ class IrcStateTestCase(SupyTestCase):
             self.assertEqual(list(state.history),
                              msgs[len(msgs) - maxHistoryLength():])
 
+    def testLast(self):
+        m1 = ircmsgs.privmsg('#foo', 'one', prefix='bar!u@h')
+        m2 = ircmsgs.privmsg('#Foo', 'two', prefix='baz!u@h')
+        m3 = ircmsgs.privmsg('#qux', 'three', prefix='bar!u@h')
+        m4 = ircmsgs.privmsg('#foo', 'four', prefix='Bar!u@h')
+        m5 = ircmsgs.privmsg('#foo', 'five')
+        for (channelLength, nickLength) in ((0, 0), (10, 0), (10, 10)):
+            with conf.supybot.protocols.irc.maxChannelHistoryLength \
+                    .context(channelLength), \
+                    conf.supybot.protocols.irc.maxNickHistoryLength \
+                    .context(nickLength):
+                state = irclib.IrcState()
+                for m in (m1, m2, m3, m4, m5):
+                    state.addMsg(self.irc, m)
+                self.assertEqual(state.last('#foo'), [m5, m4, m2, m1])
+                self.assertEqual(state.last('#FOO', limit=2), [m5, m4])
+                self.assertEqual(state.last('#foo', 'bar'), [m4, m1])
+                self.assertEqual(state.last('#qux', 'bar'), [m3])
+                self.assertEqual(state.last('#foo', 'bar', limit=1), [m4])
+                self.assertEqual(state.last('#foo', predicate=lambda m:
+                                            'o' in m.args[1]), [m4, m2, m1])
+                self.assertEqual(state.last('#bar'), [])
+                self.assertEqual(state.last('#foo', 'quux'), [])
+
+    def testChannelHistory(self):
+        maxChannelHistoryLength = \
+                conf.supybot.protocols.irc.maxChannelHistoryLength
+        with maxChannelHistoryLength.context(2), \
+                conf.supybot.protocols.irc.maxHistoryLength.context(2):
+            state = irclib.IrcState()
+            m1 = ircmsgs.privmsg('#foo', 'one', prefix='bar!u@h')
+            state.addMsg(self.irc, m1)
+            for i in range(5):
+                state.addMsg(self.irc,
+                             ircmsgs.privmsg('#qux', str(i), prefix='a!u@h'))
+            self.assertEqual(state.last('#foo'), [m1])
+            self.assertEqual(len(state.last('#qux')), 2)
+            self.assertEqual(state.copy().last('#foo'), [m1])
+            state.reset()
+            self.assertEqual(state.last('#foo'), [])
+
+    def testNickHistory(self):
+        irc = conf.supybot.protocols.irc
+        with irc.maxChannelHistoryLength.context(10), \
+                irc.maxNickHistoryLength.context(2), \
+                irc.maxNickHistoryLength.nicks.context(2):
+            state = irclib.IrcState()
+            state.addMsg(self.irc, ircmsgs.join('#foo', prefix=self.irc.prefix))
+            m1 = ircmsgs.privmsg('#foo', 'one', prefix='Bar!u@h')
+            state.addMsg(self.irc, m1)
+            self.assertEqual(state.last('#foo', 'bar'), [m1])
+            state.addMsg(self.irc, ircmsgs.privmsg('#foo', 'x', prefix='a!u@h'))
+            state.addMsg(self.irc, ircmsgs.privmsg('#foo', 'y', prefix='b!u@h'))
+            # Only the buffers of the two most recently active nicks are kept;
+            # the channel's is used for the others.
+            self.assertNotIn('bar', state.channelHistory.nicks['#foo'])
+            self.assertEqual(state.last('#foo', 'bar'), [m1])
+            self.assertEqual(len(state.last('#foo')), 4)
+            state.addMsg(self.irc, ircmsgs.part('#foo', prefix=self.irc.prefix))
+            self.assertEqual(state.last('#foo'), [])
+            self.assertEqual(state.last('#foo', 'a'), [])
+
     def testWasteland005(self):
         state = irclib.IrcState()
         # Here we're testing if PREFIX works without the (ov) there.
@@ -499,6 +595,7 @@ class IrcCapsTestCase(SupyTestCase):
 
 class IrcTestCase(SupyTestCase):
     def setUp(self):
+        super(IrcTestCase, self).setUp()
         self.irc = irclib.Irc('test')
 
         #m = self.irc.takeMsg()
@@ -563,6 +660,43 @@ class IrcTestCase(SupyTestCase):
         msg = self.irc.takeMsg()
         self.assertTrue(msg.command == 'NOTICE')
 
+    def testThrottleBurst(self):
+        while self.irc.takeMsg() is not None:
+            self.irc.takeMsg()
+        throttleTime = conf.supybot.protocols.irc.throttleTime
+        with throttleTime.context(10), throttleTime.burst.context(2):
+            self.irc.throttle.reset()
+            for i in range(3):
+                self.irc.queueMsg(ircmsgs.privmsg('#foo', str(i)))
+            self.assertEqual(self.irc.takeMsg().args[1], '0')
+            self.assertEqual(self.irc.takeMsg().args[1], '1')
+            self.assertIsNone(self.irc.takeMsg())
+            timeFastForward(10)
+            self.assertEqual(self.irc.takeMsg().args[1], '2')
+
+    def testTakeMsgs(self):
+        while self.irc.takeMsg() is not None:
+            self.irc.takeMsg()
+        class DropFoo(irclib.IrcCallback):
+            def outFilter(self, irc, msg):
+                if msg.args[0] == '#foo':
+                    return None
+                elif msg.args[0] == '#baz':
+                    raise ValueError('buggy filter')
+                return msg
+        self.irc.addCallback(DropFoo())
+        try:
+            self.irc.sendMsg(ircmsgs.privmsg('#foo', 'dropped'))
+            self.irc.sendMsg(ircmsgs.privmsg('#baz', 'dropped too'))
+            self.irc.sendMsg(ircmsgs.privmsg('#bar', 'a'))
+            self.irc.queueMsg(ircmsgs.privmsg('#bar', 'x'*1000))
+            msgs = self.irc.takeMsgs()
+            self.assertEqual([msg.args[0] for msg in msgs], ['#bar', '#bar'])
+            self.assertEqual(len(str(msgs[1])), 512)
+            self.assertEqual(self.irc.takeMsgs(), [])
+        finally:
+            self.irc.removeCallback('DropFoo')
+
     def testNoMsgLongerThan512(self):
         self.irc.queueMsg(ircmsgs.privmsg('whocares', 'x'*1000))
         msg = self.irc.takeMsg()
@@ -165,6 +165,44 @@ class IrcMsgTestCase(SupyTestCase):
                              ':Angel!angel@example.org PRIVMSG Wiz :Hello')
         self.assertEqual(msg.time, 1319042451.62)
 
+        msg = ircmsgs.IrcMsg('@time=2011-10-19T16:40:51Z '
+                             ':Angel!angel@example.org PRIVMSG Wiz :Hello')
+        self.assertEqual(msg.time, 1319042451)
+
+    def testMalformedTimeFallsBackToReceiptTime(self):
+        before = time.time()
+        msg = ircmsgs.IrcMsg('@time=yesterday '
+                             ':Angel!angel@example.org PRIVMSG Wiz :Hello')
+        after = time.time()
+        self.assertTrue(before <= msg.time <= after)
+        self.assertEqual(msg.server_tags, {'time': 'yesterday'})
+
+    def testLazyFields(self):
+        msg = ircmsgs.IrcMsg('@account=angel '
+                             ':Angel!angel@example.org PRIVMSG Wiz :Hello')
+        self.assertEqual(msg.args, ('Wiz', 'Hello'))
+        self.assertEqual(msg.host, 'example.org')
+        self.assertEqual(msg.nick, 'Angel')
+        self.assertEqual(msg.user, 'angel')
+        self.assertEqual(msg.server_tags, {'account': 'angel'})
+
+        msg = ircmsgs.IrcMsg(':irc.example.org PING :foo')
+        self.assertEqual(msg.nick, 'irc.example.org')
+        self.assertEqual(msg.user, 'irc.example.org')
+        self.assertEqual(msg.host, 'irc.example.org')
+
+        msg2 = ircmsgs.IrcMsg(prefix='foo!bar@baz', msg=msg)
+        self.assertEqual(msg2.nick, 'foo')
+        self.assertEqual(msg2.host, 'baz')
+        self.assertEqual(msg2.time, msg.time)
+        self.assertEqual(msg2.server_tags, {})
+
+    def testParseServerTime(self):
+        self.assertEqual(
+            ircmsgs.parse_server_time('1970-01-01T00:00:01.5Z'), 1.5)
+        self.assertRaises(ValueError,
+            ircmsgs.parse_server_time, '1970-01-01 00:00:01Z')
+
 class FunctionsTestCase(SupyTestCase):
     def testIsAction(self):
         L = [':jemfinch!~jfincher@ts26-2.homenet.ohio-state.edu PRIVMSG'
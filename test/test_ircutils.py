@@ -58,6 +58,50 @@ class FunctionsTestCase(SupyTestCase):
             'abr-ubr1.sbo-abr.ma.cable.rcn.com'
         self.assertTrue(ircutils.hostmaskPatternEqual(s, s))
 
+    def testHostmaskIndex(self):
+        index = ircutils.HostmaskIndex()
+        patterns = ['*!*@*.example.org', 'Foo[]!*@*', '*!~bar@*',
+                    'nick!user@host.example.net', '*!*@10.0.0.*']
+        for (i, pattern) in enumerate(patterns):
+            index.add(pattern, i)
+        for hostmask in ['a!b@c.example.org', 'foo{}!x@y', 'a!~bar@c',
+                         'NICK!user@HOST.example.NET', 'a!b@10.0.0.42',
+                         'nick!~bar@example.org']:
+            expected = set(i for (i, pattern) in enumerate(patterns)
+                           if ircutils.hostmaskPatternEqual(pattern, hostmask))
+            self.assertTrue(expected)
+            self.assertTrue(expected <= index.candidates(hostmask),
+                            hostmask)
+        self.assertEqual(index.candidates('a!b@example.com'), set([2, 4]))
+        index.add('*!*@*.example.org', 5)
+        index.add('*!*@*.example.org', 5)
+        index.remove('*!*@*.example.org', 0)
+        index.remove('*!*@*.example.org', 5)
+        self.assertEqual(index.candidates('a!b@c.example.org'), set([2, 4, 5]))
+        index.remove('*!*@*.example.org', 5)
+        self.assertEqual(index.candidates('a!b@c.example.org'), set([2, 4]))
+        self.assertRaises(KeyError, index.remove, '*!*@*.example.org', 5)
+
+    def testExpiringHostmaskDict(self):
+        d = ircutils.ExpiringHostmaskDict({'*!*@*.example.org': 0})
+        self.assertTrue(d.match('foo!bar@baz.example.org'))
+        self.assertFalse(d.match('foo!bar@example.org'))
+        d['Foo[]!*@*'] = 100
+        d['*!*@example.org'] = 200
+        self.assertTrue(d.match('foo{}!bar@example.net'))
+        self.assertTrue(d.match('foo!bar@example.org'))
+        self.assertEqual(d.expire(150), [('Foo[]!*@*', 100)])
+        self.assertFalse(d.match('foo{}!bar@example.net'))
+        d['*!*@example.org'] = 300
+        self.assertEqual(d.expire(250), [])
+        self.assertTrue(d.match('foo!bar@example.org'))
+        del d['*!*@example.org']
+        self.assertEqual(d.expire(350), [])
+        self.assertFalse(d.match('foo!bar@example.org'))
+        self.assertEqual(d, {'*!*@*.example.org': 0})
+        d.clear()
+        self.assertFalse(d.match('foo!bar@baz.example.org'))
+
     def testIsUserHostmask(self):
         self.assertTrue(ircutils.isUserHostmask(self.hostmask))
         self.assertTrue(ircutils.isUserHostmask('a!b@c'))
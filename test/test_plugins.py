@@ -31,6 +31,9 @@
 from supybot.test import *
 import supybot.conf as conf
 
+import os
+import threading
+
 import supybot.irclib as irclib
 import supybot.plugins as plugins
 
@@ -48,3 +51,145 @@ class PluginsTestCase(SupyTestCase):
         self.assertEqual(
             plugins.makeChannelFilename('dir', '/../'),
             conf.supybot.directories.data() + '/__/dir')
+
+
+class TestChannelUserDB(plugins.ChannelUserDB):
+    def serialize(self, v):
+        return [v]
+
+    def deserialize(self, channel, id, L):
+        return L[0]
+
+class ChannelUserDBTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize(
+            'test_plugins.ChannelUserDB.db')
+        self.removeFiles()
+
+    def tearDown(self):
+        self.removeFiles()
+        SupyTestCase.tearDown(self)
+
+    def removeFiles(self):
+        sqlite = plugins.SqliteChannelUserDB.sqliteFilename(self.filename)
+        for filename in (self.filename, self.filename + '.journal',
+                         sqlite, sqlite + '-wal', sqlite + '-shm'):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def testJournal(self):
+        with conf.supybot.databases.plugins.journal.context(True):
+            db = TestChannelUserDB(self.filename)
+            db['#foo', 'bar'] = 'baz'
+            db['#foo', 1] = 'qux'
+            db['#bar', 'bar'] = 'quux'
+            db.flush()
+            self.assertFalse(os.path.exists(self.filename))
+            del db['#foo', 1]
+            db['#bar', 'bar'] = 'changed'
+            db.flush()
+            db = TestChannelUserDB(self.filename)
+            self.assertEqual(sorted(db.items()),
+                             [(('#bar', 'bar'), 'changed'),
+                              (('#foo', 'bar'), 'baz')])
+            # Rewrites the database once the journal is as big as it.
+            db.compactionMinimumSize = 0
+            db['#foo', 'bar'] = 'new'
+            db.flush()
+            self.assertTrue(os.path.exists(self.filename))
+            self.assertFalse(os.path.exists(self.filename + '.journal'))
+            db['#foo', 2] = 'journaled'
+            db.flush()
+            self.assertTrue(os.path.exists(self.filename + '.journal'))
+        db = TestChannelUserDB(self.filename)
+        self.assertEqual(sorted(db.items(), key=repr),
+                         [(('#bar', 'bar'), 'changed'),
+                          (('#foo', 'bar'), 'new'),
+                          (('#foo', 2), 'journaled')])
+        # Without the journal, the whole database is rewritten.
+        db.flush()
+        self.assertFalse(os.path.exists(self.filename + '.journal'))
+        db = TestChannelUserDB(self.filename)
+        self.assertEqual(len(list(db.items())), 3)
+
+    def testJournalReplayedAfterRewrite(self):
+        with conf.supybot.databases.plugins.journal.context(True):
+            db = TestChannelUserDB(self.filename)
+            db['#foo', 'bar'] = 'journaled'
+            db.flush()
+            db.compactionMinimumSize = 0
+            db['#foo', 'bar'] = 'rewritten'
+            # Crash between the rewrite and the removal of the journal.
+            originalRemove = os.remove
+            def remove(filename):
+                raise OSError('crash')
+            os.remove = remove
+            try:
+                self.assertRaises(OSError, db.flush)
+            finally:
+                os.remove = originalRemove
+            self.assertTrue(os.path.exists(self.filename + '.journal'))
+            db = TestChannelUserDB(self.filename)
+            self.assertEqual(db['#foo', 'bar'], 'rewritten')
+
+    def testSqlite(self):
+        db = TestChannelUserDB(self.filename)
+        db['#foo', 'bar'] = 'baz'
+        db['#foo', 1] = 'qux'
+        db.flush()
+        with conf.supybot.databases.plugins.channelUserDatabase \
+                .context('sqlite3'):
+            db = plugins.openChannelUserDB(TestChannelUserDB, self.filename)
+        self.assertIsInstance(db, plugins.SqliteChannelUserDB)
+        self.assertIsInstance(db, TestChannelUserDB)
+        # Imported from the CSV database.
+        self.assertEqual(db['#FOO', 1], 'qux')
+        db.cacheSize = 2
+        db['#bar', 'Nick'] = 'a'
+        db['#bar', 'nick'] = 'b' # IdDict is case-sensitive.
+        db['#foo', 'bar'] = 'changed'
+        self.assertEqual(db['#bar', 'Nick'], 'a')
+        del db['#foo', 1]
+        self.assertNotIn(('#foo', 1), db)
+        self.assertRaises(KeyError, db.__delitem__, ('#foo', 1))
+        self.assertEqual(len(db), 3)
+        db.close()
+        db = plugins.openChannelUserDB(TestChannelUserDB, self.filename)
+        self.assertNotIsInstance(db, plugins.SqliteChannelUserDB)
+        db = type('TestSqliteChannelUserDB',
+                  (plugins.SqliteChannelUserDB, TestChannelUserDB), {})(
+                  self.filename)
+        self.assertEqual(sorted(db.items(), key=repr),
+                         [(('#bar', 'Nick'), 'a'), (('#bar', 'nick'), 'b'),
+                          (('#foo', 'bar'), 'changed')])
+        db.close()
+
+    def testSqliteSubclass(self):
+        class DB(TestChannelUserDB):
+            def __init__(self, *args, **kwargs):
+                self.initialized = True
+                TestChannelUserDB.__init__(self, *args, **kwargs)
+        with conf.supybot.databases.plugins.channelUserDatabase \
+                .context('sqlite3'):
+            db = plugins.openChannelUserDB(DB, self.filename)
+        self.assertTrue(db.initialized)
+        db.close()
+
+    def testSqliteThreads(self):
+        with conf.supybot.databases.plugins.channelUserDatabase \
+                .context('sqlite3'):
+            db = plugins.openChannelUserDB(TestChannelUserDB, self.filename)
+        db.cacheSize = 10
+        def f(i):
+            for j in range(100):
+                db['#foo', '%s-%s' % (i, j)] = str(j)
+                if j % 10 == 0:
+                    db.flush()
+        threads = [threading.Thread(target=f, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(db), 400)
+        db.close()
@@ -30,6 +30,7 @@
 
 from supybot.test import *
 
+import gc
 import sys
 import time
 import pickle
@@ -38,6 +39,13 @@ import supybot.utils as utils
 from supybot.utils.structures import *
 import supybot.utils.minisix as minisix
 
+import os
+import threading
+if minisix.PY2:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+else:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
 if sys.version_info[0] >= 0:
     xrange = range
 
@@ -552,6 +560,179 @@ class WebTest(SupyTestCase):
             url = 'http://slashdot.org/'
             self.assertTrue(len(utils.web.getUrl(url, 1024)) == 1024)
 
+class WebClientTest(SupyTestCase):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):
+            server = self.server
+            server.requests.append((self.path, self.client_address,
+                                    dict(self.headers)))
+            body = ('%s %d' % (self.path, len(server.requests))).encode()
+            if self.path == '/etag' and \
+                    self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            if self.path == '/etag':
+                self.send_header('ETag', '"v1"')
+            elif self.path == '/fresh':
+                self.send_header('Cache-Control', 'max-age=60')
+            elif self.path == '/nostore':
+                self.send_header('Cache-Control', 'no-store, max-age=60')
+            elif self.path == '/vary':
+                self.send_header('Cache-Control', 'max-age=60')
+                self.send_header('Vary', 'Accept-Language, X-Token')
+            self.end_headers()
+            self.wfile.write(body)
+        def do_POST(self):
+            # Drops the connection without answering, as if the server
+            # closed it.
+            self.server.requests.append((self.path, self.client_address,
+                                         dict(self.headers)))
+            self.close_connection = True
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = HTTPServer(('127.0.0.1', 0), self.Handler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        utils.web.pool.clear()
+
+    def tearDown(self):
+        utils.web.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        SupyTestCase.tearDown(self)
+
+    def testKeepAlive(self):
+        self.assertEqual(utils.web.getUrl(self.url + '/a'), b'/a 1')
+        self.assertEqual(utils.web.getUrl(self.url + '/b'), b'/b 2')
+        self.assertEqual(self.server.requests[0][1],
+                         self.server.requests[1][1])
+        # A partially read response can't leave its connection to the pool.
+        self.assertEqual(utils.web.getUrl(self.url + '/abcdef', size=2),
+                         b'/a')
+        self.assertEqual(utils.web.getUrl(self.url + '/c'), b'/c 4')
+        self.assertNotEqual(self.server.requests[2][1],
+                            self.server.requests[3][1])
+
+    def testNoRetryPost(self):
+        self.assertEqual(utils.web.getUrl(self.url + '/a'), b'/a 1')
+        self.assertRaises(utils.web.Error, utils.web.getUrl,
+                          self.url + '/post', data=b'foo')
+        # Sent on the pooled connection, and not sent again on a new one.
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testMaxConnections(self):
+        try:
+            utils.web.pool.setMaxConnections(1)
+            fd = utils.web.getUrlFd(self.url + '/a')
+            # The response is still being downloaded.
+            self.assertFalse(utils.web.pool.semaphore.acquire(False))
+            self.assertEqual(fd.read(), b'/a 1')
+            fd.close()
+            self.assertTrue(utils.web.pool.semaphore.acquire(False))
+            utils.web.pool.semaphore.release()
+        finally:
+            utils.web.pool.setMaxConnections(
+                conf.supybot.protocols.http.maxConnections())
+
+    def testDroppedResponse(self):
+        try:
+            utils.web.pool.setMaxConnections(1)
+            fd = utils.web.getUrlFd(self.url + '/abcdef')
+            self.assertEqual(fd.read(1), b'/')
+            # Released by reference counting alone.
+            gc.disable()
+            try:
+                del fd
+                self.assertEqual(utils.web.getUrl(self.url + '/a', timeout=5),
+                                 b'/a 2')
+            finally:
+                gc.enable()
+            fd = utils.web.getUrlFd(self.url + '/abcdef')
+            self.assertRaises(utils.web.Error, utils.web.getUrl,
+                              self.url + '/a', timeout=0.1)
+            fd.close()
+        finally:
+            utils.web.pool.setMaxConnections(
+                conf.supybot.protocols.http.maxConnections())
+
+    def testMaxResponseSize(self):
+        try:
+            utils.web.maxResponseSize = 3
+            self.assertRaises(utils.web.Error,
+                              utils.web.getUrl, self.url + '/abcdef')
+            self.assertEqual(utils.web.getUrl(self.url + '/abcdef', size=4),
+                             b'/abc')
+        finally:
+            utils.web.maxResponseSize = None
+
+    def testCache(self):
+        try:
+            utils.web.cache = utils.web.ResponseCache()
+            self.assertEqual(utils.web.getUrl(self.url + '/fresh'),
+                             b'/fresh 1')
+            self.assertEqual(utils.web.getUrl(self.url + '/fresh'),
+                             b'/fresh 1')
+            self.assertEqual(len(self.server.requests), 1)
+
+            self.assertEqual(utils.web.getUrl(self.url + '/etag'),
+                             b'/etag 2')
+            fd = utils.web.getUrlFd(self.url + '/etag')
+            self.assertEqual(fd.read(), b'/etag 2')
+            self.assertEqual(fd.headers['ETag'], '"v1"')
+            fd.close()
+            self.assertEqual(len(self.server.requests), 3)
+            self.assertEqual(self.server.requests[2][2]['If-None-Match'],
+                             '"v1"')
+
+            self.assertEqual(utils.web.getUrl(self.url + '/nostore'),
+                             b'/nostore 4')
+            self.assertEqual(utils.web.getUrl(self.url + '/nostore'),
+                             b'/nostore 5')
+
+            # Depends on a header the key doesn't include.
+            self.assertEqual(utils.web.getUrl(self.url + '/vary'),
+                             b'/vary 6')
+            self.assertEqual(utils.web.getUrl(self.url + '/vary'),
+                             b'/vary 7')
+            # Fresh, but not for other credentials or cookies.
+            for header in ('Authorization', 'Cookie'):
+                headers = dict(utils.web.defaultHeaders)
+                headers[header] = 'secret'
+                self.assertEqual(
+                    utils.web.getUrl(self.url + '/fresh', headers=headers),
+                    b'/fresh 8' if header == 'Authorization' else
+                    b'/fresh 9')
+        finally:
+            utils.web.cache = None
+
+    def testDiskCache(self):
+        directory = os.path.join(conf.supybot.directories.data.tmp(),
+                                 'test-http-cache')
+        try:
+            utils.web.cache = utils.web.ResponseCache(directory=directory)
+            self.assertEqual(utils.web.getUrl(self.url + '/fresh'),
+                             b'/fresh 1')
+            utils.web.cache = utils.web.ResponseCache(directory=directory)
+            self.assertEqual(utils.web.getUrl(self.url + '/fresh'),
+                             b'/fresh 1')
+            self.assertEqual(len(self.server.requests), 1)
+        finally:
+            utils.web.cache.clear()
+            utils.web.cache = None
+
 class FormatTestCase(SupyTestCase):
     def testNormal(self):
         format = utils.str.format
@@ -1156,6 +1337,39 @@ class TestTimeoutQueue(SupyTestCase):
         q.reset()
         self.assertFalse(1 in q)
 
+class TestTokenBucket(SupyTestCase):
+    def testBurst(self):
+        b = TokenBucket(1, 3)
+        self.assertTrue(b.take(10))
+        self.assertTrue(b.take(10))
+        self.assertTrue(b.take(10))
+        self.assertFalse(b.take(10))
+        self.assertEqual(b.delay(10), 1)
+        self.assertFalse(b.take(10.5))
+        self.assertEqual(b.delay(10.5), 0.5)
+        self.assertEqual(b.delay(11), 0)
+        self.assertTrue(b.take(11))
+        self.assertFalse(b.take(11))
+        for i in range(3):
+            self.assertTrue(b.take(100))
+        self.assertFalse(b.take(100))
+
+    def testCallable(self):
+        period = [0]
+        b = TokenBucket(lambda: period[0], lambda: 1)
+        for i in range(10):
+            self.assertTrue(b.take(10))
+        period[0] = 2
+        self.assertFalse(b.take(10))
+        self.assertEqual(b.delay(10), 2)
+
+    def testReset(self):
+        b = TokenBucket(10)
+        self.assertTrue(b.take())
+        self.assertFalse(b.take())
+        b.reset()
+        self.assertTrue(b.take())
+
 class TestCacheDict(SupyTestCase):
     def testMaxNeverExceeded(self):
         max = 10
@@ -1166,6 +1380,42 @@ class TestCacheDict(SupyTestCase):
             self.assertTrue(i in d)
             self.assertTrue(d[i] == i)
 
+    def testLeastRecentlyUsedEvicted(self):
+        d = CacheDict(3)
+        d['foo'] = 1
+        d['bar'] = 2
+        d['baz'] = 3
+        d['foo']
+        d['qux'] = 4
+        self.assertEqual(set(d), set(['foo', 'baz', 'qux']))
+        d['baz'] = 5
+        d['quux'] = 6
+        self.assertEqual(set(d), set(['baz', 'qux', 'quux']))
+
+    def testCounters(self):
+        d = CacheDict(2)
+        d['foo'] = 1
+        self.assertEqual(d['foo'], 1)
+        self.assertRaises(KeyError, d.__getitem__, 'bar')
+        d['bar'] = 2
+        d['baz'] = 3
+        self.assertEqual((d.hits, d.misses, d.evictions), (1, 1, 1))
+
+    def testResize(self):
+        d = CacheDict(10)
+        for i in range(10):
+            d[i] = i
+        d.resize(3)
+        self.assertEqual(set(d), set([7, 8, 9]))
+        self.assertEqual(d.evictions, 7)
+
+    def testNamed(self):
+        d = CacheDict(10, 'testNamed')
+        unnamed = CacheDict(10)
+        named = CacheDict.named()
+        self.assertTrue(any(cache is d for cache in named))
+        self.assertFalse(any(cache is unnamed for cache in named))
+
 class TestTruncatableSet(SupyTestCase):
     def testBasics(self):
         s = TruncatableSet(['foo', 'bar', 'baz', 'qux'])